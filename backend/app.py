@@ -1,204 +1,532 @@
-# -*- coding: utf-8 -*-
-import os
-import uuid
-import tempfile
-import boto3
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import rasterio
-from rasterio.warp import transform_bounds
-import numpy as np
-from PIL import Image
-import psycopg2
-import psycopg2.extras
-from collections import defaultdict
-
-# --- 应用初始化 ---
-app = Flask(__name__)
-CORS(app)  # 为整个应用启用CORS
-
-# --- AWS S3 配置 ---
-# 强烈建议将这些值设置为您 Render 服务中的环境变量
-S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
-AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
-AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
-AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
-
-# S3 存储桶内的“文件夹”（前缀）
-S3_PREVIEW_PREFIX = 'previews/'  # 用于存放处理后的预览图
-S3_SOURCE_PREFIX = 'geotiffs/'  # 用于存放用户上传的原始GeoTIFF文件
-
-# 初始化 S3 客户端
-# boto3 会自动从环境变量中读取凭证
-s3_client = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
-
-# --- 数据库连接 ---
-def get_db_connection():
-    """建立与 PostgreSQL 数据库的连接。"""
-    # 将您的数据库凭证也设置为环境变量
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST'),
-        database=os.environ.get('DB_NAME'),
-        user=os.environ.get('DB_USER'),
-        password=os.environ.get('DB_PASSWORD')
-    )
-    return conn
-
-# --- 文件上传接口 (已为S3重构) ---
-@app.route('/upload-geotiff', methods=['POST'])
-def upload_geotiff():
-    if 'file' not in request.files:
-        return jsonify({"success": False, "error": "请求中不包含文件部分"}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"success": False, "error": "未选择任何文件"}), 400
-
-    conn = None
-    temp_geotiff_path = None
-    temp_preview_path = None
-
-    try:
-        # 步骤 1: 将上传的文件保存到服务器的临时路径中
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
-            file.save(temp_file.name)
-            temp_geotiff_path = temp_file.name
-
-        # 步骤 2: 将原始 GeoTIFF 文件上传到 S3 进行备份和存档
-        dataset_name = os.path.splitext(file.filename)[0]
-        s3_source_key = f"{S3_SOURCE_PREFIX}{uuid.uuid4()}_{file.filename}"
-        s3_client.upload_file(temp_geotiff_path, S3_BUCKET_NAME, s3_source_key)
-        print(f"原始文件已上传至: s3://{S3_BUCKET_NAME}/{s3_source_key}")
-
-        # 步骤 3: 处理本地的临时 GeoTIFF 文件以创建预览图
-        with rasterio.open(temp_geotiff_path) as dataset:
-            bounds = dataset.bounds
-            src_crs = dataset.crs
-            wgs84_bounds = transform_bounds(src_crs, {'init': 'epsg:4326'}, *bounds)
-            band1 = dataset.read(1)
-            min_val, max_val = np.min(band1), np.max(band1)
-
-            if max_val == min_val:
-                normalized_band = np.zeros(band1.shape, dtype=np.uint8)
-            else:
-                normalized_band = ((band1 - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-
-            img = Image.fromarray(normalized_band, 'L')
-            
-            # 将预览图保存到另一个临时文件中
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_preview:
-                img.save(temp_preview.name, format='PNG')
-                temp_preview_path = temp_preview.name
-        
-        # 步骤 4: 将生成的预览图上传到 S3，并设置为公开可读
-        s3_preview_key = f"{S3_PREVIEW_PREFIX}{uuid.uuid4()}.png"
-        s3_client.upload_file(
-            temp_preview_path,
-            S3_BUCKET_NAME,
-            s3_preview_key,
-            ExtraArgs={'ContentType': 'image/png', 'ACL': 'public-read'}
-        )
-        # 构建预览图的公开访问 URL
-        preview_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_DEFAULT_REGION}.amazonaws.com/{s3_preview_key}"
-        print(f"预览图已上传至: {preview_url}")
-
-        # 步骤 5: 将元数据和 S3 预览图 URL 存入数据库
-        wkt_polygon = f'POLYGON(({wgs84_bounds[0]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[1]}))'
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 默认归类为“其他”。更高级的实现可能允许用户在前端选择分类。
-        # 请确保您的 categories 表中存在 ID 为 4 的记录，或者修改为正确的ID。
-        default_category_id = 4
-        cursor.execute(
-            """
-            INSERT INTO datasets (name, image_url, geom, source_path, source_type, category_id) 
-            VALUES (%s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s)
-            """,
-            (dataset_name, preview_url, wkt_polygon, s3_source_key, 'S3_UPLOAD', default_category_id)
-        )
-        conn.commit()
-        cursor.close()
-
-        return jsonify({"success": True, "message": f"数据集 '{dataset_name}' 已成功处理并保存。"})
-
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        print(f"文件上传和处理过程中发生错误: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
-    finally:
-        # 步骤 6: 无论成功与否，都清理服务器上的所有临时文件
-        if temp_geotiff_path and os.path.exists(temp_geotiff_path):
-            os.remove(temp_geotiff_path)
-        if temp_preview_path and os.path.exists(temp_preview_path):
-            os.remove(temp_preview_path)
-        if conn:
-            conn.close()
-
-# --- 数据集 API 接口 (已适配 S3) ---
-@app.route('/api/datasets', methods=['GET'])
-def get_datasets():
-    """从数据库获取按分类分组的数据集列表。"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-        sql = """
-            SELECT 
-                c.name as category_name,
-                c.description as category_description,
-                d.id, 
-                d.name, 
-                d.image_url, -- 这已经是完整的 S3 URL
-                d.source_type,
-                ST_XMin(d.geom) as bbox_west,
-                ST_YMin(d.geom) as bbox_south,
-                ST_XMax(d.geom) as bbox_east,
-                ST_YMax(d.geom) as bbox_north
-            FROM datasets d
-            JOIN categories c ON d.category_id = c.id
-            ORDER BY c.name, d.name;
-        """
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-
-        # 将扁平的查询结果按分类分组，转换为层级结构
-        grouped_data = defaultdict(lambda: {'category_description': '', 'datasets': []})
-        for row in rows:
-            category_name = row['category_name']
-            grouped_data[category_name]['category_description'] = row['category_description']
-            
-            dataset_info = dict(row)
-            # !!! 关键改动: 不再需要拼接 request.host_url !!!
-            # 因为数据库中存储的已经是完整的、可公开访问的 S3 URL。
-            
-            # 清理字典以获得更简洁的 API 响应
-            dataset_info['category'] = dataset_info.pop('category_name')
-            del dataset_info['category_description']
-            
-            grouped_data[category_name]['datasets'].append(dataset_info)
-
-        # 将分组后的数据转换为最终的列表格式
-        final_result = [
-            {"category": name, "description": data['category_description'], "datasets": data['datasets']}
-            for name, data in grouped_data.items()
-        ]
-
-        return jsonify(final_result)
-
-    except Exception as e:
-        print(f"获取数据集时出错: {e}")
-        return jsonify({"success": False, "error": "无法从数据库检索数据集。"}), 500
-    finally:
-        if conn:
-            conn.close()
-
-# --- 主程序入口 ---
-if __name__ == '__main__':
-    # Render 会自动设置 PORT 环境变量
-    port = int(os.environ.get('PORT', 5000))
-    # 使用 0.0.0.0 使服务在容器/Render环境中可访问
-    app.run(host='0.0.0.0', port=port)
+# -*- coding: utf-8 -*-
+import os
+import io
+import time
+from flask import Flask, Request, request, jsonify, send_file, g
+from flask_cors import CORS
+import psycopg2.extras
+from collections import defaultdict
+from tiles import is_valid_tile, resolve_source_uri, render_tile, empty_tile
+from render import parse_render_params
+from tile_cache import tile_cache
+from jobs import (
+    new_job_id, spool_file_path, open_incoming_file, adopt_incoming_file, enqueue_job, get_job, load_worker_metrics
+)
+from encoding import encode_image, encode_stats
+from dedup import HashingWriter, find_dataset_by_hash, describe_duplicate
+from uploads import UploadError, create_upload, describe_upload, put_part, complete_upload, abort_upload
+# 数据库连接来自共享连接池，close() 时归还
+from db import get_db_connection, db_pool
+from catalog_cache import (
+    get_catalog_version, make_query_key, make_etag, cache_control_header,
+    get_cached_response, put_cached_response
+)
+from metrics import timed, observe, add_bytes_written, register_collector, render_prometheus
+from mosaic import render_mosaic, parse_mosaic_size, parse_ordering
+from footprints import get_footprint_tile, MVT_CONTENT_TYPE
+from sampling import (
+    raster_handles, parse_points, parse_band, parse_dataset_ids, parse_geometry, sample_points, zonal_summary,
+    ZONAL_DEFAULT_BINS
+)
+
+# --- 应用初始化 ---
+class SpoolingRequest(Request):
+    """
+    multipart 上传的文件直接写入任务 spool 目录，而不是先写到系统临时文件再复制一遍；
+    写入的同时计算 SHA-256，用于去重。
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingWriter(open_incoming_file())
+
+app = Flask(__name__)
+app.request_class = SpoolingRequest
+CORS(app)  # 为整个应用启用CORS
+
+# 在 /metrics 中一并导出已有的缓存、连接池和编码统计
+register_collector('tile_cache', tile_cache.stats)
+register_collector('db_pool', db_pool.stats)
+register_collector('encode', encode_stats, label='format')
+register_collector('raster_handles', raster_handles.stats)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        observe('http_request_seconds', time.perf_counter() - started,
+                endpoint=request.endpoint or 'unmatched', method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def remove_incoming_files(exc):
+    """删除请求中未被任务接管的上传文件 (例如校验失败的请求)。"""
+    files = request.__dict__.get('files')  # 只清理已经解析过的请求体
+    for file in (files.values() if files else ()):
+        path = getattr(file.stream, 'name', None)
+        file.stream.close()
+        if isinstance(path, str) and os.path.exists(path):
+            os.remove(path)
+
+# --- 文件上传接口 (异步处理) ---
+@app.route('/upload-geotiff', methods=['POST'])
+def upload_geotiff():
+    """
+    将上传的文件保存到任务 spool 目录并入队，立即返回 202 和任务 ID。
+    S3 存档、预览图生成和入库由 jobs.py 中的 worker 异步完成，进度通过 /api/jobs/<id> 查询。
+    相同内容的文件已入库时不再处理，返回 200 和已有数据集 (duplicate 为 true)。
+    """
+    # 首次访问 request.files 时才接收并写入请求体
+    with timed('receive'):
+        files = request.files
+    if 'file' not in files:
+        return jsonify({"success": False, "error": "请求中不包含文件部分"}), 400
+
+    file = files['file']
+    if file.filename == '':
+        return jsonify({"success": False, "error": "未选择任何文件"}), 400
+    add_bytes_written('spool', os.path.getsize(file.stream.name))
+
+    # 内容哈希在接收请求体时已计算；重复的文件由 teardown 删除
+    content_hash = file.stream.hexdigest()
+    conn = get_db_connection()
+    try:
+        duplicate = find_dataset_by_hash(conn, content_hash)
+    finally:
+        conn.close()
+    if duplicate is not None:
+        return jsonify(dict(describe_duplicate(duplicate), success=True)), 200
+
+    job_id = new_job_id()
+    spool_path = spool_file_path(job_id, file.filename)
+    try:
+        # 请求体已由 SpoolingRequest 写入 spool 目录，这里只需 rename
+        spool_path = adopt_incoming_file(file.stream, job_id, file.filename)
+        enqueue_job(job_id, 'upload', {'path': spool_path, 'filename': file.filename, 'content_hash': content_hash})
+    except Exception as e:
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        print(f"上传文件入队时发生错误: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    status_url = f"/api/jobs/{job_id}"
+    response = jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status_url": status_url,
+        "message": f"文件 '{file.filename}' 已接收，正在后台处理。"
+    })
+    response.headers['Location'] = status_url
+    return response, 202
+
+# --- 分块上传接口 (大文件，可续传；协议见 uploads.py) ---
+@app.errorhandler(UploadError)
+def handle_upload_error(e):
+    return jsonify({"success": False, "error": str(e)}), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+def start_chunked_upload():
+    """开始分块上传，返回 upload_id、分块大小和分块数。"""
+    body = request.get_json(silent=True) or {}
+    session = create_upload(body.get('filename'), body.get('size'))
+    return jsonify(dict(session, success=True)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """查询已收到的分块，客户端断线后据此只补传缺失的分块。"""
+    return jsonify(describe_upload(upload_id))
+
+@app.route('/api/uploads/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+def put_chunked_upload_part(upload_id, part_number):
+    """接收一个分块 (请求体为原始字节)。最后一块到达时自动完成并入队处理 (或报告重复)。"""
+    result = put_part(upload_id, part_number, request.stream, request.content_length)
+    return jsonify(dict(result, success=True))
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """完成上传并入队处理 (幂等)，返回 202 和任务 ID；相同内容已入库时返回 200 和已有数据集。"""
+    job = complete_upload(upload_id)
+    if job.get('duplicate'):
+        return jsonify(dict(job, success=True)), 200
+    response = jsonify(dict(job, success=True))
+    response.headers['Location'] = job['status_url']
+    return response, 202
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """放弃上传并删除已收到的分块。"""
+    abort_upload(upload_id)
+    return jsonify({"success": True})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """查询上传任务的状态、阶段和进度。"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+    return jsonify(job)
+
+# --- 数据集 API 接口 (已适配 S3) ---
+# 单页最多返回的数据集数量
+DATASETS_MAX_PAGE_SIZE = 1000
+
+def parse_bbox(value):
+    """解析 'west,south,east,north' (WGS84 经纬度)。west > east 表示跨越 180° 经线。"""
+    parts = [float(v) for v in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox 必须是 west,south,east,north 四个数值")
+    west, south, east, north = parts
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox 超出经纬度范围")
+    return west, south, east, north
+
+def build_dataset_filters(args):
+    """
+    根据查询参数构建 WHERE 子句和参数。
+    bbox 通过 ST_Intersects 命中 datasets.geom 上的 GiST 索引；跨越 180° 经线的 bbox 拆成两个矩形。
+    """
+    clauses, params = [], []
+    if args.get('bbox'):
+        west, south, east, north = parse_bbox(args['bbox'])
+        if west <= east:
+            clauses.append("ST_Intersects(d.geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))")
+            params += [west, south, east, north]
+        else:
+            clauses.append("(ST_Intersects(d.geom, ST_MakeEnvelope(%s, %s, 180, %s, 4326))"
+                           " OR ST_Intersects(d.geom, ST_MakeEnvelope(-180, %s, %s, %s, 4326)))")
+            params += [west, south, north, south, east, north]
+    if args.get('category'):
+        clauses.append("c.name = %s")
+        params.append(args['category'])
+    if args.get('after'):
+        clauses.append("d.id > %s")
+        params.append(int(args['after']))
+    return clauses, params
+
+@app.route('/api/datasets', methods=['GET'])
+def get_datasets():
+    """
+    从数据库获取按分类分组的数据集列表。
+    可选参数:
+        bbox=west,south,east,north  只返回与该范围相交的数据集
+        category=<分类名>            只返回该分类的数据集
+        after=<id>&limit=<n>        按 id 进行 keyset 分页；指定后返回 {"categories": [...], "next_after": id}
+    响应按目录版本缓存，并带有 ETag；客户端携带 If-None-Match 时可能得到 304。
+    """
+    paginated = 'limit' in request.args or 'after' in request.args
+    try:
+        clauses, params = build_dataset_filters(request.args)
+        limit = int(request.args.get('limit', DATASETS_MAX_PAGE_SIZE)) if paginated else None
+        if limit is not None and not (0 < limit <= DATASETS_MAX_PAGE_SIZE):
+            raise ValueError(f"limit 必须在 1 到 {DATASETS_MAX_PAGE_SIZE} 之间")
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"无效的查询参数: {e}"}), 400
+
+    try:
+        version = get_catalog_version()
+        query_key = make_query_key(request.args)
+        etag = make_etag(version, query_key)
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            body = get_cached_response(version, query_key)
+            if body is None:
+                body = query_datasets(clauses, params, paginated, limit)
+                put_cached_response(version, query_key, body)
+            response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control_header()
+        return response
+
+    except Exception as e:
+        print(f"获取数据集时出错: {e}")
+        return jsonify({"success": False, "error": "无法从数据库检索数据集。"}), 500
+
+def query_datasets(clauses, params, paginated, limit):
+    """执行数据集查询并返回序列化后的 JSON 响应体 (bytes)。"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        sql = """
+            SELECT 
+                c.name as category_name,
+                c.description as category_description,
+                d.id, 
+                d.name, 
+                d.image_url, -- 这已经是完整的 S3 URL
+                d.source_type,
+                d.source_path,
+                d.cog_path,
+                ST_XMin(d.geom) as bbox_west,
+                ST_YMin(d.geom) as bbox_south,
+                ST_XMax(d.geom) as bbox_east,
+                ST_YMax(d.geom) as bbox_north
+            FROM datasets d
+            JOIN categories c ON d.category_id = c.id
+        """
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        if paginated:
+            # keyset 分页按主键排序，翻页成本与页码无关
+            sql += " ORDER BY d.id LIMIT %s"
+            params.append(limit)
+        else:
+            sql += " ORDER BY c.name, d.name"
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        # 将扁平的查询结果按分类分组，转换为层级结构
+        grouped_data = defaultdict(lambda: {'category_description': '', 'datasets': []})
+        for row in rows:
+            category_name = row['category_name']
+            grouped_data[category_name]['category_description'] = row['category_description']
+            
+            dataset_info = dict(row)
+            # !!! 关键改动: 不再需要拼接 request.host_url !!!
+            # 因为数据库中存储的已经是完整的、可公开访问的 S3 URL。
+            
+            # 清理字典以获得更简洁的 API 响应
+            dataset_info['category'] = dataset_info.pop('category_name')
+            del dataset_info['category_description']
+
+            # 可按需切片的数据集附带瓦片模板 URL (相对路径)，前端据此切换到瓦片图层
+            source_path = dataset_info.pop('source_path')
+            cog_path = dataset_info.pop('cog_path')
+            if resolve_source_uri(source_path, dataset_info['source_type'], cog_path):
+                dataset_info['tile_url'] = f"/tiles/{dataset_info['id']}/{{z}}/{{x}}/{{y}}.png"
+            else:
+                dataset_info['tile_url'] = None
+            
+            grouped_data[category_name]['datasets'].append(dataset_info)
+
+        # 将分组后的数据转换为最终的列表格式
+        final_result = [
+            {"category": name, "description": data['category_description'], "datasets": data['datasets']}
+            for name, data in grouped_data.items()
+        ]
+
+        if paginated:
+            final_result.sort(key=lambda group: group['category'])
+            next_after = rows[-1]['id'] if len(rows) == limit else None
+            return jsonify({"categories": final_result, "next_after": next_after}).get_data()
+        return jsonify(final_result).get_data()
+
+    finally:
+        if conn:
+            conn.close()
+
+# --- 动态瓦片接口 ---
+@app.route('/tiles/<int:dataset_id>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def get_tile(dataset_id, z, x, y):
+    """
+    从源栅格按需渲染 Web Mercator XYZ 瓦片。
+    可选查询参数: colormap (gray/terrain/slope/hillshade) 和 bands (例如 4,3,2 合成 RGB)。
+    """
+    if not is_valid_tile(z, x, y):
+        return jsonify({"success": False, "error": "无效的瓦片坐标"}), 400
+    try:
+        colormap, bands = parse_render_params(request.args.get('colormap'), request.args.get('bands'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT source_path, source_type, cog_path, created_at, stats FROM datasets WHERE id = %s",
+            (dataset_id,)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+    except Exception as e:
+        print(f"查询数据集 {dataset_id} 时出错: {e}")
+        return jsonify({"success": False, "error": "无法从数据库检索数据集。"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+    if row is None:
+        return jsonify({"success": False, "error": "数据集不存在"}), 404
+    source_path, source_type, cog_path, created_at, stats = row
+    src_uri = resolve_source_uri(source_path, source_type, cog_path)
+    if src_uri is None:
+        return jsonify({"success": False, "error": "该数据集的源文件无法按需切片"}), 404
+
+    # 以入库时间作为数据集版本，重新入库后旧版本的缓存键不会再被命中
+    version = int(created_at.timestamp()) if created_at else 0
+    render_params = {'colormap': colormap, 'bands': bands} if (colormap or bands != (1,)) else None
+    cache_key = tile_cache.make_key(dataset_id, z, x, y, params=render_params, version=version)
+    tile_bytes = tile_cache.get(cache_key)
+    if tile_bytes is None:
+        try:
+            img = render_tile(src_uri, z, x, y, stats=stats, colormap=colormap, bands=bands) or empty_tile()
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        except Exception as e:
+            print(f"渲染瓦片 {dataset_id}/{z}/{x}/{y} 时出错: {e}")
+            return jsonify({"success": False, "error": "瓦片渲染失败"}), 500
+
+        tile_bytes, _, _ = encode_image(img, 'png')
+        tile_cache.put(cache_key, tile_bytes)
+
+    return send_file(io.BytesIO(tile_bytes), mimetype='image/png')
+
+# --- 数据集范围矢量瓦片 ---
+@app.route('/api/footprints/<int:z>/<int:x>/<int:y>.mvt', methods=['GET'])
+def get_footprints(z, x, y):
+    """
+    数据集范围的 Mapbox Vector Tile (图层名 footprints)。低级别为带 count 的聚合点，
+    高级别为带 id/name/category 的范围多边形 (见 footprints.py)。
+    瓦片按目录版本缓存在瓦片缓存中，并带有 ETag。
+    """
+    if not is_valid_tile(z, x, y):
+        return jsonify({"success": False, "error": "无效的瓦片坐标"}), 400
+    try:
+        version = get_catalog_version()
+        etag = make_etag(version, f"footprints/{z}/{x}/{y}")
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            # 目录版本变化后旧版本的键不会再被命中，由缓存按 LRU 和磁盘上限淘汰
+            cache_key = tile_cache.make_key('footprints', z, x, y, version=version)
+            tile_bytes = tile_cache.get(cache_key)
+            if tile_bytes is None:
+                tile_bytes = get_footprint_tile(z, x, y)
+                tile_cache.put(cache_key, tile_bytes)
+            response = app.response_class(tile_bytes, mimetype=MVT_CONTENT_TYPE)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control_header()
+        return response
+    except Exception as e:
+        print(f"生成范围瓦片 {z}/{x}/{y} 时出错: {e}")
+        return jsonify({"success": False, "error": "无法生成范围瓦片"}), 500
+
+# --- 镶嵌接口 ---
+@app.route('/api/mosaic', methods=['GET'])
+def get_mosaic():
+    """
+    把与 bbox 相交的数据集合成为一张 EPSG:4326 图像，替代逐个叠加各数据集的预览图。
+    参数:
+        bbox=west,south,east,north  (必填，不支持跨越 180° 经线)
+        width=<像素>&height=<像素>    (必填)
+        order=first|last|mean        重叠区域的合成方式，默认 first
+        category=<分类名>             只合成该分类的数据集
+        colormap / bands / format    同瓦片接口；format 默认 png
+    响应按目录版本生成 ETag，入库新数据后才会变化；X-Mosaic-Datasets 为参与合成的数据集数量，
+    X-Mosaic-Truncated 为 true 时表示相交的数据集超过 MOSAIC_MAX_DATASETS，只合成了其中一部分。
+    """
+    try:
+        if not request.args.get('bbox'):
+            raise ValueError("缺少 bbox")
+        bbox = parse_bbox(request.args['bbox'])
+        width, height = parse_mosaic_size(request.args.get('width', 0), request.args.get('height', 0))
+        ordering = parse_ordering(request.args.get('order'))
+        colormap, bands = parse_render_params(request.args.get('colormap'), request.args.get('bands'))
+        fmt = request.args.get('format', 'png')
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"无效的查询参数: {e}"}), 400
+
+    try:
+        etag = make_etag(get_catalog_version(), 'mosaic?' + make_query_key(request.args))
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            img, dataset_count, truncated = render_mosaic(bbox, width, height, ordering, colormap, bands,
+                                               request.args.get('category'))
+            data, content_type, _ = encode_image(img, fmt)
+            response = send_file(io.BytesIO(data), mimetype=content_type)
+            response.headers['X-Mosaic-Datasets'] = str(dataset_count)
+            response.headers['X-Mosaic-Truncated'] = 'true' if truncated else 'false'
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control_header()
+        return response
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        print(f"生成镶嵌图时出错: {e}")
+        return jsonify({"success": False, "error": "镶嵌图生成失败"}), 500
+
+# --- 取值与统计接口 ---
+@app.route('/api/sample', methods=['POST'])
+def sample():
+    """
+    批量按点取值。请求体:
+        {"points": [[lon, lat], ...], "band": 1, "dataset_ids": [...], "category": "..."}
+    band、dataset_ids 和 category 均为可选。返回每个点在所有覆盖它的数据集中的像素值 (nodata 为 null)。
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        lons, lats = parse_points(body.get('points'))
+        band = parse_band(body.get('band'))
+        dataset_ids = parse_dataset_ids(body.get('dataset_ids'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"无效的请求参数: {e}"}), 400
+
+    try:
+        results = sample_points(lons, lats, band, dataset_ids, body.get('category'))
+    except Exception as e:
+        print(f"按点取值时出错: {e}")
+        return jsonify({"success": False, "error": "取值失败"}), 500
+    return jsonify({"success": True, "band": band, "points": results})
+
+@app.route('/api/zonal', methods=['POST'])
+def zonal():
+    """
+    按多边形统计。请求体:
+        {"geometry": <GeoJSON Polygon/MultiPolygon (WGS84)>, "band": 1, "bins": 32, "dataset_ids": [...], "category": "..."}
+    返回每个相交数据集在多边形内的 count/min/max/mean/std 和直方图。
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        geometry = parse_geometry(body.get('geometry'))
+        band = parse_band(body.get('band'))
+        bins = int(body.get('bins', ZONAL_DEFAULT_BINS))
+        dataset_ids = parse_dataset_ids(body.get('dataset_ids'))
+        results = zonal_summary(geometry, band, bins, dataset_ids, body.get('category'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"无效的请求参数: {e}"}), 400
+    except Exception as e:
+        print(f"按多边形统计时出错: {e}")
+        return jsonify({"success": False, "error": "统计失败"}), 500
+    return jsonify({"success": True, "band": band, "datasets": results})
+
+@app.route('/api/raster-handles/stats', methods=['GET'])
+def get_raster_handle_stats():
+    """返回本进程栅格句柄缓存的命中/未命中/淘汰计数。"""
+    return jsonify(raster_handles.stats())
+
+@app.route('/api/tile-cache/stats', methods=['GET'])
+def get_tile_cache_stats():
+    """返回瓦片缓存的命中/未命中/淘汰计数，用于评估缓存容量。"""
+    return jsonify(tile_cache.stats())
+
+@app.route('/api/encode/stats', methods=['GET'])
+def get_encode_stats():
+    """返回本进程内按格式统计的图像编码次数、耗时和输出大小。"""
+    return jsonify(encode_stats())
+
+@app.route('/api/db-pool/stats', methods=['GET'])
+def get_db_pool_stats():
+    """返回本进程数据库连接池的大小、借出次数和等待时间统计。"""
+    return jsonify(db_pool.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    以 Prometheus 文本格式导出阶段耗时、读写字节数、入库行数和 HTTP 延迟：本进程的指标
+    加上独立任务 worker 进程 (python jobs.py) 写入的快照，上传处理各阶段的耗时因此也在这里。
+    """
+    return app.response_class(render_prometheus(load_worker_metrics()), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# --- 主程序入口 ---
+if __name__ == '__main__':
+    # Render 会自动设置 PORT 环境变量
+    port = int(os.environ.get('PORT', 5000))
+    # 使用 0.0.0.0 使服务在容器/Render环境中可访问
+    app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+为没有保存波段统计的旧数据集回填 datasets.stats。
+
+新入库的数据集在入库时就会计算统计 (见 raster_stats.py)；更早入库的数据集在瓦片请求中
+只能按降采样数据粗略估计拉伸范围。运行本脚本一次即可让它们与新数据集一样直接使用保存的统计:
+
+    python backfill_stats.py              # 回填全部缺少统计的数据集
+    python backfill_stats.py --limit 100  # 只处理前 100 个
+
+无法读取源文件的数据集 (例如来自 Google Drive) 会被跳过。
+"""
+import argparse
+
+import psycopg2.extras
+import rasterio
+
+from db import get_db_connection
+from raster_stats import compute_band_stats
+from tiles import resolve_source_uri
+from tile_cache import tile_cache
+
+
+def find_datasets_without_stats(conn, limit=None):
+    cursor = conn.cursor()
+    sql = "SELECT id, source_path, source_type, cog_path FROM datasets WHERE stats IS NULL ORDER BY id"
+    if limit:
+        sql += " LIMIT %s"
+    cursor.execute(sql, (limit,) if limit else None)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def backfill_dataset(conn, dataset_id, src_uri):
+    with rasterio.open(src_uri) as src:
+        stats = compute_band_stats(src, 1)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE datasets SET stats = %s WHERE id = %s AND stats IS NULL",
+                       (psycopg2.extras.Json(stats), dataset_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    # 已缓存的瓦片按估计的拉伸范围渲染，清掉后按保存的统计重新渲染
+    tile_cache.invalidate_dataset(dataset_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="为缺少波段统计的旧数据集回填 datasets.stats")
+    parser.add_argument('--limit', type=int, default=None, help="最多处理的数据集数量")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    succeeded = skipped = failed = 0
+    try:
+        for dataset_id, source_path, source_type, cog_path in find_datasets_without_stats(conn, args.limit):
+            src_uri = resolve_source_uri(source_path, source_type, cog_path)
+            if src_uri is None:
+                skipped += 1
+                continue
+            try:
+                backfill_dataset(conn, dataset_id, src_uri)
+                succeeded += 1
+                print(f"✅ 已回填数据集 #{dataset_id}")
+            except Exception as e:
+                failed += 1
+                print(f"❌ 回填数据集 #{dataset_id} 失败: {e}")
+    finally:
+        conn.close()
+    print(f"回填完成：成功 {succeeded} 个，跳过 {skipped} 个 (源文件不可读)，失败 {failed} 个。")
+
+
+if __name__ == '__main__':
+    main()
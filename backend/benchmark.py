@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准：生成可配置的合成 GeoTIFF，在 moto 模拟的 S3 和本地 PostgreSQL/PostGIS 上
+测量预览图生成、上传、入库和数据集列表接口的吞吐量、p50/p99 延迟和峰值内存 (RSS)。
+
+    pip install "moto[s3]"        # 仅基准测试需要
+    python init_dtable.py         # 在一个专用的本地数据库上初始化表结构 (连接参数见 DB_* 环境变量)
+    python benchmark.py --count 5 --width 4096 --height 4096 --dtype float32 --crs EPSG:32633 \\
+        --tiled --nodata -9999 --compare
+
+场景 (--scenarios，逗号分隔):
+    preview   process_geotiff_and_upload：统计 + 降采样读取 + 编码 + 上传预览图
+    upload    POST /upload-geotiff 的请求耗时 (upload_request)，以及任务处理耗时 (upload_job)
+    ingest    process_and_insert_geotiff + DatasetBatchWriter 批量入库
+    listing   GET /api/datasets：未命中缓存 (listing_cold)、命中缓存 (listing_cached) 和 bbox 过滤 (listing_bbox)
+
+每个场景在独立的子进程中运行，峰值 RSS 互不影响。结果以 JSON Lines 追加到 --output
+(默认 bench_results.jsonl)，每行带有 git 提交、参数和指标；--compare 会与同场景、同参数的
+上一次结果对比。基准写入的数据集都归入 "benchmark" 分类，结束时删除。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import transform as transform_coords
+from rasterio.windows import Window
+
+BENCH_CATEGORY = 'benchmark'
+BENCH_SOURCE_TYPE = 'BENCH'
+BENCH_BUCKET = 'geotiff-bench'
+DEFAULT_OUTPUT = 'bench_results.jsonl'
+ALL_SCENARIOS = ('preview', 'upload', 'ingest', 'listing')
+# 需要数据库的场景；preview 只需要 S3
+DB_SCENARIOS = ('upload', 'ingest', 'listing')
+# 合成栅格的中心位置 (经纬度)，投影坐标系下的像元大小 (米)
+SYNTHETIC_CENTER = (10.0, 45.0)
+SYNTHETIC_PROJECTED_RES = 30.0
+
+
+# --- 合成 GeoTIFF ---
+def synthetic_transform(crs, width, height):
+    """以 SYNTHETIC_CENTER 为中心：地理坐标系下覆盖 1°，投影坐标系下像元为 SYNTHETIC_PROJECTED_RES 米。"""
+    crs = CRS.from_user_input(crs)
+    if crs.is_geographic:
+        res = 1.0 / max(width, height)
+        cx, cy = SYNTHETIC_CENTER
+    else:
+        res = SYNTHETIC_PROJECTED_RES
+        xs, ys = transform_coords('EPSG:4326', crs, [SYNTHETIC_CENTER[0]], [SYNTHETIC_CENTER[1]])
+        cx, cy = xs[0], ys[0]
+    return from_origin(cx - width * res / 2, cy + height * res / 2, res, res)
+
+def make_synthetic_geotiff(path, width=2048, height=2048, dtype='float32', crs='EPSG:4326', bands=1,
+                           tiled=True, blocksize=512, nodata=None, compress=None, overviews=False, seed=0):
+    """
+    生成一个合成 GeoTIFF：平滑的地形状起伏 + 随机噪声，左上角一块区域为 nodata。
+    按行条带写入，内存占用与栅格尺寸无关。seed 不同的文件内容不同 (避免被去重)。
+    :return: path
+    """
+    profile = {
+        'driver': 'GTiff', 'width': width, 'height': height, 'count': bands, 'dtype': dtype,
+        'crs': crs, 'transform': synthetic_transform(crs, width, height),
+        'BIGTIFF': 'IF_SAFER',
+    }
+    if tiled:
+        profile.update({'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+    if nodata is not None:
+        profile['nodata'] = nodata
+    if compress:
+        profile['compress'] = compress
+
+    rng = np.random.default_rng(seed)
+    info = np.iinfo(dtype) if np.issubdtype(np.dtype(dtype), np.integer) else None
+    low, high = (info.min, info.max) if info else (0.0, 4000.0)
+    strip_rows = blocksize if tiled else 256
+    cols = np.arange(width, dtype=np.float64)
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row in range(0, height, strip_rows):
+            rows = min(strip_rows, height - row)
+            yy = np.arange(row, row + rows, dtype=np.float64)[:, None]
+            for band in range(1, bands + 1):
+                surface = (np.sin(cols / 97.0 + band) + np.cos(yy / 131.0 + seed)) * 0.25 + 0.5
+                surface += rng.normal(0.0, 0.02, size=(rows, width))
+                data = low + np.clip(surface, 0.0, 1.0) * (high - low)
+                if nodata is not None:
+                    # 左上角 1/8 区域为 nodata，检验统计和渲染的 nodata 处理
+                    data[:max(0, min(rows, height // 8 - row)), :width // 8] = nodata
+                dst.write(data.astype(dtype), band, window=Window(0, row, width, rows))
+        if overviews:
+            dst.build_overviews([2, 4, 8, 16], Resampling.average)
+    return path
+
+
+# --- 指标 ---
+def peak_rss_mb():
+    """本进程迄今的峰值常驻内存 (MB)。"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+def percentile(values, p):
+    """最近秩法百分位。"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(np.ceil(p / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(latencies, wall_seconds, nbytes=0):
+    return {
+        'count': len(latencies),
+        'wall_seconds': wall_seconds,
+        'throughput_per_s': len(latencies) / wall_seconds if wall_seconds > 0 else 0.0,
+        'mb_per_s': nbytes / (1024.0 * 1024.0) / wall_seconds if wall_seconds > 0 and nbytes else None,
+        'p50_ms': percentile(latencies, 50) * 1000.0,
+        'p99_ms': percentile(latencies, 99) * 1000.0,
+        'mean_ms': sum(latencies) * 1000.0 / len(latencies),
+    }
+
+class Timer:
+    """累计每次操作的耗时，以及整个场景的墙钟时间。"""
+
+    def __init__(self):
+        self.latencies = []
+        self.nbytes = 0
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def op(self, nbytes=0):
+        start = time.perf_counter()
+        yield
+        self.latencies.append(time.perf_counter() - start)
+        self.nbytes += nbytes
+
+    def summary(self):
+        return summarize(self.latencies, time.perf_counter() - self.started, self.nbytes)
+
+
+# --- 环境 ---
+def configure_environment(options):
+    """在导入 processing/app 之前设置环境变量 (这些模块在导入时读取配置)。"""
+    if options['s3'] == 'moto':
+        os.environ['S3_BUCKET_NAME'] = BENCH_BUCKET
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ[key] = 'bench'
+    os.environ['JOB_SPOOL_DIR'] = os.path.join(options['workdir'], 'spool')
+    os.environ['JOB_EMBEDDED_WORKERS'] = '0'  # 上传场景中由基准本身执行任务
+    os.environ['TILE_CACHE_DIR'] = os.path.join(options['workdir'], 'tile_cache')
+    os.environ['METRICS_JOB_LOG'] = os.path.join(options['workdir'], 'jobs.log')
+
+@contextmanager
+def s3_backend(options):
+    if options['s3'] != 'moto':
+        yield
+        return
+    try:
+        from moto import mock_aws
+    except ImportError:
+        try:
+            from moto import mock_s3 as mock_aws  # moto < 5
+        except ImportError:
+            raise SystemExit('需要安装 moto: pip install "moto[s3]"，或使用 --s3 env 连接真实的 S3')
+    import boto3
+    with mock_aws():
+        region = os.environ['AWS_DEFAULT_REGION']
+        extra = {} if region == 'us-east-1' else {'CreateBucketConfiguration': {'LocationConstraint': region}}
+        boto3.client('s3', region_name=region).create_bucket(Bucket=BENCH_BUCKET, **extra)
+        yield
+
+def ensure_bench_category():
+    from db import get_db_connection
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO categories (name, description) VALUES (%s, %s) "
+            "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id",
+            (BENCH_CATEGORY, '性能基准生成的临时数据')
+        )
+        category_id = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+        return category_id
+    finally:
+        conn.close()
+
+def cleanup_bench_rows(category_id):
+    from db import get_db_connection
+    from catalog_cache import bump_catalog_version, catalog_changed
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM datasets WHERE category_id = %s", (category_id,))
+        bump_catalog_version(cursor)
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    catalog_changed()
+
+
+# --- 场景 ---
+def bench_preview(files, options, category_id):
+    from processing import process_geotiff_and_upload
+    timer = Timer()
+    for path in files:
+        with timer.op(os.path.getsize(path)):
+            process_geotiff_and_upload(path)
+    return {'preview': timer.summary()}
+
+def bench_upload(files, options, category_id):
+    import jobs
+    from app import app
+    jobs.DEFAULT_UPLOAD_CATEGORY_ID = category_id
+    client = app.test_client()
+    request_timer, job_timer = Timer(), Timer()
+    for path in files:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f, request_timer.op(size):
+            response = client.post('/upload-geotiff', data={'file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+        if response.status_code != 202:
+            raise RuntimeError(f"上传失败: {response.status_code} {response.get_data(as_text=True)}")
+        job_id = response.get_json()['job_id']
+        with job_timer.op(size):
+            jobs.run_job(jobs.claim_next_job())
+        job = jobs.get_job(job_id)
+        if job['status'] != 'succeeded':
+            raise RuntimeError(f"上传任务失败: {job.get('error')}")
+    return {'upload_request': request_timer.summary(), 'upload_job': job_timer.summary()}
+
+def bench_ingest(files, options, category_id):
+    from processing import process_and_insert_geotiff, DatasetBatchWriter
+    run_prefix = f"bench/{uuid.uuid4().hex}"
+    timer = Timer()
+    with DatasetBatchWriter() as writer:
+        for i, path in enumerate(files):
+            with timer.op(os.path.getsize(path)):
+                process_and_insert_geotiff(path, f"{run_prefix}/{i}_{os.path.basename(path)}", category_id,
+                                           BENCH_SOURCE_TYPE, writer=writer)
+    # 墙钟时间包含最后一批的写入
+    return {'ingest': timer.summary()}
+
+def seed_listing_rows(category_id, rows):
+    """写入 rows 个随机分布的假数据集，模拟目录规模。"""
+    import psycopg2.extras
+    from db import get_db_connection
+    from catalog_cache import bump_catalog_version, catalog_changed
+    rng = np.random.default_rng(0)
+    values = []
+    for i in range(rows):
+        west, south = rng.uniform(-179, 178), rng.uniform(-89, 88)
+        east, north = west + 1, south + 1
+        wkt = f"POLYGON(({west} {south}, {east} {south}, {east} {north}, {west} {north}, {west} {south}))"
+        values.append((f"bench_{i}", 'https://example.invalid/preview.png', wkt,
+                       f"bench/listing/{uuid.uuid4().hex}", BENCH_SOURCE_TYPE, category_id))
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO datasets (name, image_url, geom, source_path, source_type, category_id) VALUES %s",
+            values, template="(%s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s)", page_size=1000
+        )
+        bump_catalog_version(cursor)
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    catalog_changed()
+
+def bench_listing(files, options, category_id):
+    from app import app
+    seed_listing_rows(category_id, options['listing_rows'])
+    client = app.test_client()
+    iterations = options['listing_iterations']
+    results = {}
+    cases = {
+        # 附加一个无关参数使每次请求的缓存键不同，从而测量数据库查询和序列化
+        'listing_cold': lambda i: f"/api/datasets?_bench={uuid.uuid4().hex}",
+        'listing_cached': lambda i: "/api/datasets",
+        'listing_bbox': lambda i: f"/api/datasets?bbox=0,0,20,20&_bench={uuid.uuid4().hex}",
+    }
+    for name, url in cases.items():
+        timer = Timer()
+        for i in range(iterations):
+            with timer.op():
+                response = client.get(url(i))
+            if response.status_code != 200:
+                raise RuntimeError(f"{name} 失败: {response.status_code}")
+        results[name] = timer.summary()
+    return results
+
+SCENARIOS = {
+    'preview': bench_preview,
+    'upload': bench_upload,
+    'ingest': bench_ingest,
+    'listing': bench_listing,
+}
+
+
+# --- 运行与记录 ---
+def run_scenario(name, files, options, result_queue):
+    """在子进程中运行一个场景，把 {子场景: 指标} 或错误信息放入 result_queue。"""
+    try:
+        configure_environment(options)
+        with s3_backend(options):
+            category_id = ensure_bench_category() if name in DB_SCENARIOS else None
+            baseline_rss = peak_rss_mb()
+            try:
+                results = SCENARIOS[name](files, options, category_id)
+            finally:
+                if category_id is not None:
+                    cleanup_bench_rows(category_id)
+        peak = peak_rss_mb()
+        for summary in results.values():
+            summary['peak_rss_mb'] = peak
+            summary['baseline_rss_mb'] = baseline_rss
+        result_queue.put({'results': results})
+    except BaseException as e:
+        result_queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def load_previous(output, scenario, params):
+    """返回 output 中同场景、同参数的最近一条结果。"""
+    previous = None
+    try:
+        with open(output, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('scenario') == scenario and params_key(record.get('params', {})) == params_key(params):
+                    previous = record
+    except OSError:
+        pass
+    return previous
+
+def format_delta(current, previous, key, lower_is_better=True):
+    if previous is None or previous.get(key) in (None, 0) or current.get(key) is None:
+        return ''
+    change = (current[key] - previous[key]) / previous[key] * 100.0
+    better = change < 0 if lower_is_better else change > 0
+    return f" ({change:+.1f}% {'✓' if better else '✗'})"
+
+def print_record(record, previous=None):
+    print(f"{record['scenario']:>15}: {record['count']} 次  "
+          f"{record['throughput_per_s']:.2f}/s{format_delta(record, previous, 'throughput_per_s', False)}  "
+          f"p50 {record['p50_ms']:.1f}ms{format_delta(record, previous, 'p50_ms')}  "
+          f"p99 {record['p99_ms']:.1f}ms{format_delta(record, previous, 'p99_ms')}  "
+          f"峰值 RSS {record['peak_rss_mb']:.0f}MB{format_delta(record, previous, 'peak_rss_mb')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoTIFF 处理与 API 的性能基准")
+    parser.add_argument('--scenarios', default=','.join(ALL_SCENARIOS),
+                        help=f"逗号分隔的场景: {', '.join(ALL_SCENARIOS)}")
+    parser.add_argument('--count', type=int, default=3, help="每个场景处理的文件数")
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--crs', default='EPSG:4326')
+    parser.add_argument('--bands', type=int, default=1)
+    parser.add_argument('--tiled', action='store_true', help="内部分块存储 (否则为条带)")
+    parser.add_argument('--blocksize', type=int, default=512)
+    parser.add_argument('--nodata', type=float, default=None)
+    parser.add_argument('--compress', default=None, help="例如 DEFLATE、LZW")
+    parser.add_argument('--overviews', action='store_true', help="生成内部金字塔")
+    parser.add_argument('--listing-rows', type=int, default=10000, help="listing 场景预先写入的数据集数量")
+    parser.add_argument('--listing-iterations', type=int, default=50)
+    parser.add_argument('--s3', choices=('moto', 'env'), default='moto',
+                        help="moto: 进程内模拟 S3；env: 使用环境变量配置的真实 S3")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="结果文件 (JSON Lines，追加写入)")
+    parser.add_argument('--compare', action='store_true', help="与同参数的上一次结果对比")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+
+    params = {
+        'count': args.count, 'width': args.width, 'height': args.height, 'dtype': args.dtype, 'crs': args.crs,
+        'bands': args.bands, 'tiled': args.tiled, 'blocksize': args.blocksize, 'nodata': args.nodata,
+        'compress': args.compress, 'overviews': args.overviews, 's3': args.s3,
+    }
+    run_id = uuid.uuid4().hex
+    mp_context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory(prefix='geotiff_bench_') as workdir:
+        print(f"--- 生成 {args.count} 个合成 GeoTIFF ({args.width}x{args.height} {args.dtype} {args.crs}) ---")
+        files = [
+            make_synthetic_geotiff(
+                os.path.join(workdir, f"synthetic_{i}.tif"), args.width, args.height, args.dtype, args.crs,
+                args.bands, args.tiled, args.blocksize, args.nodata, args.compress, args.overviews, seed=i
+            )
+            for i in range(args.count)
+        ]
+        options = {'s3': args.s3, 'workdir': workdir, 'listing_rows': args.listing_rows,
+                   'listing_iterations': args.listing_iterations}
+
+        for scenario in scenarios:
+            print(f"--- 场景: {scenario} ---")
+            # 每个场景使用新的子进程，峰值 RSS 只反映该场景
+            result_queue = mp_context.Queue()
+            process = mp_context.Process(target=run_scenario, args=(scenario, files, options, result_queue))
+            process.start()
+            outcome = result_queue.get()
+            process.join()
+            if 'error' in outcome:
+                print(f"❌ 场景 {scenario} 失败: {outcome['error']}")
+                continue
+
+            for name, summary in outcome['results'].items():
+                record = dict(summary, run_id=run_id, scenario=name, params=params, commit=git_commit(),
+                              host=socket.gethostname(), python=sys.version.split()[0], time=time.time())
+                previous = load_previous(args.output, name, params) if args.compare else None
+                print_record(record, previous)
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    print(f"--- 结果已追加到 {args.output} ---")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+/api/datasets 响应缓存。
+
+数据目录只会在入库 (insert_dataset_to_db / 上传) 时变化，因此用一个单行表
+catalog_version 记录目录版本：入库时在同一事务中把版本号加一，Web 进程最多每
+CATALOG_VERSION_TTL 秒读取一次版本号。版本不变时直接返回缓存的序列化结果，
+ETag 也由版本号派生，客户端携带 If-None-Match 即可得到 304。
+
+入库方在事务提交之后调用 catalog_changed()，本进程立即丢弃缓存的版本号。
+在提交之前丢弃会让同一进程中的并发请求重新读到旧版本，并在 TTL 内继续使用它。
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from db import get_db_connection
+
+# --- 配置 ---
+# 版本号在进程内的缓存时间 (秒)；其他进程入库后，最多经过这么久本进程就能看到新数据
+CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', 1.0))
+# 最多缓存的不同查询 (bbox/category/分页参数组合) 数量
+CATALOG_CACHE_ENTRIES = int(os.environ.get('CATALOG_CACHE_ENTRIES', 256))
+# 客户端可直接复用响应的秒数；默认 0，即每次都用 ETag 向服务端确认
+CATALOG_CACHE_MAX_AGE = int(os.environ.get('CATALOG_CACHE_MAX_AGE', 0))
+
+_lock = threading.Lock()
+# generation 在每次 catalog_changed() 时递增；读取版本号期间发生变化时不保存读到的 (可能已过期的) 值
+_state = {'version': None, 'checked_at': 0.0, 'generation': 0}
+_responses = OrderedDict()  # (version, query_key) -> body bytes
+
+
+def bump_catalog_version(cursor):
+    """
+    在入库事务中调用，使所有进程中缓存的目录响应失效。catalog_version 是单行热点，
+    行锁持有到事务提交，应作为提交前的最后一条语句，并且每个事务 (批次) 只调用一次。
+    提交后调用 catalog_changed()。
+    """
+    cursor.execute("UPDATE catalog_version SET version = version + 1 RETURNING version")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def catalog_changed():
+    """在 bump_catalog_version() 所在的事务提交之后调用：本进程立即重新读取版本号，无需等待 TTL。"""
+    with _lock:
+        _state['version'] = None
+        _state['generation'] += 1
+
+def get_catalog_version():
+    """返回当前目录版本号 (带 TTL 的进程内缓存)。"""
+    now = time.monotonic()
+    with _lock:
+        if _state['version'] is not None and now - _state['checked_at'] < CATALOG_VERSION_TTL:
+            return _state['version']
+        generation = _state['generation']
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM catalog_version")
+        row = cursor.fetchone()
+        cursor.close()
+    finally:
+        conn.close()
+
+    version = row[0] if row else 0
+    with _lock:
+        if _state['generation'] == generation:
+            _state['version'] = version
+            _state['checked_at'] = now
+    return version
+
+def make_query_key(args):
+    """把查询参数规范化为与参数顺序无关的键。"""
+    return '&'.join(f"{k}={v}" for k, v in sorted(args.items(multi=True)))
+
+def make_etag(version, query_key):
+    digest = hashlib.sha1(query_key.encode('utf-8')).hexdigest()[:12]
+    return f"catalog-{version}-{digest}"
+
+def cache_control_header():
+    return f"public, max-age={CATALOG_CACHE_MAX_AGE}, must-revalidate"
+
+def get_cached_response(version, query_key):
+    with _lock:
+        body = _responses.get((version, query_key))
+        if body is not None:
+            _responses.move_to_end((version, query_key))
+        return body
+
+def put_cached_response(version, query_key, body):
+    with _lock:
+        # 版本变化后旧版本的条目不会再被命中，直接清掉
+        for key in [k for k in _responses if k[0] != version]:
+            del _responses[key]
+        _responses[(version, query_key)] = body
+        while len(_responses) > CATALOG_CACHE_ENTRIES:
+            _responses.popitem(last=False)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+导入耗时预算检查：在全新的解释器中用 `python -X importtime` 导入 Web 应用和各入库脚本，
+统计导入耗时和导入的模块，超出预算或导入了不应导入的模块时以非零状态退出，可放在 CI 中运行。
+
+    python check_import_time.py                  # 检查全部模块
+    python check_import_time.py app ingest_local --repeat 5 --top 15
+
+每个模块重复导入 --repeat 次取最小值，以减少磁盘缓存等噪声。预算在不同机器上差别较大，
+可以用 IMPORT_BUDGET_SCALE 整体放宽 (例如较慢的 CI 机器上设为 2)。
+
+除耗时外还检查两条与机器快慢无关的约束，它们是防止启动变慢的主要手段:
+    - 入库脚本和处理模块不导入 Flask (不依赖 app.py)；
+    - 导入时不创建任何 boto3 客户端：S3 客户端由 clients.get_s3_client() 在首次使用时按进程创建。
+      (boto3 模块本身无法避免：rasterio.session 在导入 rasterio 时就会导入它。)
+
+rasterio、numpy 和 PIL 仍在模块顶层导入 (processing、raster_stats、render、tiles、s3_reader 等)，
+它们占了导入耗时的大部分，预算按此设定。Web worker 不再各自支付这部分开销，是因为
+gunicorn 的 preload_app 在 master 中导入一次后 fork 共享；入库脚本每次启动仍需导入它们。
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+# --- 配置 ---
+IMPORT_BUDGET_SCALE = float(os.environ.get('IMPORT_BUDGET_SCALE', 1.0))
+# 模块 -> 导入耗时预算 (毫秒)
+IMPORT_BUDGETS_MS = {
+    'app': 1200,
+    'processing': 900,
+    'ingest_local': 900,
+    'ingest_s3': 900,
+    'ingest_gdrive': 1500,
+    'jobs': 900,
+}
+# 模块 -> 导入时不应被导入的顶层包
+FORBIDDEN_IMPORTS = {
+    'processing': ('flask', 'flask_cors'),
+    'ingest_local': ('flask', 'flask_cors'),
+    'ingest_s3': ('flask', 'flask_cors'),
+    'ingest_gdrive': ('flask', 'flask_cors'),
+    'jobs': ('flask', 'flask_cors'),
+}
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# 导入目标模块后，输出导入过程中创建的 botocore 客户端数量
+IMPORT_SCRIPT = """
+import gc, sys
+import {module}
+client = sys.modules.get('botocore.client')
+print(sum(isinstance(o, client.BaseClient) for o in gc.get_objects()) if client else 0)
+"""
+
+
+def parse_importtime(stderr):
+    """
+    解析 -X importtime 的输出。
+    :return: [(模块名, 嵌套深度, 自身耗时 us, 累计耗时 us)]，按导入完成的顺序
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # 表头
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return entries
+
+def measure_import(module):
+    """
+    在新的解释器中导入 module。
+    :return: (导入耗时 ms, 导入的全部模块, 直接依赖 [(名称, ms)], 导入时创建的 boto3 客户端数量)
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT.format(module=module)],
+        cwd=BACKEND_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else '导入失败')
+    entries = parse_importtime(result.stderr)
+    # 目标模块的条目在其全部依赖之后输出；它之前、上一个顶层条目之后的深度 1 条目就是它的直接依赖
+    index = max(i for i, (name, depth, _, _) in enumerate(entries) if name == module and depth == 0)
+    start = max((i for i in range(index) if entries[i][1] == 0), default=-1) + 1
+    top = [(name, cumulative / 1000.0) for name, depth, _, cumulative in entries[start:index] if depth == 1]
+    return entries[index][3] / 1000.0, {name for name, _, _, _ in entries}, top, int(result.stdout.split()[-1])
+
+def check_module(module, repeat, top_n):
+    budget = IMPORT_BUDGETS_MS.get(module)
+    best = None
+    for _ in range(repeat):
+        measured = measure_import(module)
+        if best is None or measured[0] < best[0]:
+            best = measured
+    total_ms, imported, top, clients_created = best
+
+    problems = []
+    if budget is not None and total_ms > budget * IMPORT_BUDGET_SCALE:
+        problems.append(f"导入耗时 {total_ms:.0f} ms 超出预算 {budget * IMPORT_BUDGET_SCALE:.0f} ms")
+    packages = {name.split('.')[0] for name in imported}
+    for forbidden in FORBIDDEN_IMPORTS.get(module, ()):
+        if forbidden in packages:
+            problems.append(f"导入时不应导入 {forbidden}")
+    if clients_created:
+        problems.append(f"导入时创建了 {clients_created} 个 boto3 客户端 (应使用 clients.get_s3_client())")
+
+    status = '❌' if problems else '✅'
+    budget_text = f" / 预算 {budget * IMPORT_BUDGET_SCALE:.0f} ms" if budget is not None else ''
+    print(f"{status} {module}: {total_ms:.0f} ms{budget_text}")
+    for problem in problems:
+        print(f"     {problem}")
+    for name, ms in sorted(top, key=lambda item: -item[1])[:top_n]:
+        print(f"     {ms:8.1f} ms  {name}")
+    return not problems
+
+def main():
+    parser = argparse.ArgumentParser(description="检查 Web 应用和入库脚本的导入耗时预算")
+    parser.add_argument('modules', nargs='*', default=list(IMPORT_BUDGETS_MS), help="要检查的模块 (默认全部)")
+    parser.add_argument('--repeat', type=int, default=3, help="每个模块的导入次数，取最小值")
+    parser.add_argument('--top', type=int, default=8, help="列出耗时最多的直接依赖数量")
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        try:
+            ok = check_module(module, max(1, args.repeat), args.top)
+        except Exception as e:
+            print(f"❌ {module}: {e}")
+            ok = False
+        if not ok:
+            failed.append(module)
+
+    if failed:
+        print(f"\n{len(failed)} 个模块未通过导入耗时检查: {', '.join(failed)}")
+        sys.exit(1)
+    print("\n全部模块通过导入耗时检查")
+
+
+if __name__ == '__main__':
+    main()
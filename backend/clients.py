@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+按进程懒加载的外部服务客户端。
+
+导入 boto3 并创建客户端需要数百毫秒，而且客户端内部的 HTTP 连接池不能在 fork 之后
+跨进程共享。get_s3_client() 在首次调用时才导入 boto3 并创建客户端，之后在同一进程内
+复用 (boto3 客户端本身是线程安全的)；检测到 PID 变化时 (gunicorn preload_app 之后
+fork 出的 worker、multiprocessing fork 出的子进程) 重新创建，从不复用父进程的客户端。
+
+只需要导入模块而不访问 S3 的代码路径 (例如 ingest_local.py、只读接口) 因此不再为
+boto3 付出启动开销。
+"""
+import os
+import threading
+
+# --- 配置 ---
+AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_s3_client = None
+
+
+def reset_clients():
+    """
+    丢弃本进程已创建的客户端，下次使用时重新创建。fork 时其他线程可能正持有锁，因此锁也一并换新。
+    get_s3_client() 检测到 PID 变化时自动调用；gunicorn 的 post_fork 钩子也会显式调用。
+    """
+    global _lock, _pid, _s3_client
+    _lock = threading.Lock()
+    _pid = os.getpid()
+    _s3_client = None
+
+def get_s3_client():
+    """返回本进程的 S3 客户端，首次调用时创建。"""
+    global _s3_client
+    if _pid != os.getpid():
+        reset_clients()
+    client = _s3_client
+    if client is not None:
+        return client
+    with _lock:
+        if _s3_client is None:
+            import boto3
+            _s3_client = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
+        return _s3_client
+
+def preload_modules():
+    """
+    只导入客户端依赖的模块而不创建客户端。在 gunicorn master 中调用后，
+    各 worker 通过 fork 共享已导入的模块，首次创建客户端时不再需要导入 boto3。
+    """
+    import boto3  # noqa: F401
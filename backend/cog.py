@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+入库时的 Cloud-Optimized GeoTIFF (COG) 规范化：将条带存储、未压缩、无金字塔的
+GeoTIFF 重写为内部分块 + 压缩 + 完整金字塔的 COG，后续的预览、切片和采样
+只需读取少量数据块。
+
+转换使用 GDAL 的 COG 驱动，它按块流式地从源文件复制数据并逐级生成金字塔，
+内存占用由 GDAL_CACHEMAX 限制，而不是整个栅格的大小。
+"""
+import os
+import rasterio
+import rasterio.shutil
+from rasterio.env import GDALVersion
+
+from processing import S3_BUCKET_NAME
+from clients import get_s3_client
+from metrics import timed, add_bytes_written
+
+# --- 配置 ---
+# 设置 COG_NORMALIZE=1 以在入库时启用 COG 转换
+COG_NORMALIZE = os.environ.get('COG_NORMALIZE', '0') == '1'
+S3_COG_PREFIX = 'cogs/'
+S3_SOURCE_PREFIX = 'geotiffs/'
+COG_COMPRESS = os.environ.get('COG_COMPRESS', 'DEFLATE')
+COG_BLOCKSIZE = int(os.environ.get('COG_BLOCKSIZE', 512))
+# 转换过程中 GDAL 块缓存的上限 (MB)，决定了转换的峰值内存
+COG_CACHE_MB = int(os.environ.get('COG_CACHE_MB', 256))
+
+
+def is_cloud_optimized(path):
+    """粗略判断文件是否已满足 COG 要求：内部分块、已压缩，且大于一个块时带有金字塔。"""
+    with rasterio.open(path) as src:
+        if src.driver != 'GTiff' or not src.profile.get('tiled'):
+            return False
+        if src.compression is None:
+            return False
+        needs_overviews = max(src.width, src.height) > COG_BLOCKSIZE
+        return not needs_overviews or bool(src.overviews(1))
+
+def convert_to_cog(src_path, dst_path, compress=COG_COMPRESS, blocksize=COG_BLOCKSIZE):
+    """
+    将 src_path 流式转换为 COG 并写入 dst_path。
+    :return: dst_path
+    """
+    if GDALVersion.runtime() < GDALVersion(3, 1):
+        raise RuntimeError("COG 转换需要 GDAL 3.1 及以上版本 (COG 驱动)")
+
+    with rasterio.Env(GDAL_CACHEMAX=COG_CACHE_MB, GDAL_NUM_THREADS='ALL_CPUS'):
+        rasterio.shutil.copy(
+            src_path,
+            dst_path,
+            driver='COG',
+            COMPRESS=compress,
+            PREDICTOR='YES',
+            BLOCKSIZE=blocksize,
+            OVERVIEWS='IGNORE_EXISTING',
+            RESAMPLING='AVERAGE',
+            BIGTIFF='IF_SAFER',
+            NUM_THREADS='ALL_CPUS',
+        )
+    return dst_path
+
+def get_cog_key(source_key):
+    """
+    根据原始文件的 S3 键生成 COG 的键，保留完整的相对路径，不同来源不会互相覆盖:
+    geotiffs/dem/a.tif -> cogs/dem/a.tif，uploads/b/a.tif -> cogs/uploads/b/a.tif。
+    """
+    if source_key.startswith(S3_SOURCE_PREFIX):
+        relative = source_key[len(S3_SOURCE_PREFIX):]
+    else:
+        relative = source_key.lstrip('/')
+    return f"{S3_COG_PREFIX}{os.path.splitext(relative)[0]}.tif"
+
+def normalize_and_upload_cog(local_path, source_key):
+    """
+    入库流程中的可选 COG 阶段。source_key 是原始文件已存档的 S3 键；已经是 COG 的文件
+    不重写也不重复上传，直接以 source_key 作为 COG 的键。
+    :return: (本地 COG 路径, COG 的 S3 键)。调用方负责删除本地 COG 文件 (与 local_path 不同时)。
+    """
+    if is_cloud_optimized(local_path):
+        print(f"源文件已是 COG，直接使用: s3://{S3_BUCKET_NAME}/{source_key}")
+        return local_path, source_key
+
+    cog_path = f"{os.path.splitext(local_path)[0]}.cog.tif"
+    with timed('cog'):
+        convert_to_cog(local_path, cog_path)
+    print(f"已转换为 COG: {cog_path}")
+
+    cog_key = get_cog_key(source_key)
+    with timed('cog_upload'):
+        get_s3_client().upload_file(cog_path, S3_BUCKET_NAME, cog_key, ExtraArgs={'ContentType': 'image/tiff'})
+    add_bytes_written('s3_cog', os.path.getsize(cog_path))
+    print(f"COG 已上传至: s3://{S3_BUCKET_NAME}/{cog_key}")
+    return cog_path, cog_key
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Web 应用和入库脚本共用的 PostgreSQL 连接池。
+
+get_db_connection() 返回的连接在 close() 时归还到池中而不是真正断开，
+因此现有的 "conn = get_db_connection() ... conn.close()" 写法无需改动。
+连接池是线程安全的，并且能感知 fork：gunicorn 的 worker 进程不会复用
+父进程创建的连接，而是各自建立新的连接。
+"""
+import os
+import time
+import threading
+import psycopg2
+import psycopg2.extensions
+
+# --- 配置 ---
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+# 等待空闲连接的最长时间 (秒)，超时抛出 PoolTimeoutError
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# 空闲超过该时间 (秒) 的连接在借出前会先执行 SELECT 1 做健康检查
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', 30))
+
+
+def _connect():
+    """建立与 PostgreSQL 数据库的连接 (凭证来自环境变量)"""
+    return psycopg2.connect(
+        host=os.environ.get('DB_HOST'),
+        database=os.environ.get('DB_NAME'),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD')
+    )
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+class PoolTimeoutError(Exception):
+    """在 DB_POOL_TIMEOUT 内没有可用连接。"""
+
+
+class PooledConnection:
+    """psycopg2 连接的轻量代理，close() 会把连接归还到池中。"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise psycopg2.InterfaceError("连接已归还到连接池")
+        return getattr(conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.putconn(conn)
+
+    def discard(self):
+        """关闭底层连接后归还，连接池会丢弃它而不是再次借出 (出错后连接状态不确定时使用)。"""
+        if self._conn is not None:
+            _close_quietly(self._conn)
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    """带健康检查和等待统计的有界连接池。"""
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE, connect=_connect):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._connect = connect
+        self._reset()
+
+    def _reset(self):
+        """(重新) 初始化池状态。fork 之后在子进程中调用，丢弃从父进程继承的连接。"""
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, 最后归还时间)]
+        self._size = 0
+        self._stats = {
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def _check_fork(self):
+        # 不能关闭继承来的连接：psycopg2 的 close() 会通知服务端，从而断开父进程正在使用的同一个会话
+        if self._pid != os.getpid():
+            self._reset()
+
+    def getconn(self):
+        """借出一个连接，必要时等待其他线程归还。空闲连接的健康检查在锁外进行，不阻塞其他线程。"""
+        self._check_fork()
+        start = time.monotonic()
+        waited = False
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError(f"{self.timeout} 秒内没有可用的数据库连接 (上限 {self.maxconn})")
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                break  # 已占用一个名额，在下面新建连接
+
+            # 取出的连接仍计入 _size，检查期间其他线程不会超额新建
+            if self._is_healthy(conn, returned_at):
+                with self._cond:
+                    self._record_checkout(start, waited)
+                return conn
+            with self._cond:
+                self._discard(conn)
+                self._cond.notify()
+
+        # 在锁外建立新连接，避免阻塞其他线程
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['connections_created'] += 1
+            self._record_checkout(start, waited)
+        return conn
+
+    def putconn(self, conn):
+        """归还连接。未提交的事务会被回滚；已损坏的连接直接丢弃。"""
+        if self._pid != os.getpid():
+            return
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            if conn.closed or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def warm_up(self):
+        """预先建立 minconn 个连接。"""
+        conns = [self.getconn() for _ in range(max(0, self.minconn - len(self._idle)))]
+        for conn in conns:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            result = dict(self._stats)
+            result.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.maxconn,
+                'wait_time_avg': (self._stats['wait_time_total'] / self._stats['waits']
+                                  if self._stats['waits'] else 0.0),
+            })
+        return result
+
+    def _is_healthy(self, conn, returned_at):
+        """不持有 self._cond 调用：SELECT 1 需要一次网络往返，服务端失联时会一直等到超时。"""
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.healthcheck_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._stats['healthcheck_failures'] += 1
+            return False
+
+    # --- 内部实现 (调用方需持有 self._cond) ---
+    def _discard(self, conn):
+        self._size -= 1
+        self._stats['connections_discarded'] += 1
+        _close_quietly(conn)
+
+    def _record_checkout(self, start, waited):
+        self._stats['checkouts'] += 1
+        if waited:
+            elapsed = time.monotonic() - start
+            self._stats['waits'] += 1
+            self._stats['wait_time_total'] += elapsed
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], elapsed)
+
+
+# 进程内共享的连接池
+db_pool = ConnectionPool()
+
+def get_db_connection():
+    """从共享连接池借出一个连接；调用 close() 即归还。"""
+    return PooledConnection(db_pool, db_pool.getconn())
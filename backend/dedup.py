@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+按内容哈希 (SHA-256) 去重。
+
+同一个文件被反复上传，或者同一幅影像分别从 S3 和本地目录入库时，不再重复做
+S3 存档、渲染和入库:
+    - 上传：哈希在接收请求体时顺带计算 (HashingWriter)，命中时直接返回已有的数据集，
+      响应中 duplicate 为 true；
+    - 入库脚本：哈希在下载 (或与清单比对) 时计算，命中时复用已有数据集的预览图、范围、
+      统计和 COG，只为新的来源路径写入一行，不再重新渲染。
+
+哈希保存在 datasets.content_hash 中。上传的原始文件和预览图按内容寻址存放，
+相同内容只存一份:
+    geotiffs/sha256/<哈希前两位>/<哈希>.tif
+    previews/sha256/<哈希前两位>/<哈希>.<png|webp|jpg>
+"""
+import os
+import hashlib
+
+S3_CONTENT_PREFIX = 'geotiffs/sha256/'
+S3_PREVIEW_CONTENT_PREFIX = 'previews/sha256/'
+
+DATASET_FIELDS = ('id', 'name', 'image_url', 'geom_wkt', 'source_path', 'source_type', 'cog_path', 'stats')
+
+
+class HashingWriter:
+    """
+    包装一个可写的文件对象，在顺序写入的同时计算 SHA-256。
+    seekable() 返回 False，使 boto3 等下载器按顺序写入 (并发写入不同偏移会使哈希失效)；
+    写入完成后仍可 seek/read，name、close 等其他属性都转发给被包装的文件。
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._fileobj.write(data)
+
+    def seekable(self):
+        return False
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+def content_source_key(content_hash, filename):
+    """原始文件按内容寻址的 S3 键 (保留扩展名，供 GDAL 识别格式)。"""
+    extension = os.path.splitext(filename)[1].lower() or '.tif'
+    return f"{S3_CONTENT_PREFIX}{content_hash[:2]}/{content_hash}{extension}"
+
+def content_preview_key(content_hash, extension):
+    return f"{S3_PREVIEW_CONTENT_PREFIX}{content_hash[:2]}/{content_hash}.{extension}"
+
+def s3_object_exists(s3_client, bucket, key):
+    from botocore.exceptions import ClientError  # 调用方已创建客户端，此时 botocore 已导入
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def find_dataset_by_hash(conn, content_hash, exclude_source_path=None):
+    """
+    按内容哈希查找最早入库的数据集，返回 DATASET_FIELDS 组成的字典；没有时返回 None。
+    :param exclude_source_path: 忽略该来源路径自身的记录 (例如重新处理同一个文件时)。
+    """
+    if not content_hash:
+        return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            SELECT id, name, image_url, ST_AsText(geom), source_path, source_type, cog_path, stats
+            FROM datasets
+            WHERE content_hash = %s AND source_path IS DISTINCT FROM %s
+            ORDER BY id
+            LIMIT 1
+            """,
+            (content_hash, exclude_source_path)
+        )
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return dict(zip(DATASET_FIELDS, row)) if row else None
+
+def describe_duplicate(dataset):
+    """API 响应中描述去重命中的字段。"""
+    return {
+        'duplicate': True,
+        'dataset_id': dataset['id'],
+        'name': dataset['name'],
+        'image_url': dataset['image_url'],
+        'message': f"相同内容的文件已入库为数据集 '{dataset['name']}'，未重复处理。",
+    }
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+图像编码：预览图和瓦片直接编码到内存缓冲区，不再经过临时文件。
+
+支持的格式及可调参数 (均可通过环境变量配置):
+    png   PNG_COMPRESS_LEVEL (0-9，越高越小、越慢)
+    webp  WEBP_QUALITY (0-100)，WEBP_LOSSLESS=1 时无损；支持透明通道
+    jpeg  JPEG_QUALITY (0-100)；不支持透明通道，适合没有 nodata 的影像
+    auto  没有透明通道的 RGB 影像用 JPEG，其他用 PNG
+
+每种格式的编码次数、耗时和输出字节数都会累计，可通过 /api/encode/stats 查看
+(统计在每个进程内独立计算)。
+"""
+import io
+import os
+import time
+import threading
+
+from metrics import timed
+
+# --- 配置 ---
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 6))
+WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', 80))
+WEBP_LOSSLESS = os.environ.get('WEBP_LOSSLESS', '0') == '1'
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 85))
+# 预览图的输出格式
+PREVIEW_FORMAT = os.environ.get('PREVIEW_FORMAT', 'png').lower()
+
+IMAGE_FORMATS = {
+    # 格式名: (PIL 格式, Content-Type, 扩展名)
+    'png': ('PNG', 'image/png', 'png'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+}
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def resolve_format(img, fmt):
+    """把 'auto' 解析为具体格式；未知格式抛出 ValueError。"""
+    fmt = (fmt or 'png').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt == 'auto':
+        return 'jpeg' if img.mode == 'RGB' else 'png'
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"不支持的图像格式: {fmt}，可选: {', '.join(sorted(IMAGE_FORMATS))}, auto")
+    return fmt
+
+def _save_options(fmt):
+    if fmt == 'png':
+        return {'compress_level': PNG_COMPRESS_LEVEL}
+    if fmt == 'webp':
+        return {'quality': WEBP_QUALITY, 'lossless': WEBP_LOSSLESS, 'method': 4}
+    return {'quality': JPEG_QUALITY, 'optimize': False}
+
+def encode_image(img, fmt=PREVIEW_FORMAT):
+    """
+    把 PIL Image 编码到内存。
+    :return: (字节串, Content-Type, 扩展名)
+    """
+    fmt = resolve_format(img, fmt)
+    pil_format, content_type, extension = IMAGE_FORMATS[fmt]
+    if fmt == 'jpeg' and img.mode not in ('L', 'RGB'):
+        # JPEG 没有透明通道，nodata 区域显示为黑色
+        img = img.convert('L' if img.mode == 'LA' else 'RGB')
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    with timed('encode'):
+        img.save(buffer, format=pil_format, **_save_options(fmt))
+    data = buffer.getvalue()
+    record_encode(fmt, time.perf_counter() - start, len(data), img.width * img.height)
+    return data, content_type, extension
+
+def record_encode(fmt, seconds, size, pixels):
+    with _stats_lock:
+        entry = _stats.setdefault(fmt, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'pixels': 0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['bytes'] += size
+        entry['pixels'] += pixels
+
+def encode_stats():
+    """按格式返回编码次数、平均耗时 (毫秒)、平均大小和每像素字节数。"""
+    with _stats_lock:
+        snapshot = {fmt: dict(entry) for fmt, entry in _stats.items()}
+    for entry in snapshot.values():
+        count = entry['count']
+        entry['avg_ms'] = entry['seconds'] * 1000.0 / count if count else 0.0
+        entry['avg_bytes'] = entry['bytes'] / count if count else 0.0
+        entry['bytes_per_pixel'] = entry['bytes'] / entry['pixels'] if entry['pixels'] else 0.0
+    return snapshot
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+数据集范围的矢量瓦片 (Mapbox Vector Tile)，由 PostGIS 的 ST_AsMVT 直接生成。
+
+全球视图下前端不再一次性下载全部数据集的 bbox JSON，而是按瓦片加载范围:
+    - z <= FOOTPRINT_CLUSTER_MAX_ZOOM：把数据集中心点按网格 (每个瓦片
+      FOOTPRINT_CLUSTER_GRID x FOOTPRINT_CLUSTER_GRID 个单元) 聚合，每个单元输出一个点，
+      属性为 count (数据集数量) 和 category (单元中最常见的分类)；
+    - 更高的级别：输出每个数据集的范围多边形，属性为 id、name 和 category。
+
+中心点保存在 datasets.centroid_3857 生成列上并建有 GiST 索引 (见 init_dtable.py)，
+聚合只扫描落在瓦片内的数据集，成本与目录总量无关。
+
+Web Mercator 只定义在纬度 ±85.0511° 之内，全球或极地数据集的范围在转换到 EPSG:3857 之前
+先裁剪到该范围 (中心点生成列同样基于裁剪后的范围)，否则会得到无穷大坐标或使整个瓦片请求失败。
+"""
+import os
+
+from db import get_db_connection
+
+# --- 配置 ---
+# 该级别及以下输出聚合点，以上输出范围多边形
+FOOTPRINT_CLUSTER_MAX_ZOOM = int(os.environ.get('FOOTPRINT_CLUSTER_MAX_ZOOM', 6))
+# 聚合时每个瓦片每边的网格单元数
+FOOTPRINT_CLUSTER_GRID = int(os.environ.get('FOOTPRINT_CLUSTER_GRID', 32))
+# 单个瓦片最多输出的范围多边形数量
+FOOTPRINT_MAX_FEATURES = int(os.environ.get('FOOTPRINT_MAX_FEATURES', 20000))
+FOOTPRINT_LAYER = 'footprints'
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+# Web Mercator 投影的周长 (米)，用于计算聚合网格的单元大小
+WEB_MERCATOR_EXTENT = 2 * 20037508.342789244
+# Web Mercator 的有效纬度范围；范围多边形在投影前裁剪到这个经纬度矩形内
+WEB_MERCATOR_MAX_LAT = 85.0511287798
+MERCATOR_CLIP_BOX = f"ST_MakeEnvelope(-180, -{WEB_MERCATOR_MAX_LAT}, 180, {WEB_MERCATOR_MAX_LAT}, 4326)::box2d"
+
+CLUSTER_SQL = f"""
+    WITH bounds AS (SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+    cells AS (
+        -- 按网格单元分组 (吸附到单元中心)，输出点取单元内各中心点的平均位置
+        SELECT ST_Centroid(ST_Collect(d.centroid_3857)) AS cell,
+               count(*) AS count,
+               mode() WITHIN GROUP (ORDER BY c.name) AS category
+        FROM datasets d
+        JOIN categories c ON d.category_id = c.id, bounds
+        WHERE d.centroid_3857 && bounds.geom
+        GROUP BY ST_SnapToGrid(d.centroid_3857, %(origin)s, %(origin)s, %(cell)s, %(cell)s)
+    ),
+    mvtgeom AS (
+        SELECT ST_AsMVTGeom(cells.cell, bounds.geom, {MVT_EXTENT}, 0, true) AS geom, cells.count, cells.category
+        FROM cells, bounds
+    )
+    SELECT ST_AsMVT(mvtgeom.*, '{FOOTPRINT_LAYER}', {MVT_EXTENT}, 'geom') FROM mvtgeom
+"""
+
+FOOTPRINT_SQL = f"""
+    WITH bounds AS (SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+    mvtgeom AS (
+        SELECT ST_AsMVTGeom(ST_Transform(ST_ClipByBox2D(d.geom, {MERCATOR_CLIP_BOX}), 3857), bounds.geom,
+                            {MVT_EXTENT}, {MVT_BUFFER}, true) AS geom,
+               d.id, d.name, c.name AS category
+        FROM datasets d
+        JOIN categories c ON d.category_id = c.id, bounds
+        WHERE ST_Intersects(d.geom, ST_Transform(bounds.geom, 4326))
+        ORDER BY d.id
+        LIMIT %(limit)s
+    )
+    SELECT ST_AsMVT(mvtgeom.*, '{FOOTPRINT_LAYER}', {MVT_EXTENT}, 'geom') FROM mvtgeom
+"""
+
+
+def cluster_cell_size(z, grid=FOOTPRINT_CLUSTER_GRID):
+    """
+    z 级聚合网格的单元边长 (米)。单元边长整除瓦片边长，且 ST_SnapToGrid 以 cluster_grid_origin()
+    为原点把中心点吸附到单元中心 (而不是单元角点)，因此每个单元都完整地落在一个瓦片内。
+    """
+    return WEB_MERCATOR_EXTENT / (2 ** z) / grid
+
+def cluster_grid_origin(cell):
+    """聚合网格的吸附原点：左下角第一个单元的中心。"""
+    return -WEB_MERCATOR_EXTENT / 2 + cell / 2
+
+def get_footprint_tile(z, x, y):
+    """生成 z/x/y 瓦片的 MVT 字节串；瓦片内没有数据集时返回空字节串。"""
+    if z <= FOOTPRINT_CLUSTER_MAX_ZOOM:
+        cell = cluster_cell_size(z)
+        sql, params = CLUSTER_SQL, {'z': z, 'x': x, 'y': y, 'cell': cell, 'origin': cluster_grid_origin(cell)}
+    else:
+        sql, params = FOOTPRINT_SQL, {'z': z, 'x': x, 'y': y, 'limit': FOOTPRINT_MAX_FEATURES}
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        cursor.close()
+    finally:
+        conn.close()
+    return bytes(row[0]) if row and row[0] is not None else b''
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+本地目录监控，供 ingest_local.py 的 --watch 模式使用。
+
+Linux 上通过 ctypes 直接调用 inotify，新文件在写入完成后几秒内即可被发现，无需遍历整个目录；
+其他平台、或 inotify 不可用 (例如 watch 数量达到 fs.inotify.max_user_watches 上限) 时
+退回到按 WATCH_POLL_INTERVAL 定期比较 (大小, mtime) 的轮询方式。
+
+两种 watcher 都提供同样的接口:
+    watcher.poll(timeout) -> 发生变化的 .tif/.tiff 文件路径集合
+    watcher.close()
+
+拷贝中的文件会先后触发多次事件，StableFileTracker 负责去抖：
+文件的大小和 mtime 在 WATCH_STABLE_SECONDS 内保持不变后才交给调用方处理。
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# --- 配置 ---
+# 文件大小和 mtime 保持不变多久 (秒) 才认为写入完成
+WATCH_STABLE_SECONDS = float(os.environ.get('WATCH_STABLE_SECONDS', 2.0))
+# 轮询模式下两次扫描的间隔 (秒)
+WATCH_POLL_INTERVAL = float(os.environ.get('WATCH_POLL_INTERVAL', 10.0))
+
+GEOTIFF_EXTENSIONS = ('.tif', '.tiff')
+
+# inotify 常量 (见 <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def is_geotiff(path):
+    return path.lower().endswith(GEOTIFF_EXTENSIONS)
+
+def walk_geotiffs(folder):
+    """遍历目录，产出其中所有 .tif/.tiff 文件的路径。"""
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if is_geotiff(filename):
+                yield os.path.join(root, filename)
+
+
+class InotifyWatcher:
+    """基于 inotify 的递归目录监控。新建的子目录会自动加入监控。"""
+
+    def __init__(self, folder):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify 仅在 Linux 上可用")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 失败: {os.strerror(err)}")
+        self._folder = folder
+        self._dirs = {}  # wd -> 目录路径
+        try:
+            self._add_tree(folder)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"无法监控目录 {path}: {os.strerror(err)}")
+        self._dirs[wd] = path
+
+    def _add_tree(self, folder):
+        for root, _, _ in os.walk(folder):
+            self._add_watch(root)
+
+    def poll(self, timeout):
+        """等待最多 timeout 秒，返回期间发生变化的 GeoTIFF 路径集合。"""
+        changed = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._parse_events(data, changed)
+        return changed
+
+    def _parse_events(self, data, changed):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，可能丢失了事件：整体重新扫描一次，由清单过滤掉未变化的文件
+                print("警告: inotify 事件队列溢出，重新扫描整个目录。")
+                changed.update(walk_geotiffs(self._folder))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新目录：加入监控，并补上加入监控之前已经写入的文件
+                    try:
+                        self._add_tree(path)
+                    except OSError as e:
+                        print(f"警告: {e}")
+                    changed.update(walk_geotiffs(path))
+            elif is_geotiff(name):
+                changed.add(path)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """inotify 不可用时的退回方案：每隔 interval 秒遍历目录，比较文件的 (大小, mtime)。"""
+
+    def __init__(self, folder, interval=WATCH_POLL_INTERVAL):
+        self._folder = folder
+        self._interval = interval
+        self._snapshot = self._scan()
+        self._last_scan = time.monotonic()
+
+    def _scan(self):
+        snapshot = {}
+        for path in walk_geotiffs(self._folder):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        remaining = self._interval - (time.monotonic() - self._last_scan)
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            if remaining > timeout:
+                return set()
+        snapshot = self._scan()
+        self._last_scan = time.monotonic()
+        changed = {path for path, sig in snapshot.items() if self._snapshot.get(path) != sig}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(folder, use_polling=False):
+    """优先使用 inotify，失败时退回到轮询。"""
+    if not use_polling:
+        try:
+            watcher = InotifyWatcher(folder)
+            print(f"使用 inotify 监控目录: {folder}")
+            return watcher
+        except OSError as e:
+            print(f"inotify 不可用 ({e})，改为每 {WATCH_POLL_INTERVAL:g} 秒轮询一次。")
+    return PollingWatcher(folder)
+
+
+class StableFileTracker:
+    """
+    去抖：记录发生变化的文件，只有当文件的大小和 mtime 连续 stable_seconds 秒不变时
+    才由 pop_stable() 返回，避免处理仍在拷贝中的文件。
+    """
+
+    def __init__(self, stable_seconds=WATCH_STABLE_SECONDS):
+        self.stable_seconds = stable_seconds
+        self._pending = {}  # path -> ((size, mtime_ns), 最后一次变化的时间)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def touch(self, path):
+        self._pending[path] = (None, time.monotonic())
+
+    def pop_stable(self):
+        """返回已稳定的 [(path, os.stat_result)]，并从待定列表中移除；已被删除的文件直接丢弃。"""
+        now = time.monotonic()
+        ready = []
+        for path, (last_sig, changed_at) in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if sig != last_sig:
+                self._pending[path] = (sig, now)
+            elif now - changed_at >= self.stable_seconds:
+                del self._pending[path]
+                ready.append((path, st))
+        return ready
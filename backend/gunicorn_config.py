@@ -1,2 +1,33 @@
-bind = "0.0.0.0:10000"  # Render 会自动替换这个端口
-workers = 3
\ No newline at end of file
+bind = "0.0.0.0:10000"  # Render 会自动替换这个端口
+workers = 3
+
+# 在 master 中导入一次应用 (Flask、rasterio/GDAL、numpy、PIL 等)，worker 通过 fork 共享已导入的模块，
+# 不再各自重复导入。这些栅格库仍在模块顶层导入，preload 是 Web worker 启动变快的主要原因；
+# 导入应用时不会建立数据库连接或创建 S3 客户端，这些都在 worker 中按需创建。
+preload_app = True
+
+
+def when_ready(server):
+    # 在 fork worker 之前预先导入 boto3 (只导入模块，不创建客户端)
+    import clients
+    clients.preload_modules()
+
+def post_fork(server, worker):
+    # 数据库连接池和栅格句柄缓存会按 PID 自动重建；这里显式丢弃可能从 master 继承的客户端
+    import clients
+    clients.reset_clients()
+
+def post_worker_init(worker):
+    # 在处理第一个请求之前创建本 worker 的 S3 客户端和最少数量的数据库连接；
+    # 配置了 JOB_EMBEDDED_WORKERS 时同时启动内嵌的任务 worker 线程。
+    # 默认不内嵌：部署时必须在同一台机器上另外运行 python jobs.py --workers N (共享 JOB_SPOOL_DIR)，
+    # 否则上传接口返回 202 后任务会一直停留在 queued 状态 (见 README)
+    import clients
+    import jobs
+    from db import db_pool
+    clients.get_s3_client()
+    jobs.ensure_embedded_workers()
+    try:
+        db_pool.warm_up()
+    except Exception as e:
+        worker.log.warning("预先建立数据库连接失败 (将在首次请求时重试): %s", e)
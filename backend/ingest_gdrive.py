@@ -1,11 +1,18 @@
 import os
 import io
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
-from processing import process_and_insert_geotiff
-from app import get_db_connection
+from processing import process_and_insert_geotiff, DatasetBatchWriter
+from dedup import HashingWriter
+from db import get_db_connection
 from ingest_local import get_categories, assign_category_by_filepath # 复用本地脚本的函数
+import manifest
+import metrics
 
 # --- 配置 (保持不变) ---
 SERVICE_ACCOUNT_FILE = 'gdrive-credentials.json'
@@ -14,118 +21,283 @@ SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 DOWNLOAD_DIR = 'temp_downloads'
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-# vvv --- 这里是新增的部分 --- vvv
+# --- 并发与分页参数 ---
+# 并发下载/处理的线程数
+GDRIVE_DOWNLOAD_WORKERS = int(os.environ.get('GDRIVE_DOWNLOAD_WORKERS', 4))
+# MediaIoBaseDownload 每次请求的字节数
+GDRIVE_DOWNLOAD_CHUNK_SIZE = int(os.environ.get('GDRIVE_DOWNLOAD_CHUNK_SIZE', 32 * 1024 * 1024))
+GDRIVE_DOWNLOAD_RETRIES = int(os.environ.get('GDRIVE_DOWNLOAD_RETRIES', 3))
+# 文件夹 ID -> 完整路径 的缓存文件，在多次运行之间复用
+GDRIVE_PATH_CACHE_FILE = os.environ.get('GDRIVE_PATH_CACHE_FILE', 'gdrive_path_cache.json')
+GDRIVE_PAGE_SIZE = 1000
+# 遍历时每次 files().list 查询合并的父文件夹数量 (受查询字符串长度限制)
+GDRIVE_PARENTS_PER_QUERY = 20
+# 单个 HTTP 批量请求中的最大请求数 (Drive API 上限为 100)
+GDRIVE_BATCH_SIZE = 100
 
-def get_gdrive_path(service, file_id, path_cache):
-    """
-    递归获取 Google Drive 中文件或文件夹的完整路径字符串。
-    使用一个缓存来提高性能，避免重复查询。
-    """
-    # 如果路径已在缓存中，直接返回
-    if file_id in path_cache:
-        return path_cache[file_id]
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LIST_FIELDS = "nextPageToken, files(id, name, mimeType, parents, size, modifiedTime, md5Checksum)"
+
+
+def get_gdrive_service():
+    """使用服务账号凭证创建 Drive v3 客户端。客户端不是线程安全的，每个线程需要各自创建。"""
+    credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return build('drive', 'v3', credentials=credentials, cache_discovery=False)
 
+def list_all_pages(service, **params):
+    """按 nextPageToken 逐页列举，产出所有文件，不会在第一页后截断。"""
+    page_token = None
+    while True:
+        response = service.files().list(pageToken=page_token, **params).execute()
+        yield from response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+# --- 路径解析与缓存 ---
+def load_path_cache(path=GDRIVE_PATH_CACHE_FILE):
     try:
-        # 获取当前文件/文件夹的名称及其父文件夹的ID
-        file_metadata = service.files().get(fileId=file_id, fields='name, parents').execute()
-        parents = file_metadata.get('parents')
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-        # 如果有父文件夹，则递归调用以获取父路径
-        if parents:
+def save_path_cache(path_cache, path=GDRIVE_PATH_CACHE_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(path_cache, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _batch_get_metadata(service, file_ids):
+    """通过 HTTP 批量请求获取一组文件/文件夹的名称和父级，每批最多 GDRIVE_BATCH_SIZE 个。"""
+    results = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"警告：无法获取 ID '{request_id}' 的元数据. 错误: {exception}")
+        else:
+            results[request_id] = response
+
+    file_ids = list(file_ids)
+    for i in range(0, len(file_ids), GDRIVE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for file_id in file_ids[i:i + GDRIVE_BATCH_SIZE]:
+            batch.add(service.files().get(fileId=file_id, fields='id, name, parents', supportsAllDrives=True),
+                      request_id=file_id)
+        batch.execute()
+    return results
+
+def resolve_folder_paths(service, folder_ids, path_cache):
+    """
+    解析一组文件夹在 Google Drive 中的完整路径。
+    缓存中没有的文件夹按层级批量查询：每一轮用一个批量请求获取当前所有未知 ID 的元数据，
+    再对它们未知的父级进行下一轮，请求数与目录深度成正比，而不是与祖先数量成正比。
+    """
+    metadata = {}
+    pending = {fid for fid in folder_ids if fid not in path_cache}
+    while pending:
+        fetched = _batch_get_metadata(service, pending)
+        metadata.update(fetched)
+        pending = set()
+        for item in fetched.values():
+            parents = item.get('parents')
             # Google Drive 文件可以有多个父级，我们只取第一个
-            parent_path = get_gdrive_path(service, parents[0], path_cache)
-            # 拼接路径
-            full_path = os.path.join(parent_path, file_metadata['name'])
+            if parents and parents[0] not in path_cache and parents[0] not in metadata:
+                pending.add(parents[0])
+
+    def path_of(folder_id):
+        if folder_id in path_cache:
+            return path_cache[folder_id]
+        item = metadata.get(folder_id)
+        if item is None:
+            # 元数据获取失败，返回一个特殊值表示路径未知 (不写入缓存，下次重试)
+            return f"UnknownPath/{folder_id}"
+        parents = item.get('parents')
+        if parents:
+            full_path = os.path.join(path_of(parents[0]), item['name'])
         else:
             # 如果没有父文件夹，说明它在“我的云端硬盘”的根目录
-            full_path = file_metadata['name']
-
-        # 将结果存入缓存
-        path_cache[file_id] = full_path
+            full_path = item['name']
+        path_cache[folder_id] = full_path
         return full_path
 
-    except Exception as e:
-        print(f"警告：无法解析 ID '{file_id}' 的路径. 错误: {e}")
-        # 返回一个特殊值表示路径未知
-        return f"UnknownPath/{file_id}"
+    return {fid: path_of(fid) for fid in folder_ids}
+
+def get_gdrive_path(service, file_id, path_cache):
+    """获取 Google Drive 中单个文件夹的完整路径字符串 (见 resolve_folder_paths)。"""
+    return resolve_folder_paths(service, [file_id], path_cache)[file_id]
+
+
+# --- 遍历 ---
+def is_geotiff_item(item):
+    return item.get('mimeType') == 'image/tiff' or item['name'].lower().endswith(('.tif', '.tiff'))
+
+def walk_drive_folder(service, root_id, path_cache):
+    """
+    按层级递归遍历文件夹，产出 (完整路径, 文件元数据)。
+    同一层的多个文件夹合并在一次 files().list 查询中，每个查询都完整分页；
+    子文件夹的路径由父路径直接拼接，并写入 path_cache。
+    """
+    folders = {root_id: get_gdrive_path(service, root_id, path_cache)}
+    level = [root_id]
+    while level:
+        next_level = []
+        for i in range(0, len(level), GDRIVE_PARENTS_PER_QUERY):
+            group = level[i:i + GDRIVE_PARENTS_PER_QUERY]
+            parents_query = ' or '.join(f"'{folder_id}' in parents" for folder_id in group)
+            query = (f"({parents_query}) and trashed = false and "
+                     f"(mimeType = '{FOLDER_MIME_TYPE}' or mimeType = 'image/tiff' or name contains '.tif')")
+            for item in list_all_pages(service, q=query, fields=LIST_FIELDS, pageSize=GDRIVE_PAGE_SIZE,
+                                       supportsAllDrives=True, includeItemsFromAllDrives=True):
+                parent_id = next((p for p in item.get('parents', []) if p in group), None)
+                if parent_id is None:
+                    continue
+                path = os.path.join(folders[parent_id], item['name'])
+                if item.get('mimeType') == FOLDER_MIME_TYPE:
+                    if item['id'] not in folders:  # 同一文件夹可能通过多个父级出现
+                        folders[item['id']] = path
+                        path_cache[item['id']] = path
+                        next_level.append(item['id'])
+                elif is_geotiff_item(item):
+                    yield path, item
+        level = next_level
+
+def scan_changed_files(conn, service, root_id, path_cache, stats):
+    """遍历文件夹并按批与入库清单对比，产出新增或内容变化的 (完整路径, 文件元数据, 清单记录)。"""
+    def diff(batch):
+        known = manifest.lookup(conn, 'GOOGLE_DRIVE', batch.keys())
+        adopted = []
+        for full_gdrive_path, (item, entry) in batch.items():
+            state = manifest.classify(entry, known.get(full_gdrive_path))
+            if state == 'unchanged':
+                stats['skipped'] += 1
+                if not known[full_gdrive_path]['in_manifest']:
+                    adopted.append(entry)  # 旧版本入库的数据，补录到清单中
+                continue
+            yield full_gdrive_path, item, entry
+        manifest.record(conn, adopted)
+
+    batch = {}
+    for full_gdrive_path, item in walk_drive_folder(service, root_id, path_cache):
+        stats['listed'] += 1
+        # Drive 提供的 md5Checksum 可直接作为 ETag 对比；content_hash (SHA-256) 在下载时计算
+        batch[full_gdrive_path] = (item, manifest.make_entry(
+            'GOOGLE_DRIVE', full_gdrive_path,
+            size=int(item['size']) if item.get('size') else None,
+            etag=item.get('md5Checksum'),
+        ))
+        if len(batch) >= manifest.MANIFEST_LOOKUP_BATCH:
+            yield from diff(batch)
+            batch = {}
+    if batch:
+        yield from diff(batch)
+
+
+# --- 下载 ---
+def download_file(service, file_id, local_path, chunk_size=GDRIVE_DOWNLOAD_CHUNK_SIZE):
+    """用 MediaIoBaseDownload 分块下载文件，每块失败时自动重试。返回边下载边计算的 SHA-256。"""
+    request = service.files().get_media(fileId=file_id, supportsAllDrives=True)
+    with metrics.timed('download'), io.FileIO(local_path, 'wb') as fh:
+        writer = HashingWriter(fh)
+        downloader = MediaIoBaseDownload(writer, request, chunksize=chunk_size)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=GDRIVE_DOWNLOAD_RETRIES)
+    metrics.add_bytes_read('gdrive_download', os.path.getsize(local_path))
+    return writer.hexdigest()
+
 
+def run_gdrive_ingest(service_factory, conn, writer, categories, root_id, path_cache,
+                      download_workers=GDRIVE_DOWNLOAD_WORKERS, chunk_size=GDRIVE_DOWNLOAD_CHUNK_SIZE):
+    """
+    遍历 root_id 下的所有文件夹，并发下载并入库新增或变化的 GeoTIFF。
+    :param service_factory: 无参函数，返回一个 Drive 客户端；每个线程调用一次 (便于测试时替换为桩对象)。
+    :return: 统计字典 {'listed', 'skipped', 'succeeded', 'failed'}
+    """
+    stats = {'listed': 0, 'skipped': 0, 'succeeded': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    local = threading.local()
+    slots = threading.BoundedSemaphore(download_workers * 2)
+
+    def thread_service():
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        return local.service
 
-def get_processed_gdrive_source_paths(conn):
-    """从数据库获取所有已处理的 Google Drive 文件来源路径"""
-    cursor = conn.cursor()
-    cursor.execute("SELECT source_path FROM datasets WHERE source_path IS NOT NULL")
-    processed_paths = {item[0] for item in cursor.fetchall()}
-    cursor.close()
-    return processed_paths
+    def ingest_one(full_gdrive_path, item, entry, category_id):
+        # 以文件 ID 作前缀，避免不同文件夹中的同名文件相互覆盖
+        local_filepath = os.path.join(DOWNLOAD_DIR, f"{item['id']}_{item['name']}")
+        try:
+            with metrics.job_timer('gdrive_ingest', full_gdrive_path):
+                entry['content_hash'] = download_file(thread_service(), item['id'], local_filepath, chunk_size)
+                print(f"已下载: {full_gdrive_path}")
+                # 调用处理函数，传入要记录的完整 GDrive 路径
+                process_and_insert_geotiff(local_filepath, full_gdrive_path, category_id, 'GOOGLE_DRIVE',
+                                           writer=writer, manifest_entry=entry)
+            with stats_lock:
+                stats['succeeded'] += 1
+        except Exception as e:
+            print(f"❌ 处理 {full_gdrive_path} 失败: {e}")
+            with stats_lock:
+                stats['failed'] += 1
+        finally:
+            if os.path.exists(local_filepath):
+                os.remove(local_filepath)
+            slots.release()
 
-# ^^^ --- 新增部分结束 --- ^^^
+    with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='gdrive') as pool:
+        for full_gdrive_path, item, entry in scan_changed_files(conn, thread_service(), root_id, path_cache, stats):
+            print(f"发现新文件: {full_gdrive_path}")
+            # 根据拼接出的完整路径分配分类
+            category_id = assign_category_by_filepath(full_gdrive_path, categories)
+            if category_id is None:
+                print(f"警告: 未能为文件 {item['name']} 找到匹配的分类，已跳过。")
+                continue
+            slots.acquire()  # 排队的文件过多时阻塞遍历，形成背压
+            pool.submit(ingest_one, full_gdrive_path, item, entry, category_id)
+    return stats
 
 
 def main():
+    parser = argparse.ArgumentParser(description="递归扫描 Google Drive 文件夹并并发入库新的 GeoTIFF 文件")
+    parser.add_argument('--download-workers', type=int, default=GDRIVE_DOWNLOAD_WORKERS,
+                        help="并发下载/入库的线程数")
+    parser.add_argument('--chunk-size', type=int, default=GDRIVE_DOWNLOAD_CHUNK_SIZE,
+                        help="每次下载请求的字节数")
+    parser.add_argument('--refresh-paths', action='store_true',
+                        help="忽略已保存的路径缓存 (文件夹被重命名或移动后使用)")
+    args = parser.parse_args()
+
     print("--- 开始扫描 Google Drive 文件夹 ---")
-    service = get_gdrive_service()
+    path_cache = {} if args.refresh_paths else load_path_cache()
 
     db_conn = get_db_connection()
-    # 修改：现在我们检查完整的来源路径，而不仅仅是ID
-    processed_paths = get_processed_gdrive_source_paths(db_conn)
     categories = get_categories(db_conn)
-    db_conn.close()
-
-    print(f"数据库中已有 {len(processed_paths)} 个已处理文件。")
 
-    # 创建一个在本次运行中持续有效的路径缓存
-    path_cache = {}
-
-    query = f"'{GDRIVE_FOLDER_ID}' in parents and (mimeType='image/tiff' or name contains '.tif')"
-    results = service.files().list(q=query, fields="nextPageToken, files(id, name, parents)").execute()
-    items = results.get('files', [])
-
-    if not items:
-        print("在 Google Drive 文件夹中未找到任何 .tif/.tiff 文件。")
-        return
-
-    new_files_count = 0
-    for item in items:
-        file_id, file_name = item['id'], item['name']
-
-        # --- 核心逻辑修改 ---
-        # 1. 获取文件的完整 GDrive 路径
-        # 我们获取的是父文件夹的路径，然后手动拼接上文件名，这样更准确
-        parent_id = item.get('parents')[0] if item.get('parents') else None
-        folder_path = get_gdrive_path(service, parent_id, path_cache) if parent_id else "/"
-        full_gdrive_path = os.path.join(folder_path, file_name)
-
-        # 2. 检查这个完整路径是否已经被处理过
-        if full_gdrive_path in processed_paths:
-            continue
-
-        print(f"发现新文件: {full_gdrive_path}")
-        new_files_count += 1
-
-        # 3. 根据拼接出的完整路径分配分类
-        category_id = assign_category_by_filepath(full_gdrive_path, categories)
-        if category_id is None:
-            print(f"警告: 未能为文件 {file_name} 找到匹配的分类，已跳过。")
-            continue
-
-        # 4. 下载文件
-        request = service.files().get_media(fileId=file_id)
-        local_filepath = os.path.join(DOWNLOAD_DIR, file_name)
-        with io.FileIO(local_filepath, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-                print(f"下载 {file_name}: {int(status.progress() * 100)}%")
-
-        # 5. 调用处理函数，传入要记录的完整 GDrive 路径
-        process_and_insert_geotiff(local_filepath, full_gdrive_path, category_id, 'GOOGLE_DRIVE')
-
-        os.remove(local_filepath)
+    try:
+        # 新文件的元数据按批次写入数据库，而不是每个文件提交一次
+        with DatasetBatchWriter() as writer:
+            stats = run_gdrive_ingest(
+                get_gdrive_service, db_conn, writer, categories, GDRIVE_FOLDER_ID, path_cache,
+                download_workers=args.download_workers,
+                chunk_size=args.chunk_size
+            )
+    finally:
+        db_conn.close()
+        save_path_cache(path_cache)
 
+    write_stats = writer.stats()
     print("--- Google Drive 扫描完成 ---")
-    print(f"本次共处理了 {new_files_count} 个新文件。")
+    if stats['listed'] == 0:
+        print("在 Google Drive 文件夹中未找到任何 .tif/.tiff 文件。")
+    print(f"共发现 {stats['listed']} 个文件，跳过 {stats['skipped']} 个未变化的文件；"
+          f"成功处理 {stats['succeeded']} 个，失败 {stats['failed']} 个。")
+    print(f"入库 {write_stats['rows_written']} 行，{write_stats['rows_per_sec']:.1f} 行/秒")
+    print("各阶段耗时:")
+    metrics.print_stage_summary()
+    metrics.write_textfile()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
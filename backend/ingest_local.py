@@ -1,19 +1,26 @@
 import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from processing import process_and_insert_geotiff # 导入我们的核心处理函数
-from app import get_db_connection # 复用连接函数
+from processing import process_and_insert_geotiff, DatasetBatchWriter # 导入我们的核心处理函数
+from db import get_db_connection # 共享连接池 (不导入 app，避免加载 Flask 和全部接口模块)
+from fs_watch import create_watcher, StableFileTracker
+import manifest
+import metrics
 
 # --- 配置 ---
 # 将此路径修改为你要监控的本地文件夹
 GEO_DATA_FOLDER = r"E:\Diffusion+Landslide\GVLM-CD\Slope\tiff"
-
-def get_processed_files(conn):
-    """从数据库获取所有已处理文件的源路径列表"""
-    cursor = conn.cursor()
-    cursor.execute("SELECT source_path FROM datasets WHERE source_path IS NOT NULL")
-    processed_files = {item[0] for item in cursor.fetchall()}
-    cursor.close()
-    return processed_files
+# --watch 模式下并行处理文件的线程数；排队等待的文件最多为其两倍，超出时暂停接收新文件
+WATCH_WORKERS = int(os.environ.get('WATCH_WORKERS', 2))
+# --watch 模式下缓冲的入库行最多等待多久 (秒) 写入数据库
+WATCH_FLUSH_SECONDS = float(os.environ.get('WATCH_FLUSH_SECONDS', 1.0))
+# 事件循环的最长等待时间 (秒)
+WATCH_TICK_SECONDS = 0.5
+# --watch 模式下数据库出错后，等待多久 (秒) 重新连接并重试
+WATCH_RETRY_SECONDS = float(os.environ.get('WATCH_RETRY_SECONDS', 5.0))
 
 def get_categories(conn):
     """从数据库获取所有分类，并返回一个 name->id 的字典"""
@@ -53,44 +60,217 @@ def assign_category_by_filepath(filepath, categories):
 
 # ^^^ --- 修改结束 --- ^^^
 
+def _diff_against_manifest(conn, batch, stats):
+    """将一批本地文件与清单对比，产出需要 (重新) 处理的 (文件路径, 清单记录)。"""
+    known = manifest.lookup(conn, 'LOCAL', batch.keys())
+    touched = []
+    for file_path, entry in batch.items():
+        state = manifest.classify(entry, known.get(file_path))
+        if state == 'unchanged':
+            stats['skipped'] += 1
+            # 旧版本入库的数据没有清单记录，补录后下次即可按大小/mtime 判断
+            if not known[file_path]['in_manifest']:
+                touched.append(entry)
+            continue
+
+        # 只有新文件或元数据变化的文件才计算内容哈希
+        entry['content_hash'] = manifest.hash_file(file_path)
+        if state == 'verify' and manifest.is_same_content(entry['content_hash'], known[file_path]):
+            stats['skipped'] += 1
+            touched.append(entry)  # 仅 mtime 变化 (例如 touch)，内容未变
+            continue
+        yield file_path, entry
+    manifest.record(conn, touched)
+
+def scan_changed_files(conn, folder, stats):
+    """
+    遍历目录中的 .tif/.tiff 文件，按批与入库清单对比，产出新增或内容变化的 (文件路径, 清单记录)。
+    数据库查询量与本次遍历到的文件数成正比，不再读取整个目录表。
+    """
+    batch = {}
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if not filename.lower().endswith(('.tif', '.tiff')):
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            batch[file_path] = manifest.make_entry('LOCAL', file_path, size=st.st_size, mtime=st.st_mtime)
+            if len(batch) >= manifest.MANIFEST_LOOKUP_BATCH:
+                yield from _diff_against_manifest(conn, batch, stats)
+                batch = {}
+    if batch:
+        yield from _diff_against_manifest(conn, batch, stats)
+
+def ingest_file(file_path, category_id, writer, entry):
+    """处理并入库单个本地文件 (处理路径和记录路径是同一个)，各阶段耗时记入一条任务日志。"""
+    with metrics.job_timer('local_ingest', file_path):
+        process_and_insert_geotiff(file_path, file_path, category_id, 'LOCAL',
+                                   writer=writer, manifest_entry=entry)
+
+def _reconnect(conn):
+    """丢弃出错的连接 (不归还到连接池中复用)，重新借出一个；数据库仍不可用时抛出异常。"""
+    if conn is not None:
+        conn.discard()
+    return get_db_connection()
+
+def watch(folder, workers=WATCH_WORKERS, use_polling=False):
+    """
+    常驻监控模式：先做一次增量扫描追上离线期间的变化，之后只处理 inotify (或轮询) 报告的文件。
+    文件写入稳定后经清单比对，交给有界线程池处理；Ctrl+C 退出前会等待已提交的文件处理完毕。
+    数据库暂时不可用时不会退出：本轮的错误被记录下来，等待 WATCH_RETRY_SECONDS 后重新连接，
+    未写入的批次留在 writer 中、未比对的文件重新排队，在下一轮重试。
+    """
+    db_conn = get_db_connection()
+    categories = get_categories(db_conn)
+    print(f"已加载分类: {list(categories.keys())}")
+
+    stats = {'skipped': 0, 'succeeded': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    in_flight = set()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    # 先开始监控再做追赶扫描，扫描期间新写入的文件也不会漏掉
+    watcher = create_watcher(folder, use_polling=use_polling)
+    tracker = StableFileTracker()
+
+    with DatasetBatchWriter(max_seconds=WATCH_FLUSH_SECONDS) as writer, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as pool:
+
+        def on_done(future, file_path):
+            error = future.exception()
+            with stats_lock:
+                in_flight.discard(file_path)
+                stats['failed' if error else 'succeeded'] += 1
+            slots.release()
+            if error:
+                print(f"❌ 处理 {file_path} 失败: {error}")
+
+        def submit(file_path, entry):
+            category_id = assign_category_by_filepath(file_path, categories)
+            if category_id is None:
+                print(f"警告: 未能为文件 {os.path.basename(file_path)} 找到匹配的分类，已跳过。")
+                return
+            with stats_lock:
+                if file_path in in_flight:
+                    return  # 重试追赶扫描时，上一轮已提交的文件仍在处理中
+            slots.acquire()  # 排队的文件过多时阻塞，形成背压
+            with stats_lock:
+                in_flight.add(file_path)
+            future = pool.submit(ingest_file, file_path, category_id, writer, entry)
+            future.add_done_callback(lambda f: on_done(f, file_path))
+
+        def on_error(stage, error):
+            nonlocal db_conn
+            print(f"❌ {stage}时出错，{WATCH_RETRY_SECONDS:.0f} 秒后重试: {error}")
+            time.sleep(WATCH_RETRY_SECONDS)
+            try:
+                db_conn = _reconnect(db_conn)
+            except Exception as e:
+                db_conn = None
+                print(f"❌ 重新连接数据库失败: {e}")
+
+        try:
+            print("--- 追赶扫描 ---")
+            while True:
+                try:
+                    db_conn = db_conn or get_db_connection()
+                    for file_path, entry in scan_changed_files(db_conn, folder, stats):
+                        submit(file_path, entry)
+                    break
+                except Exception as e:
+                    on_error("追赶扫描", e)
+
+            print(f"--- 开始监控 {folder} (Ctrl+C 退出) ---")
+            while True:
+                for file_path in watcher.poll(WATCH_TICK_SECONDS):
+                    tracker.touch(file_path)
+
+                ready = tracker.pop_stable()
+                try:
+                    db_conn = db_conn or get_db_connection()
+                    if ready:
+                        # 先写入已处理完的行，保证清单比对看到的是最新状态
+                        writer.flush()
+                        batch = {}
+                        for file_path, st in ready:
+                            with stats_lock:
+                                busy = file_path in in_flight
+                            if busy:
+                                tracker.touch(file_path)  # 同一文件仍在处理中，稍后再比对
+                                continue
+                            batch[file_path] = manifest.make_entry('LOCAL', file_path, size=st.st_size, mtime=st.st_mtime)
+                        for file_path, entry in _diff_against_manifest(db_conn, batch, stats):
+                            print(f"发现新增或变化的文件: {file_path}")
+                            submit(file_path, entry)
+
+                    writer.flush_if_due()
+                except Exception as e:
+                    # 本轮稳定的文件重新排队，下一轮重新比对 (已提交处理的文件比对时会被跳过)
+                    for file_path, _ in ready:
+                        tracker.touch(file_path)
+                    on_error("写入或比对清单", e)
+        except KeyboardInterrupt:
+            print("收到中断信号，等待处理中的文件完成...")
+        finally:
+            watcher.close()
+
+    if db_conn is not None:
+        db_conn.close()
+    print(f"--- 监控结束：成功 {stats['succeeded']} 个，失败 {stats['failed']} 个，跳过 {stats['skipped']} 个 ---")
+    metrics.print_stage_summary()
+    metrics.write_textfile()
+
 def main():
-    print("--- 开始扫描本地文件夹 ---")
+    parser = argparse.ArgumentParser(description="扫描本地文件夹并入库新的 GeoTIFF 文件")
+    parser.add_argument('--watch', action='store_true',
+                        help="常驻运行，监控文件夹并在文件写入完成后自动入库")
+    parser.add_argument('--workers', type=int, default=WATCH_WORKERS,
+                        help="--watch 模式下并行处理文件的线程数")
+    parser.add_argument('--polling', action='store_true',
+                        help="--watch 模式下强制使用轮询而不是 inotify")
+    args = parser.parse_args()
+
     if not os.path.isdir(GEO_DATA_FOLDER):
         print(f"错误: 文件夹不存在 -> {GEO_DATA_FOLDER}")
         return
 
+    if args.watch:
+        watch(GEO_DATA_FOLDER, workers=args.workers, use_polling=args.polling)
+        return
+
+    print("--- 开始扫描本地文件夹 ---")
     db_conn = get_db_connection()
-    processed_files = get_processed_files(db_conn)
     categories = get_categories(db_conn)
-    db_conn.close()
 
-    print(f"数据库中已有 {len(processed_files)} 个已处理文件。")
     print(f"已加载分类: {list(categories.keys())}")
 
     new_files_count = 0
-    for root, _, files in os.walk(GEO_DATA_FOLDER):
-        for filename in files:
-            if filename.lower().endswith(('.tif', '.tiff')):
-                file_path = os.path.join(root, filename)
-
-                if file_path in processed_files:
-                    continue
+    scan_stats = {'skipped': 0}
+    # 新文件的元数据按批次写入数据库，而不是每个文件提交一次
+    with DatasetBatchWriter() as writer:
+        for file_path, entry in scan_changed_files(db_conn, GEO_DATA_FOLDER, scan_stats):
+            new_files_count += 1
 
-                new_files_count += 1
+            # --- 修改这里的函数调用 ---
+            category_id = assign_category_by_filepath(file_path, categories) # 使用新的函数名和参数
 
-                # --- 修改这里的函数调用 ---
-                category_id = assign_category_by_filepath(file_path, categories) # 使用新的函数名和参数
+            if category_id is None:
+                print(f"警告: 未能为文件 {os.path.basename(file_path)} 找到匹配的分类，已跳过。")
+                continue
 
-                if category_id is None:
-                    print(f"警告: 未能为文件 {filename} 找到匹配的分类，已跳过。")
-                    continue
-
-                # --- 修改这里的函数调用 ---
-                # 对于本地文件，处理路径和记录路径是同一个
-                process_and_insert_geotiff(file_path, file_path, category_id, 'LOCAL')
+            ingest_file(file_path, category_id, writer, entry)
+    db_conn.close()
 
+    write_stats = writer.stats()
     print("--- 扫描完成 ---")
-    print(f"本次共处理了 {new_files_count} 个新文件。")
+    print(f"本次共处理了 {new_files_count} 个新增或变化的文件，跳过 {scan_stats['skipped']} 个未变化的文件。")
+    print(f"入库 {write_stats['rows_written']} 行，{write_stats['rows_per_sec']:.1f} 行/秒")
+    print("各阶段耗时:")
+    metrics.print_stage_summary()
+    metrics.write_textfile()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,34 +1,39 @@
 # -*- coding: utf-8 -*-
 import os
+import queue
+import argparse
 import tempfile
-import boto3
-from collections import defaultdict
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # --- 导入我们重构后的核心处理模块 ---
 from processing import (
     get_db_connection, 
     process_geotiff_and_upload, 
-    insert_dataset_to_db
+    find_duplicate_dataset,
+    DatasetBatchWriter
 )
+from dedup import HashingWriter
+from cog import COG_NORMALIZE, normalize_and_upload_cog
+from s3_reader import S3RangeContainer, S3_RANGE_GDAL_OPTIONS
+from clients import get_s3_client
+import manifest
+import metrics
+import rasterio
 
 # --- 配置 ---
 # 从环境变量获取配置
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
-AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
 S3_SOURCE_PREFIX = 'geotiffs/'  # 存放原始 GeoTIFF 的“文件夹”
-
-# 初始化 boto3 客户端
-s3_client = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
+# 并发入库参数：下载线程数、渲染进程数，以及列举与处理之间的有界队列长度
+INGEST_DOWNLOAD_WORKERS = int(os.environ.get('INGEST_DOWNLOAD_WORKERS', 4))
+INGEST_PROCESS_WORKERS = int(os.environ.get('INGEST_PROCESS_WORKERS', multiprocessing.cpu_count()))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 16))
+# 设置 INGEST_IN_PLACE=1 时通过 Range 请求原地读取 S3 对象，不再整文件下载
+INGEST_IN_PLACE = os.environ.get('INGEST_IN_PLACE', '0') == '1'
 
 # --- 数据库交互函数 ---
-def get_processed_files(conn):
-    """从数据库获取所有已处理文件的源路径(S3 Key)列表"""
-    cursor = conn.cursor()
-    cursor.execute("SELECT source_path FROM datasets WHERE source_path IS NOT NULL")
-    processed_files = {item[0] for item in cursor.fetchall()}
-    cursor.close()
-    return processed_files
-
 def get_categories(conn):
     """从数据库获取所有分类，并返回一个 name->id 的字典"""
     cursor = conn.cursor()
@@ -51,61 +56,249 @@ def assign_category_by_s3_key(s3_key, categories):
     else:
         return categories.get('其他')
 
-def main():
-    print("--- 开始扫描 S3 存储桶 ---")
-    db_conn = None
-    try:
-        db_conn = get_db_connection()
-        processed_files = get_processed_files(db_conn)
-        categories = get_categories(db_conn)
+def list_changed_objects(conn, listing=None):
+    """
+    逐页列举 S3 中新增或内容变化 (ETag 不同) 的 GeoTIFF 对象，产出 (S3 键, 清单记录)。
+    每页只按键批量查询一次清单，与目录总量无关，因此每次都列举整个前缀：S3 按字典序返回键，
+    按键断点续列会漏掉排在断点之前的新对象 (例如新的 dem/ 文件或以 UUID 命名的上传)。
+    :param listing: 可选的字典，用于回传 'complete' 和 'skipped'。
+    """
+    listing = listing if listing is not None else {}
+    listing.update({'complete': False, 'skipped': 0})
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=S3_SOURCE_PREFIX):
+        entries = {}
+        for obj in page.get('Contents', []):
+            s3_key = obj['Key']
+            if s3_key.endswith('/') or not s3_key.lower().endswith(('.tif', '.tiff')):
+                continue
+            # content_hash (SHA-256) 在下载时计算
+            entries[s3_key] = manifest.make_entry(
+                'S3', s3_key,
+                size=obj['Size'],
+                mtime=obj['LastModified'].timestamp(),
+                etag=obj['ETag'].strip('"')
+            )
 
-        print(f"数据库中已有 {len(processed_files)} 个已处理文件。")
-        print(f"已加载分类: {list(categories.keys())}")
+        known = manifest.lookup(conn, 'S3', entries.keys())
+        adopted = []
+        for s3_key, entry in entries.items():
+            state = manifest.classify(entry, known.get(s3_key))
+            if state == 'unchanged':
+                listing['skipped'] += 1
+                # 旧版本入库的数据没有清单记录，补录后下次即可按 ETag 判断
+                if not known[s3_key]['in_manifest']:
+                    adopted.append(entry)
+                continue
+            yield s3_key, entry
+        manifest.record(conn, adopted)
+    listing['complete'] = True
 
-        new_files_count = 0
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=S3_SOURCE_PREFIX)
+def render_s3_object(local_geotiff_path, s3_key, content_hash=None):
+    """
+    在渲染进程池中执行的 CPU 密集部分：(可选) COG 转换、预览图生成与上传。
+    必须是模块级函数，才能被 ProcessPoolExecutor 序列化。
+    子进程中的阶段耗时放在返回值的 'timings' 中，由调用方通过 metrics.merge_job 并入主进程的指标。
+    """
+    cog_key = None
+    # 在 COG 转换之前取大小：转换后 local_geotiff_path 指向本地生成的 COG，而不是下载的对象
+    downloaded_bytes = os.path.getsize(local_geotiff_path)
+    with metrics.job_timer('render', s3_key, log=False) as timer:
+        if COG_NORMALIZE:
+            local_geotiff_path, cog_key = normalize_and_upload_cog(local_geotiff_path, s3_key)
+        processed_data = process_geotiff_and_upload(local_geotiff_path, content_hash=content_hash)
+    processed_data['timings'] = timer.to_dict()
+    processed_data['cog_key'] = cog_key
+    processed_data['bytes_transferred'] = downloaded_bytes
+    processed_data['source_bytes'] = processed_data['bytes_transferred']
+    return processed_data
 
-        for page in pages:
-            if 'Contents' not in page:
-                continue
-            for obj in page['Contents']:
-                s3_key = obj['Key']
-                
-                if s3_key.endswith('/') or not s3_key.lower().endswith(('.tif', '.tiff')):
-                    continue
-                
-                if s3_key in processed_files:
-                    continue
+def render_s3_object_in_place(s3_key):
+    """
+    原地读取版本：通过 Range 请求只拉取文件头和预览所需的 (金字塔) 数据块。
+    返回的 bytes_transferred 是实际传输的字节数，可与 source_bytes 对比节省量。
+    """
+    container = S3RangeContainer(get_s3_client(), S3_BUCKET_NAME)
+    with metrics.job_timer('render', s3_key, log=False) as timer, rasterio.Env(**S3_RANGE_GDAL_OPTIONS):
+        processed_data = process_geotiff_and_upload(s3_key, opener=container)
+    processed_data['timings'] = timer.to_dict()
+    processed_data['cog_key'] = None
+    processed_data['bytes_transferred'] = container.bytes_transferred
+    processed_data['source_bytes'] = container.size(s3_key)
+    return processed_data
+
+def download_and_hash(s3_key, local_path):
+    """下载对象到本地，同时计算 SHA-256 (分段并发下载，按顺序写入)。返回十六进制哈希。"""
+    with metrics.timed('download'), open(local_path, 'wb') as f:
+        writer = HashingWriter(f)
+        get_s3_client().download_fileobj(S3_BUCKET_NAME, s3_key, writer)
+    metrics.add_bytes_read('s3_download', os.path.getsize(local_path))
+    return writer.hexdigest()
+
+def ingest_one(s3_key, category_id, process_pool, writer, in_place=False, manifest_entry=None):
+    """
+    下载 (或原地读取)、渲染并入库单个对象。异常由调用方按文件隔离处理。返回渲染结果。
+    下载的对象与其他来源中已入库的文件内容相同时，复用已有的预览图和元数据，不再渲染。
+    原地读取模式不读取整个文件，因此不做去重。
+    """
+    with metrics.job_timer('s3_ingest', s3_key, in_place=bool(in_place and not COG_NORMALIZE)):
+        return _ingest_one(s3_key, category_id, process_pool, writer, in_place, manifest_entry)
 
-                new_files_count += 1
+def _ingest_one(s3_key, category_id, process_pool, writer, in_place, manifest_entry):
+    content_hash = None
+    # COG 转换需要读取整个文件，因此启用 COG_NORMALIZE 时仍然下载到本地
+    if in_place and not COG_NORMALIZE:
+        print(f"正在原地处理: {s3_key}")
+        processed_data = process_pool.submit(render_s3_object_in_place, s3_key).result()
+        metrics.add_bytes_read('s3_range', processed_data['bytes_transferred'])
+    else:
+        # 使用临时目录安全地处理下载的文件
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_geotiff_path = os.path.join(temp_dir, os.path.basename(s3_key))
+            print(f"正在下载并处理: {s3_key}")
+            content_hash = download_and_hash(s3_key, local_geotiff_path)
+            if manifest_entry is not None:
+                manifest_entry['content_hash'] = content_hash
+
+            duplicate = find_duplicate_dataset(content_hash, s3_key)
+            if duplicate is not None:
+                print(f"♻️ {s3_key} 与数据集 #{duplicate['id']} ({duplicate['source_path']}) 内容相同，复用其预览图和元数据")
+                processed_data = {
+                    'preview_url': duplicate['image_url'],
+                    'wkt_polygon': duplicate['geom_wkt'],
+                    'stats': duplicate['stats'],
+                    'cog_key': duplicate['cog_path'],
+                    'bytes_transferred': os.path.getsize(local_geotiff_path),
+                }
+                processed_data['source_bytes'] = processed_data['bytes_transferred']
+            else:
+                # 渲染交给进程池，下载线程在此等待，从而把网络 I/O 与 CPU 计算重叠起来
+                processed_data = process_pool.submit(render_s3_object, local_geotiff_path, s3_key,
+                                                     content_hash).result()
+    metrics.merge_job(processed_data.pop('timings', None))
+
+    dataset_name = os.path.splitext(os.path.basename(s3_key))[0]
+    # 交给批量写入器，按批次在单个事务中 upsert
+    writer.add(
+        name=dataset_name,
+        image_url=processed_data['preview_url'],
+        geom_wkt=processed_data['wkt_polygon'],
+        source_path=s3_key,
+        source_type='S3',
+        category_id=category_id,
+        cog_path=processed_data['cog_key'],
+        manifest_entry=manifest_entry,
+        stats=processed_data.get('stats'),
+        content_hash=content_hash
+    )
+    return processed_data
+
+def run_concurrent_ingest(writer, categories,
+                          download_workers=INGEST_DOWNLOAD_WORKERS,
+                          process_workers=INGEST_PROCESS_WORKERS,
+                          queue_size=INGEST_QUEUE_SIZE,
+                          in_place=INGEST_IN_PLACE):
+    """
+    并发入库：一个列举线程把新增或变化的对象放入有界队列，download_workers 个线程负责下载和入库，
+    渲染在 process_workers 个进程中执行，结果交给 writer (DatasetBatchWriter) 批量入库。
+    单个文件失败只会记录下来，不会中断整个运行。
+    :return: (成功数量, 失败列表 [(s3_key, 错误信息)], 传输统计 {'bytes_transferred', 'source_bytes'},
+              列举状态 {'complete', 'skipped'})
+    """
+    work_queue = queue.Queue(maxsize=queue_size)
+    stats_lock = threading.Lock()
+    succeeded = []
+    failed = []
+    transfer = {'bytes_transferred': 0, 'source_bytes': 0}
+    listing = {}
+    stop = object()
+
+    def producer():
+        conn = get_db_connection()
+        try:
+            for s3_key, entry in list_changed_objects(conn, listing):
                 category_id = assign_category_by_s3_key(s3_key, categories)
-                
                 if category_id is None:
                     print(f"警告: 未能为文件 {s3_key} 找到匹配的分类，已跳过。")
                     continue
-                
-                # 使用临时目录安全地处理下载的文件
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    local_geotiff_path = os.path.join(temp_dir, os.path.basename(s3_key))
-                    print(f"正在下载并处理: {s3_key}")
-                    s3_client.download_file(S3_BUCKET_NAME, s3_key, local_geotiff_path)
-                    
-                    # 调用 processing 模块的核心函数
-                    processed_data = process_geotiff_and_upload(local_geotiff_path)
-                    
-                    dataset_name = os.path.splitext(os.path.basename(s3_key))[0]
-                    
-                    # 调用 processing 模块的数据库插入函数
-                    insert_dataset_to_db(
-                        db_conn,
-                        name=dataset_name,
-                        image_url=processed_data['preview_url'],
-                        geom_wkt=processed_data['wkt_polygon'],
-                        source_path=s3_key,
-                        source_type='S3',
-                        category_id=category_id
-                    )
+                work_queue.put((s3_key, category_id, entry))
+        except Exception as e:
+            print(f"列举 S3 对象时出错: {e}")
+        finally:
+            conn.close()
+            for _ in range(download_workers):
+                work_queue.put(stop)
+
+    def consumer(process_pool):
+        while True:
+            item = work_queue.get()
+            if item is stop:
+                return
+            s3_key, category_id, entry = item
+            try:
+                processed_data = ingest_one(s3_key, category_id, process_pool, writer, in_place, entry)
+                with stats_lock:
+                    succeeded.append(s3_key)
+                    transfer['bytes_transferred'] += processed_data['bytes_transferred']
+                    transfer['source_bytes'] += processed_data['source_bytes']
+            except Exception as e:
+                print(f"❌ 处理 {s3_key} 失败，已跳过: {e}")
+                with stats_lock:
+                    failed.append((s3_key, str(e)))
+
+    # 使用 spawn 启动渲染进程，避免 fork 继承下载线程的锁和数据库连接
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=process_workers, mp_context=mp_context) as process_pool:
+        threads = [threading.Thread(target=producer, name='s3-lister')]
+        threads += [threading.Thread(target=consumer, args=(process_pool,), name=f"s3-ingest-{i}")
+                    for i in range(download_workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    return len(succeeded), failed, transfer, listing
+
+def main():
+    parser = argparse.ArgumentParser(description="扫描 S3 存储桶并并发入库新的 GeoTIFF 文件")
+    parser.add_argument('--download-workers', type=int, default=INGEST_DOWNLOAD_WORKERS,
+                        help="并发下载/入库的线程数")
+    parser.add_argument('--process-workers', type=int, default=INGEST_PROCESS_WORKERS,
+                        help="渲染预览图的进程数")
+    parser.add_argument('--queue-size', type=int, default=INGEST_QUEUE_SIZE,
+                        help="列举与处理之间的队列长度上限")
+    parser.add_argument('--in-place', action='store_true', default=INGEST_IN_PLACE,
+                        help="通过 Range 请求原地读取 S3 对象，不下载整个文件 (启用 COG_NORMALIZE 时无效)")
+    args = parser.parse_args()
+
+    print("--- 开始扫描 S3 存储桶 ---")
+    db_conn = None
+    try:
+        db_conn = get_db_connection()
+        categories = get_categories(db_conn)
+        print(f"已加载分类: {list(categories.keys())}")
+
+        with DatasetBatchWriter() as writer:
+            succeeded, failed, transfer, listing = run_concurrent_ingest(
+                writer, categories,
+                download_workers=args.download_workers,
+                process_workers=args.process_workers,
+                queue_size=args.queue_size,
+                in_place=args.in_place
+            )
+        write_stats = writer.stats()
+        print(f"本次成功处理 {succeeded} 个新文件，失败 {len(failed)} 个。")
+        print(f"入库 {write_stats['rows_written']} 行，{write_stats['flushes']} 个批次，"
+              f"{write_stats['rows_per_sec']:.1f} 行/秒")
+        print(f"传输字节数: {transfer['bytes_transferred']} / 源文件总字节数: {transfer['source_bytes']}")
+        print(f"跳过未变化的文件 {listing.get('skipped', 0)} 个。")
+        for s3_key, error in failed:
+            print(f"  失败: {s3_key} -> {error}")
+        print("各阶段耗时:")
+        metrics.print_stage_summary()
+        metrics.write_textfile()
+        if not listing.get('complete'):
+            print("警告: S3 列举未完成，未列举到的对象将在下次运行时处理。")
 
     except Exception as e:
         print(f"处理过程中发生严重错误: {e}")
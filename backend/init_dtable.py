@@ -13,6 +13,39 @@ def get_db_connection():
     conn = psycopg2.connect(**DB_CONFIG)
     return conn
 
+def create_source_path_index(conn):
+    """
+    创建入库脚本 upsert 所需的 source_path 唯一索引 (独立事务)。
+    旧库中存在重复的 source_path 时不创建索引，而是列出重复的行，由人工清理后重新运行。
+    返回索引是否已存在或创建成功。
+    """
+    cursor = conn.cursor()
+    try:
+        print("Creating unique index on source_path...")
+        cursor.execute("""
+            SELECT source_path, array_agg(id ORDER BY id) FROM datasets
+            WHERE source_path IS NOT NULL
+            GROUP BY source_path HAVING count(*) > 1
+            ORDER BY source_path;
+        """)
+        duplicates = cursor.fetchall()
+        if duplicates:
+            print(f"Skipped idx_source_path_unique: {len(duplicates)} source_path values have duplicate rows:")
+            for source_path, ids in duplicates:
+                print(f"  {source_path}: dataset ids {ids}")
+            print("Remove the duplicates (e.g. keep the newest id of each) and run init_db() again.")
+            conn.rollback()
+            return False
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_source_path_unique ON datasets (source_path);")
+        conn.commit()
+        return True
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Creating idx_source_path_unique failed: {e}")
+        return False
+    finally:
+        cursor.close()
+
 def init_db():
     """初始化数据库，创建 PostGIS 扩展和数据表"""
     print("Initializing PostgreSQL database with PostGIS...")
@@ -25,7 +58,16 @@ def init_db():
         print("Enabling PostGIS extension...")
         cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
 
-        # 步骤 2: 创建 datasets 表，使用 GEOMETRY 类型存储地理边界
+        # 步骤 2: 创建 categories 表和 datasets 表，datasets 使用 GEOMETRY 类型存储地理边界
+        print("Creating categories table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS categories (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                description TEXT
+            );
+        """)
+
         print("Creating datasets table...")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS datasets (
@@ -37,8 +79,74 @@ def init_db():
             );
         """)
 
+        # 步骤 3: 入库时生成的 Cloud-Optimized GeoTIFF 的 S3 键 (可选)
+        print("Adding cog_path column...")
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS cog_path TEXT;")
+
+        # 步骤 4: 补齐入库脚本使用的来源和分类字段 (旧库中可能已存在)
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS source_path TEXT;")
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS source_type TEXT;")
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS category_id INTEGER REFERENCES categories(id);")
+        # 入库时计算的波段统计 (排除 nodata 的 min/max/均值/标准差和百分位拉伸范围)，渲染时复用
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS stats JSONB;")
+        # 源文件的 SHA-256，用于上传和入库去重 (见 dedup.py)
+        cursor.execute("ALTER TABLE datasets ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+
+        # 步骤 5: 空间索引和分类索引，供 /api/datasets 的 bbox/category 过滤使用
+        print("Creating indexes...")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_datasets_geom ON datasets USING GIST (geom);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_datasets_category_id ON datasets (category_id, id);")
+        # 同一内容可能对应多个来源路径，因此不是唯一索引
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_datasets_content_hash ON datasets (content_hash);")
+        # 范围中心点 (Web Mercator) 的生成列，供 /api/footprints 在低级别按网格聚合时走索引。
+        # 先把范围裁剪到 Web Mercator 的有效纬度 (±85.0511°)，极地数据集不会产生无穷大坐标；
+        # 旧版本的生成列没有裁剪，生成表达式无法原地修改，需要删除后重建
+        cursor.execute("""
+            SELECT generation_expression FROM information_schema.columns
+            WHERE table_name = 'datasets' AND column_name = 'centroid_3857';
+        """)
+        row = cursor.fetchone()
+        if row and 'clipbybox2d' not in (row[0] or '').lower():
+            cursor.execute("ALTER TABLE datasets DROP COLUMN centroid_3857;")
+        cursor.execute("""
+            ALTER TABLE datasets ADD COLUMN IF NOT EXISTS centroid_3857 GEOMETRY(Point, 3857)
+                GENERATED ALWAYS AS (ST_Transform(ST_Centroid(
+                    ST_ClipByBox2D(geom, ST_MakeEnvelope(-180, -85.0511287798, 180, 85.0511287798, 4326)::box2d)
+                ), 3857)) STORED;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_datasets_centroid_3857 ON datasets USING GIST (centroid_3857);")
+        cursor.execute("ANALYZE datasets;")
+
+        # 步骤 6: 单行的目录版本表，入库时递增，用于 /api/datasets 的缓存失效和 ETag
+        print("Creating catalog_version table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS catalog_version (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                version BIGINT NOT NULL DEFAULT 1
+            );
+        """)
+        cursor.execute("INSERT INTO catalog_version (id, version) VALUES (TRUE, 1) ON CONFLICT (id) DO NOTHING;")
+
+        # 步骤 7: 增量入库清单，入库脚本据此只处理新增或变化的文件
+        print("Creating ingest manifest tables...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_manifest (
+                source_type TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                size BIGINT,
+                mtime DOUBLE PRECISION,
+                etag TEXT,
+                content_hash TEXT,
+                processed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source_type, source_key)
+            );
+        """)
+
         conn.commit()
         cursor.close()
+
+        # 步骤 8: 唯一索引单独提交，旧库中已有重复的 source_path 时不影响前面的迁移
+        create_source_path_index(conn)
         print("Database initialized successfully.")
     except Exception as e:
         print(f"Database initialization failed: {e}")
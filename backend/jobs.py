@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件的异步处理：Web 请求只负责把文件落盘并入队，随后立即返回 202；
+处理流程 (S3 存档、COG、预览图、入库) 在独立的 worker 池中执行。
+
+队列以本地 spool 目录作为轻量 broker，任务状态以 JSON 文件保存，
+因此同一台机器上的所有 gunicorn worker 和独立的 worker 进程都能看到同一份状态：
+    <spool>/queue/    待处理的任务 (worker 通过原子 rename 认领)
+    <spool>/running/  已被认领的任务，文件名以认领进程的 PID 开头
+    <spool>/failed/   处理失败的任务 (python jobs.py --retry-failed 放回队列)
+    <spool>/status/   每个任务的状态 (stage / progress / result / error)
+    <spool>/files/    上传的原始文件
+    <spool>/incoming/ 正在接收的上传请求体 (接收完成后 rename 到 files/)
+    <spool>/uploads/  分块上传的会话和数据 (见 uploads.py)
+    <spool>/metrics/  独立 worker 进程的指标快照，Web 进程的 /metrics 读取后一并导出
+
+任务由独立的 worker 进程处理 (吞吐量随 --workers 扩展，与 Web worker 数量无关)，
+部署时需要与 gunicorn 一起运行:
+    python jobs.py --workers 4
+单机开发时也可以设置 JOB_EMBEDDED_WORKERS=N，让每个 Web 进程启动时内嵌 N 个 worker 线程。
+
+worker 被 SIGKILL 或机器崩溃时，任务会留在 running/ 中。每个 worker (进程或内嵌线程组) 启动时
+调用 recover_stale_jobs()，把认领进程已不存在的任务放回队列重新处理。
+
+任务的阶段耗时和字节数记录在执行任务的进程中。内嵌线程与 Web 进程共享指标；独立的 worker 进程
+在启动时和每个任务结束后把指标快照写入 metrics/ (export_worker_metrics)，Web 进程的 /metrics
+通过 load_worker_metrics() 把它们与本进程的指标相加后导出。python jobs.py 启动时会清理已退出
+进程留下的快照，对 Prometheus 而言相当于计数器重置。
+"""
+import os
+import re
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import psycopg2
+
+from processing import (
+    get_db_connection,
+    process_geotiff_and_upload,
+    insert_dataset_to_db,
+    find_duplicate_dataset,
+    S3_BUCKET_NAME,
+)
+from clients import get_s3_client
+from dedup import content_source_key, s3_object_exists, describe_duplicate
+from cog import COG_NORMALIZE, normalize_and_upload_cog
+from metrics import timed, job_timer, add_bytes_written, write_snapshot, load_snapshots
+
+# --- 配置 ---
+JOB_SPOOL_DIR = os.environ.get('JOB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'geotiff_jobs'))
+# 每个 Web 进程内嵌的后台 worker 线程数；默认 0，即由独立的 worker 进程 (python jobs.py) 处理任务
+JOB_EMBEDDED_WORKERS = int(os.environ.get('JOB_EMBEDDED_WORKERS', 0))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+S3_SOURCE_PREFIX = 'geotiffs/'
+# 上传的数据集默认归类为“其他”
+DEFAULT_UPLOAD_CATEGORY_ID = 4
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_embedded_lock = threading.Lock()
+_embedded_pid = None
+
+
+# --- spool 目录 ---
+def _spool_path(*parts):
+    path = os.path.join(JOB_SPOOL_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def write_json(path, data):
+    """原子写入 JSON 文件 (先写临时文件再 rename)。"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    """读取 JSON 文件；文件不存在或内容不完整时返回 None。"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# --- 任务状态 ---
+def new_job_id():
+    return uuid.uuid4().hex
+
+def spool_file_path(job_id, filename):
+    """返回上传文件在 spool 目录中的保存路径 (保留扩展名，供 GDAL 识别格式)。"""
+    return _spool_path('files', f"{job_id}{os.path.splitext(filename)[1]}")
+
+def open_incoming_file():
+    """
+    为正在接收的上传文件创建 spool 目录内的临时文件。它与 files/ 位于同一文件系统，
+    接收完成后 adopt_incoming_file() 只需 rename，不必再复制一遍。
+    """
+    return tempfile.NamedTemporaryFile('wb+', dir=os.path.dirname(_spool_path('incoming', 'x')),
+                                       suffix='.part', delete=False)
+
+def adopt_incoming_file(stream, job_id, filename):
+    """把 open_incoming_file() 创建的文件移动为任务的上传文件，返回新路径。"""
+    path = spool_file_path(job_id, filename)
+    stream.close()
+    os.replace(stream.name, path)
+    return path
+
+def enqueue_job(job_id, kind, payload):
+    """写入任务初始状态并放入队列。payload 中引用的文件必须已经落盘。"""
+    now = time.time()
+    write_json(_spool_path('status', f"{job_id}.json"), {
+        'id': job_id,
+        'kind': kind,
+        'status': 'queued',
+        'stage': 'queued',
+        'progress': 0.0,
+        'result': None,
+        'error': None,
+        'created_at': now,
+        'updated_at': now,
+    })
+    # 文件名以时间戳开头，worker 按文件名排序即可近似先进先出
+    write_json(_spool_path('queue', f"{now:.6f}_{job_id}.json"),
+               {'id': job_id, 'kind': kind, 'payload': payload})
+    ensure_embedded_workers()
+    return job_id
+
+def get_job(job_id):
+    """读取任务状态；任务不存在或 ID 非法时返回 None。"""
+    if not JOB_ID_PATTERN.match(job_id or ''):
+        return None
+    return read_json(os.path.join(JOB_SPOOL_DIR, 'status', f"{job_id}.json"))
+
+def update_job(job_id, **fields):
+    """更新任务状态。只有认领了该任务的 worker 会写入，因此无需跨进程加锁。"""
+    path = _spool_path('status', f"{job_id}.json")
+    job = read_json(path) or {'id': job_id}
+    job.update(fields)
+    job['updated_at'] = time.time()
+    write_json(path, job)
+
+
+# --- 任务处理函数 ---
+def archive_upload(local_path, filename, content_hash=None):
+    """
+    把上传的原始文件存档到 S3，返回 S3 键。有内容哈希时按内容寻址存放，
+    相同内容的对象已存在 (例如上次处理失败前已存档) 时跳过上传。
+    """
+    if not content_hash:
+        s3_source_key = f"{S3_SOURCE_PREFIX}{uuid.uuid4()}_{filename}"
+    else:
+        s3_source_key = content_source_key(content_hash, filename)
+        if s3_object_exists(get_s3_client(), S3_BUCKET_NAME, s3_source_key):
+            print(f"相同内容已存档于 s3://{S3_BUCKET_NAME}/{s3_source_key}，跳过上传")
+            return s3_source_key
+    with timed('archive'):
+        get_s3_client().upload_file(local_path, S3_BUCKET_NAME, s3_source_key)
+    add_bytes_written('s3_archive', os.path.getsize(local_path))
+    print(f"原始文件已上传至: s3://{S3_BUCKET_NAME}/{s3_source_key}")
+    return s3_source_key
+
+def run_upload_job(payload, report):
+    """
+    处理一个上传的 GeoTIFF：去重检查 → S3 存档 → (可选) COG → 预览图 → 入库。
+    payload 中的 content_hash (接收时计算的 SHA-256) 已入库时直接返回已有的数据集。
+    spool 中的上传文件只在成功或确认重复后删除；失败的任务保留该文件，便于排查和重新入队。
+    :param report: report(stage, progress) 回调，用于更新任务进度。
+    """
+    local_path = payload['path']
+    filename = payload['filename']
+    content_hash = payload.get('content_hash')
+    cog_path = None
+    conn = None
+    finished = False
+    try:
+        # 入队后可能已有相同内容的任务先完成，这里再检查一次
+        duplicate = find_duplicate_dataset(content_hash)
+        if duplicate is not None:
+            finished = True
+            return describe_duplicate(duplicate)
+
+        report('archiving', 0.1)
+        # 分块上传 (uploads.py) 在接收时已完成 S3 存档，payload 中带有 s3_key
+        s3_source_key = payload.get('s3_key') or archive_upload(local_path, filename, content_hash)
+
+        s3_cog_key = None
+        render_path = local_path
+        if COG_NORMALIZE:
+            report('cog', 0.3)
+            render_path, s3_cog_key = normalize_and_upload_cog(local_path, s3_source_key)
+            if render_path != local_path:
+                cog_path = render_path
+
+        report('rendering', 0.5)
+        processed_data = process_geotiff_and_upload(render_path, content_hash=content_hash)
+
+        report('inserting', 0.9)
+        dataset_name = os.path.splitext(filename)[0]
+        conn = get_db_connection()
+        try:
+            dataset_id = insert_dataset_to_db(
+                conn,
+                name=dataset_name,
+                image_url=processed_data['preview_url'],
+                geom_wkt=processed_data['wkt_polygon'],
+                source_path=s3_source_key,
+                source_type='S3_UPLOAD',
+                category_id=DEFAULT_UPLOAD_CATEGORY_ID,
+                cog_path=s3_cog_key,
+                stats=processed_data.get('stats'),
+                content_hash=content_hash
+            )
+        except psycopg2.IntegrityError:
+            # 相同内容的两个上传并发处理，按内容寻址的 source_path 冲突，后完成的一方视为重复
+            duplicate = find_duplicate_dataset(content_hash)
+            if duplicate is None:
+                raise
+            finished = True
+            return describe_duplicate(duplicate)
+        finished = True
+        return {
+            'dataset_id': dataset_id,
+            'name': dataset_name,
+            'image_url': processed_data['preview_url'],
+            'message': f"数据集 '{dataset_name}' 已成功处理并保存。",
+        }
+    finally:
+        if conn:
+            conn.close()
+        # COG 是可重新生成的中间文件，总是删除
+        for path in (local_path if finished else None, cog_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+JOB_HANDLERS = {
+    'upload': run_upload_job,
+}
+
+
+# --- worker ---
+def _running_name(pid, name):
+    return f"{pid}-{name}"
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # 进程存在，只是属于其他用户
+    return True
+
+def claim_next_job():
+    """
+    从队列中认领最早的任务；rename 是原子操作，多个 worker 不会重复认领。
+    running/ 中的文件名带有认领进程的 PID，供 recover_stale_jobs() 判断认领者是否还在运行。
+    """
+    queue_dir = os.path.join(JOB_SPOOL_DIR, 'queue')
+    try:
+        names = sorted(n for n in os.listdir(queue_dir) if n.endswith('.json'))
+    except OSError:
+        return None
+    for name in names:
+        running_path = _spool_path('running', _running_name(os.getpid(), name))
+        try:
+            os.rename(os.path.join(queue_dir, name), running_path)
+        except OSError:
+            continue  # 已被其他 worker 认领
+        job = read_json(running_path)
+        if job is not None:
+            job['_running_path'] = running_path
+            job['_queue_name'] = name
+            return job
+    return None
+
+def run_job(job):
+    """
+    执行任务；各阶段耗时 (见 metrics.py) 写入任务状态的 timings 字段，并输出一行结构化日志。
+    失败的任务移到 failed/ (上传文件仍保留在 files/ 中)，可用 retry_failed_jobs() 重新入队。
+    """
+    job_id = job['id']
+    handler = JOB_HANDLERS.get(job['kind'])
+
+    def report(stage, progress):
+        update_job(job_id, status='running', stage=stage, progress=progress)
+
+    timer = None
+    failed = False
+    try:
+        with job_timer(job['kind'], job_id, filename=job['payload'].get('filename')) as timer:
+            if handler is None:
+                raise ValueError(f"未知的任务类型: {job['kind']}")
+            report('started', 0.0)
+            result = handler(job['payload'], report)
+        update_job(job_id, status='succeeded', stage='done', progress=1.0, result=result,
+                   timings=timer.to_dict())
+    except Exception as e:
+        failed = True
+        print(f"任务 {job_id} 处理失败: {e}")
+        update_job(job_id, status='failed', error=str(e), timings=timer.to_dict() if timer else None)
+    finally:
+        try:
+            if failed:
+                os.replace(job['_running_path'], _spool_path('failed', job['_queue_name']))
+            else:
+                os.remove(job['_running_path'])
+        except OSError:
+            pass
+
+def retry_failed_jobs(job_ids=None):
+    """把 failed/ 中的任务 (可只指定部分任务 ID) 放回队列，返回重新入队的任务数。"""
+    failed_dir = os.path.join(JOB_SPOOL_DIR, 'failed')
+    try:
+        names = sorted(n for n in os.listdir(failed_dir) if n.endswith('.json'))
+    except OSError:
+        return 0
+    retried = 0
+    for name in names:
+        job = read_json(os.path.join(failed_dir, name))
+        if job is None or (job_ids is not None and job['id'] not in job_ids):
+            continue
+        update_job(job['id'], status='queued', stage='requeued', progress=0.0, error=None)
+        os.replace(os.path.join(failed_dir, name), _spool_path('queue', name))
+        retried += 1
+    return retried
+
+def recover_stale_jobs():
+    """
+    把认领进程已经退出的任务从 running/ 放回队列，返回恢复的任务数。
+    先 rename 为本进程的名字再放回队列，多个 worker 同时恢复时只有一个会成功。
+    """
+    running_dir = os.path.join(JOB_SPOOL_DIR, 'running')
+    try:
+        names = os.listdir(running_dir)
+    except OSError:
+        return 0
+    recovered = 0
+    for name in names:
+        pid, sep, queue_name = name.partition('-')
+        if not sep or not pid.isdigit() or not queue_name.endswith('.json') or _pid_alive(int(pid)):
+            continue
+        own_path = os.path.join(running_dir, _running_name(os.getpid(), queue_name))
+        try:
+            os.rename(os.path.join(running_dir, name), own_path)
+        except OSError:
+            continue  # 已被其他 worker 恢复
+        job = read_json(own_path)
+        if job is not None:
+            update_job(job['id'], status='queued', stage='requeued', progress=0.0)
+        os.replace(own_path, _spool_path('queue', queue_name))
+        print(f"已将进程 {pid} 遗留的任务 {queue_name} 放回队列")
+        recovered += 1
+    return recovered
+
+def export_worker_metrics():
+    """把本进程的指标快照写入 spool 目录，供 Web 进程的 /metrics 导出。"""
+    write_snapshot(_spool_path('metrics', f"{os.getpid()}.json"))
+
+def load_worker_metrics():
+    """读取全部独立 worker 进程的指标快照 (传给 metrics.render_prometheus)。"""
+    return load_snapshots(os.path.join(JOB_SPOOL_DIR, 'metrics'))
+
+def prune_worker_metrics():
+    """删除已退出的 worker 进程留下的指标快照。"""
+    metrics_dir = os.path.join(JOB_SPOOL_DIR, 'metrics')
+    try:
+        names = os.listdir(metrics_dir)
+    except OSError:
+        return
+    for name in names:
+        pid = name.split('.', 1)[0]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            try:
+                os.remove(os.path.join(metrics_dir, name))
+            except OSError:
+                pass
+
+def worker_loop(stop_event=None, export_metrics=False):
+    """
+    持续认领并执行任务，队列为空时按 JOB_POLL_INTERVAL 轮询。
+    :param export_metrics: 独立的 worker 进程传入 True，启动时和每个任务结束后导出指标快照；
+                           内嵌线程与 Web 进程共享指标，不需要导出。
+    """
+    if export_metrics:
+        export_worker_metrics()
+    while stop_event is None or not stop_event.is_set():
+        job = claim_next_job()
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+        if export_metrics:
+            export_worker_metrics()
+
+def ensure_embedded_workers():
+    """
+    在当前进程中按需启动 JOB_EMBEDDED_WORKERS 个后台线程 (由 gunicorn 的 post_worker_init 钩子
+    在 worker 启动时调用，入队时也会检查一次)。按 PID 记录，fork 出的子进程会重新启动自己的线程。
+    """
+    global _embedded_pid
+    if JOB_EMBEDDED_WORKERS <= 0 or _embedded_pid == os.getpid():
+        return
+    with _embedded_lock:
+        if _embedded_pid == os.getpid():
+            return
+        recover_stale_jobs()
+        for i in range(JOB_EMBEDDED_WORKERS):
+            threading.Thread(target=worker_loop, name=f"job-worker-{i}", daemon=True).start()
+        _embedded_pid = os.getpid()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上传任务 worker 进程池")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help="并行处理任务的进程数")
+    parser.add_argument('--retry-failed', nargs='*', metavar='JOB_ID',
+                        help="把失败的任务 (默认全部，或指定的任务 ID) 放回队列后退出")
+    args = parser.parse_args()
+
+    if args.retry_failed is not None:
+        retried = retry_failed_jobs(set(args.retry_failed) or None)
+        print(f"已将 {retried} 个失败的任务放回队列")
+        return
+
+    print(f"--- 启动 {args.workers} 个任务 worker，spool 目录: {JOB_SPOOL_DIR} ---")
+    recovered = recover_stale_jobs()
+    if recovered:
+        print(f"已恢复 {recovered} 个中断的任务")
+    prune_worker_metrics()
+    processes = [multiprocessing.Process(target=worker_loop, kwargs={'export_metrics': True},
+                                         name=f"job-worker-{i}")
+                 for i in range(args.workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
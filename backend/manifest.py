@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+增量入库清单 (ingest manifest)。
+
+每个已入库的来源文件在 ingest_manifest 表中记录大小、mtime / ETag 和内容哈希，
+入库脚本只按批查询本次列举到的键，而不是每次把整个 datasets.source_path 读进内存。
+判断规则:
+    - 清单中没有、datasets 中也没有            -> 新文件，需要处理
+    - 大小和 mtime/ETag 都未变                -> 跳过
+    - 大小或 mtime 变了，但内容哈希未变 (touch) -> 跳过，只更新清单
+    - 内容变了                               -> 重新处理 (upsert 覆盖旧记录)
+    - 清单中没有、但 datasets 中已存在 (旧数据)  -> 视为未变化，并补录到清单中
+"""
+import hashlib
+import psycopg2.extras
+
+# 每次查询清单的键数量
+MANIFEST_LOOKUP_BATCH = 1000
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+UPSERT_MANIFEST_SQL = """
+    INSERT INTO ingest_manifest (source_type, source_key, size, mtime, etag, content_hash, processed_at)
+    VALUES %s
+    ON CONFLICT (source_type, source_key) DO UPDATE SET
+        size = EXCLUDED.size,
+        mtime = EXCLUDED.mtime,
+        etag = EXCLUDED.etag,
+        content_hash = COALESCE(EXCLUDED.content_hash, ingest_manifest.content_hash),
+        processed_at = EXCLUDED.processed_at
+"""
+MANIFEST_ROW_TEMPLATE = "(%(source_type)s, %(source_key)s, %(size)s, %(mtime)s, %(etag)s, %(content_hash)s, CURRENT_TIMESTAMP)"
+
+
+def make_entry(source_type, source_key, size=None, mtime=None, etag=None, content_hash=None):
+    """构造一条清单记录。"""
+    return {
+        'source_type': source_type,
+        'source_key': source_key,
+        'size': size,
+        'mtime': mtime,
+        'etag': etag,
+        'content_hash': content_hash,
+    }
+
+def hash_file(path):
+    """流式计算文件的 SHA-256，内存占用与文件大小无关。"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def lookup(conn, source_type, keys):
+    """
+    按批查询清单。返回 {source_key: 清单行字典或 None}；对于清单中没有记录的键，
+    'in_catalog' 标记 datasets 中是否已有同一 source_path 的记录。
+    """
+    result = {}
+    keys = list(keys)
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(keys), MANIFEST_LOOKUP_BATCH):
+            batch = keys[i:i + MANIFEST_LOOKUP_BATCH]
+            cursor.execute(
+                """
+                SELECT k.key, m.size, m.mtime, m.etag, m.content_hash, m.source_key IS NOT NULL, d.id IS NOT NULL
+                FROM unnest(%s::text[]) AS k(key)
+                LEFT JOIN ingest_manifest m ON m.source_type = %s AND m.source_key = k.key
+                LEFT JOIN datasets d ON d.source_path = k.key
+                """,
+                (batch, source_type)
+            )
+            for key, size, mtime, etag, content_hash, in_manifest, in_catalog in cursor.fetchall():
+                result[key] = {
+                    'size': size,
+                    'mtime': mtime,
+                    'etag': etag,
+                    'content_hash': content_hash,
+                    'in_manifest': in_manifest,
+                    'in_catalog': in_catalog,
+                }
+    finally:
+        cursor.close()
+    return result
+
+def classify(entry, known):
+    """
+    将一条候选记录与清单对比，返回 'new'、'changed'、'unchanged' 或 'verify'。
+    'verify' 表示元数据变了，需要调用方计算内容哈希后再用 is_same_content() 判断。
+    """
+    if known is None or not known['in_manifest']:
+        return 'unchanged' if known and known['in_catalog'] else 'new'
+    if entry.get('etag') is not None and entry['etag'] == known['etag'] and entry['size'] == known['size']:
+        return 'unchanged'
+    if entry.get('etag') is None and entry['size'] == known['size'] and entry['mtime'] == known['mtime']:
+        return 'unchanged'
+    if entry.get('etag') is None and known['content_hash']:
+        return 'verify'
+    return 'changed'
+
+def is_same_content(content_hash, known):
+    return bool(known and known['content_hash'] and known['content_hash'] == content_hash)
+
+def record(conn, entries):
+    """批量写入/更新清单记录并提交。"""
+    entries = list(entries)
+    if not entries:
+        return
+    cursor = conn.cursor()
+    try:
+        psycopg2.extras.execute_values(cursor, UPSERT_MANIFEST_SQL, entries, template=MANIFEST_ROW_TEMPLATE)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
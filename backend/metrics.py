@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+轻量的性能埋点：各处理阶段的耗时直方图、读写字节数和入库行数。
+
+    with timed('bounds'):            # 记录一次阶段耗时
+        ...
+    add_bytes_read('raster', n)      # 按来源累计读取的字节数
+    add_bytes_written('s3_preview', n)
+    add_rows_inserted('batch', n)
+
+指标在每个进程内独立累计。Web 进程通过 /metrics 以 Prometheus 文本格式导出；
+入库脚本设置 METRICS_TEXTFILE 后，在运行结束时把同样格式的指标写入该文件
+(供 node_exporter 的 textfile collector 采集)。独立的任务 worker 进程 (python jobs.py) 没有
+HTTP 接口，它们用 write_snapshot() 定期把指标写入 spool 目录，Web 进程导出时用
+load_snapshots() 读取并与本进程的指标相加 (见 jobs.py)。
+
+job_timer() 为单个任务 (一次上传或一个入库文件) 汇总各阶段耗时和字节数，结束时输出一行
+JSON 结构化日志：写入 METRICS_JOB_LOG 指定的文件，未设置时打印到标准输出。
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# --- 配置 ---
+# 每个任务的耗时日志 (JSON Lines) 的路径；未设置时打印到标准输出
+METRICS_JOB_LOG = os.environ.get('METRICS_JOB_LOG')
+# 入库脚本结束时写入 Prometheus 文本格式指标的文件路径
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE')
+METRIC_PREFIX = 'geotiff_'
+# 阶段耗时直方图的桶上限 (秒)；COG 转换和大文件存档可能需要数分钟
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+METRIC_HELP = {
+    'stage_seconds': ('histogram', "各处理阶段的耗时 (秒)"),
+    'job_seconds': ('histogram', "单个任务的总耗时 (秒)"),
+    'http_request_seconds': ('histogram', "HTTP 请求的处理耗时 (秒)"),
+    'bytes_read_total': ('counter', "按来源累计读取的字节数"),
+    'bytes_written_total': ('counter', "按目标累计写入的字节数"),
+    'rows_inserted_total': ('counter', "写入 datasets 表的行数"),
+    'jobs_total': ('counter', "按类型和结果统计的任务数"),
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> {'buckets': [...], 'sum': float, 'count': int}
+_counters = {}    # (name, labels) -> value
+_collectors = []  # [(prefix, fn, label)]，见 register_collector
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def observe(name, seconds, **labels):
+    """向直方图 name 记录一次观测值。"""
+    key = (name, _label_key(labels))
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = {'buckets': [0] * len(STAGE_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                entry['buckets'][i] += 1
+        entry['sum'] += seconds
+        entry['count'] += 1
+
+def inc(name, value=1, **labels):
+    """累加计数器 name。"""
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# --- 阶段耗时与字节数 ---
+class JobTimer:
+    """单个任务内各阶段的累计耗时和计数，由 job_timer() 创建。"""
+
+    def __init__(self, kind, name=None):
+        self.kind = kind
+        self.name = name
+        self.stages = {}    # stage -> 累计秒数 (同一阶段多次执行时相加)
+        self.counters = {}  # 'bytes_read.raster' 等 -> 累计值
+        self.started = time.perf_counter()
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_counter(self, key, value):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        return {
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+def current_job():
+    """返回当前线程正在计时的 JobTimer；不在任务中时返回 None。"""
+    return getattr(_local, 'job', None)
+
+@contextmanager
+def timed(stage):
+    """记录一个处理阶段的耗时 (异常退出时同样记录)。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe('stage_seconds', seconds, stage=stage)
+        job = current_job()
+        if job is not None:
+            job.add_stage(stage, seconds)
+
+def _count(name, label_name, label_value, value):
+    if not value:
+        return
+    inc(name, value, **{label_name: label_value})
+    job = current_job()
+    if job is not None:
+        job.add_counter(f"{name[:-len('_total')]}.{label_value}", value)
+
+def add_bytes_read(source, nbytes):
+    _count('bytes_read_total', 'source', source, nbytes)
+
+def add_bytes_written(target, nbytes):
+    _count('bytes_written_total', 'target', target, nbytes)
+
+def add_rows_inserted(mode, rows):
+    _count('rows_inserted_total', 'mode', mode, rows)
+
+
+# --- 任务计时 ---
+@contextmanager
+def job_timer(kind, name=None, log=True, **fields):
+    """
+    在当前线程中为一个任务计时。期间的 timed() 和字节/行数计数会同时汇总到返回的 JobTimer 中；
+    结束时记录任务总耗时，log 为 True 时输出一行 JSON 结构化日志 (fields 会附加到日志中)。
+    """
+    previous = current_job()
+    job = _local.job = JobTimer(kind, name)
+    status = 'succeeded'
+    error = None
+    try:
+        yield job
+    except Exception as e:
+        status, error = 'failed', str(e)
+        raise
+    finally:
+        _local.job = previous
+        seconds = time.perf_counter() - job.started
+        observe('job_seconds', seconds, kind=kind)
+        inc('jobs_total', kind=kind, status=status)
+        if log:
+            record = {'event': 'job_timing', 'kind': kind, 'name': name, 'status': status,
+                      'seconds': round(seconds, 6), 'time': time.time()}
+            record.update(fields)
+            record.update(job.to_dict())
+            if error is not None:
+                record['error'] = error
+            write_job_log(record)
+
+def merge_job(data):
+    """
+    把其他进程 (例如 ProcessPoolExecutor 中的渲染进程) 中 JobTimer.to_dict() 的结果并入本进程的
+    指标和当前任务。子进程中的指标不会被导出，必须经由这里回传。
+    """
+    if not data:
+        return
+    job = current_job()
+    for stage, seconds in data.get('stages', {}).items():
+        observe('stage_seconds', seconds, stage=stage)
+        if job is not None:
+            job.add_stage(stage, seconds)
+    for key, value in data.get('counters', {}).items():
+        kind, label_value = key.split('.', 1)
+        label_name = {'bytes_read': 'source', 'bytes_written': 'target', 'rows_inserted': 'mode'}[kind]
+        _count(f"{kind}_total", label_name, label_value, value)
+
+def write_job_log(record):
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        if METRICS_JOB_LOG:
+            with open(METRICS_JOB_LOG, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        else:
+            print(line)
+
+
+# --- 导出 ---
+def register_collector(prefix, fn, label=None):
+    """
+    注册导出时调用的统计函数 (例如 tile_cache.stats)，其返回字典中的数值以 untyped 指标导出，
+    名称为 geotiff_<prefix>_<键>。值为字典时 (例如按格式分组的编码统计)，外层键作为 label 标签。
+    """
+    _collectors.append((prefix, fn, label))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _collector_lines():
+    samples = {}  # 指标名 -> [(labels, value)]
+    for prefix, fn, label in _collectors:
+        try:
+            stats = fn()
+        except Exception as e:
+            print(f"读取 {prefix} 统计时出错: {e}")
+            continue
+        for key, value in stats.items():
+            if isinstance(value, dict) and label:
+                for sub_key, sub_value in value.items():
+                    if _is_number(sub_value):
+                        samples.setdefault(f"{prefix}_{sub_key}", []).append((((label, str(key)),), sub_value))
+            elif _is_number(value):
+                samples.setdefault(f"{prefix}_{key}", []).append(((), value))
+    lines = []
+    for name in sorted(samples):
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} untyped")
+        for labels, value in samples[name]:
+            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}")
+    return lines
+
+def snapshot():
+    """返回本进程直方图和计数器的可 JSON 序列化副本，供其他进程导出时合并 (见 render_prometheus)。"""
+    with _lock:
+        return {
+            'histograms': [[name, [list(l) for l in labels], {'buckets': list(e['buckets']), 'sum': e['sum'],
+                                                              'count': e['count']}]
+                           for (name, labels), e in _histograms.items()],
+            'counters': [[name, [list(l) for l in labels], value] for (name, labels), value in _counters.items()],
+        }
+
+def write_snapshot(path):
+    """把 snapshot() 原子写入 path。"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+def load_snapshots(directory):
+    """读取 directory 下 write_snapshot() 写入的全部 *.json 快照；目录不存在或文件不完整时跳过。"""
+    snapshots = []
+    try:
+        names = sorted(n for n in os.listdir(directory) if n.endswith('.json'))
+    except OSError:
+        return snapshots
+    for name in names:
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def render_prometheus(snapshots=()):
+    """
+    以 Prometheus 文本格式 (0.0.4) 导出本进程的全部指标。
+    :param snapshots: 其他进程的 snapshot()，其中的直方图和计数器与本进程的相加后导出。
+    """
+    with _lock:
+        histograms = {key: {'buckets': list(e['buckets']), 'sum': e['sum'], 'count': e['count']}
+                      for key, e in _histograms.items()}
+        counters = dict(_counters)
+    for data in snapshots:
+        for name, labels, e in data.get('histograms', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            entry = histograms.setdefault(key, {'buckets': [0] * len(STAGE_BUCKETS), 'sum': 0.0, 'count': 0})
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], e['buckets'])]
+            entry['sum'] += e['sum']
+            entry['count'] += e['count']
+        for name, labels, value in data.get('counters', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+
+    lines = []
+    names = sorted({name for name, _ in histograms} | {name for name, _ in counters})
+    for name in names:
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+        full_name = f"{METRIC_PREFIX}{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for (metric, labels), entry in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(STAGE_BUCKETS, entry['buckets']):
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {entry['count']}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {entry['sum']}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {entry['count']}")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+    lines.extend(_collector_lines())
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path=METRICS_TEXTFILE):
+    """把指标原子写入 path (未配置时不做任何事)。"""
+    if not path:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+def stage_summary():
+    """按阶段返回次数、总耗时和平均耗时 (毫秒)，供入库脚本在结束时打印。"""
+    with _lock:
+        entries = [(dict(labels).get('stage'), e['count'], e['sum'])
+                   for (name, labels), e in _histograms.items() if name == 'stage_seconds']
+    return {stage: {'count': count, 'seconds': total, 'avg_ms': total * 1000.0 / count if count else 0.0}
+            for stage, count, total in sorted(entries)}
+
+def print_stage_summary():
+    for stage, entry in stage_summary().items():
+        print(f"  {stage}: {entry['count']} 次，共 {entry['seconds']:.2f} 秒，平均 {entry['avg_ms']:.1f} 毫秒")
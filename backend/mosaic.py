@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+服务端镶嵌：把与某个经纬度范围相交的多个数据集合成为一张 (EPSG:4326) 图像，
+前端在区域级缩放下只需下载这一张小图，而不是逐个叠加每个数据集的完整预览图。
+
+每个数据集在线程池中读取：先按输出分辨率选出最合适的金字塔级别，再通过 WarpedVRT
+只读取并重投影输出范围对应的窗口。各数据集的有效像素 (排除 nodata 和范围外) 按
+ordering 合成:
+    first  先入库的数据集优先 (按 id 升序)
+    last   后入库的数据集优先
+    mean   对所有有效值取平均
+相交的数据集超过 MOSAIC_MAX_DATASETS 时，last 只合成最新的那些，first 和 mean 只合成最早的那些，
+并通过返回值 (接口的 X-Mosaic-Truncated 响应头) 告知调用方。
+合成在原始数值上进行，最后统一拉伸渲染。
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+from db import get_db_connection
+from tiles import resolve_source_uri
+from sampling import raster_handles
+from raster_stats import get_stretch_range, RASTER_STATS_PERCENTILES
+from render import render_image
+from metrics import timed
+
+# --- 配置 ---
+# 输出图像每边的最大像素数
+MOSAIC_MAX_SIZE = int(os.environ.get('MOSAIC_MAX_SIZE', 2048))
+# 单次镶嵌最多合成的数据集数量
+MOSAIC_MAX_DATASETS = int(os.environ.get('MOSAIC_MAX_DATASETS', 64))
+# 并行读取数据集的线程数
+MOSAIC_WORKERS = int(os.environ.get('MOSAIC_WORKERS', 4))
+MOSAIC_CRS = 'EPSG:4326'
+MOSAIC_ORDERINGS = ('first', 'last', 'mean')
+
+
+def parse_mosaic_size(width, height):
+    width, height = int(width), int(height)
+    if not (0 < width <= MOSAIC_MAX_SIZE and 0 < height <= MOSAIC_MAX_SIZE):
+        raise ValueError(f"width 和 height 必须在 1 到 {MOSAIC_MAX_SIZE} 之间")
+    return width, height
+
+def parse_ordering(value):
+    ordering = (value or 'first').lower()
+    if ordering not in MOSAIC_ORDERINGS:
+        raise ValueError(f"未知的合成方式: {ordering}，可选: {', '.join(MOSAIC_ORDERINGS)}")
+    return ordering
+
+def mosaic_order_by(ordering):
+    """
+    数据集数量超过上限时保留哪些：last 保留最新入库的，first 和 mean 保留最早入库的。
+    查询结果统一再按 id 升序交给合成器 (见 find_mosaic_datasets)。
+    """
+    return "ORDER BY d.id DESC" if ordering == 'last' else "ORDER BY d.id"
+
+def find_mosaic_datasets(bbox, category=None, ordering='first', limit=MOSAIC_MAX_DATASETS):
+    """
+    返回与 bbox 相交、可按需读取的数据集 [{'id', 'src_uri', 'stats'}] (按 id 升序)，
+    以及相交的数据集是否超过 limit 而被截断。
+    """
+    sql = """
+        SELECT d.id, d.source_path, d.source_type, d.cog_path, d.stats
+        FROM datasets d
+        JOIN categories c ON d.category_id = c.id
+        WHERE ST_Intersects(d.geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))
+    """
+    params = list(bbox)
+    if category:
+        sql += " AND c.name = %s"
+        params.append(category)
+    # 多取一行用于判断是否截断
+    sql += f" {mosaic_order_by(ordering)} LIMIT %s"
+    params.append(limit + 1)
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+
+    truncated = len(rows) > limit
+    rows = sorted(rows[:limit], key=lambda row: row[0])
+    datasets = []
+    for dataset_id, source_path, source_type, cog_path, stats in rows:
+        src_uri = resolve_source_uri(source_path, source_type, cog_path)
+        if src_uri is not None:
+            datasets.append({'id': dataset_id, 'src_uri': src_uri, 'stats': stats})
+    return datasets, truncated
+
+def pick_overview_level(src, bbox, width):
+    """选择分辨率不高于输出分辨率的最粗一级金字塔；返回 None 表示读取原始分辨率。"""
+    west, _, east, _ = transform_bounds(MOSAIC_CRS, src.crs, *bbox)
+    out_res = abs(east - west) / width
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor <= out_res:
+            level = i
+    return level
+
+def read_dataset_window(src_uri, bbox, width, height, bands=(1,)):
+    """
+    以输出分辨率读取一个数据集在 bbox 内的数据。
+    :return: (float32 数组 [波段, 行, 列], 有效像素的布尔掩膜)
+    """
+    with raster_handles.open(src_uri) as src:
+        overview_level = pick_overview_level(src, bbox, width)
+    with raster_handles.open(src_uri, overview_level) as src:
+        with WarpedVRT(
+            src,
+            crs=MOSAIC_CRS,
+            transform=from_bounds(*bbox, width, height),
+            width=width,
+            height=height,
+            resampling=Resampling.bilinear,
+            add_alpha=True,
+        ) as vrt:
+            # add_alpha 生成的 alpha 波段位于最后，nodata 和数据范围之外的像素为 0
+            if max(bands) >= vrt.count:
+                raise ValueError(f"数据集只有 {vrt.count - 1} 个波段")
+            data = vrt.read(list(bands) + [vrt.count])
+    return data[:-1].astype(np.float32), data[-1] > 0
+
+
+class MosaicCompositor:
+    """
+    按 ordering 累积各数据集的读取结果。结果可以按任意顺序到达 (线程池中先读完的先合成)：
+    first/last 为每个像素记录当前值来自的数据集排名，排名更靠前的数据集覆盖排名靠后的。
+    """
+
+    def __init__(self, band_count, width, height, ordering='first'):
+        self.ordering = ordering
+        self.values = np.zeros((band_count, height, width), dtype=np.float64 if ordering == 'mean' else np.float32)
+        if ordering == 'mean':
+            self.counts = np.zeros((height, width), dtype=np.int32)
+        else:
+            self.ranks = np.full((height, width), np.iinfo(np.int32).max, dtype=np.int32)
+
+    def add(self, index, data, valid):
+        if self.ordering == 'mean':
+            self.values += np.where(valid, data, 0)
+            self.counts += valid
+            return
+        rank = index if self.ordering == 'first' else -index
+        take = valid & (rank < self.ranks)
+        self.ranks[take] = rank
+        self.values[:, take] = data[:, take]
+
+    def result(self):
+        """返回 (各波段的二维数组列表, 有效像素掩膜)。"""
+        if self.ordering == 'mean':
+            valid = self.counts > 0
+            values = self.values / np.maximum(self.counts, 1)
+        else:
+            valid = self.ranks != np.iinfo(np.int32).max
+            values = self.values
+        return [band.astype(np.float32) for band in values], valid
+
+
+def mosaic_stretches(bands, valid, datasets, band_indexes):
+    """
+    波段 1 使用各数据集入库时保存的拉伸范围的并集，使镶嵌与单个数据集的瓦片色调一致；
+    缺少统计的数据集或其他波段，按镶嵌结果中有效像素的百分位估计。
+    """
+    stretches = []
+    low_p, high_p = RASTER_STATS_PERCENTILES
+    for band, band_index in zip(bands, band_indexes):
+        if band_index == 1:
+            ranges = [get_stretch_range(d['stats']) for d in datasets]
+            if ranges and all(low is not None for low, _ in ranges):
+                stretches.append((min(low for low, _ in ranges), max(high for _, high in ranges)))
+                continue
+        values = band[valid]
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            stretches.append((None, None))
+        else:
+            low, high = np.percentile(values, [low_p, high_p])
+            stretches.append((float(low), float(high)) if high > low else (None, None))
+    return stretches
+
+def render_mosaic(bbox, width, height, ordering='first', colormap=None, bands=(1,), category=None):
+    """
+    渲染 bbox (west, south, east, north) 范围内的镶嵌图。
+    :return: (PIL Image, 参与合成的数据集数量, 相交的数据集是否超过 MOSAIC_MAX_DATASETS 而被截断)；
+             没有可读的相交数据集时返回全透明图像。
+    """
+    west, south, east, north = bbox
+    if west >= east or south >= north:
+        raise ValueError("镶嵌范围必须满足 west < east 且 south < north (不支持跨越 180° 经线)")
+
+    with timed('mosaic_lookup'):
+        datasets, truncated = find_mosaic_datasets(bbox, category, ordering)
+    if not datasets:
+        return Image.new('LA', (width, height)), 0, truncated
+
+    compositor = MosaicCompositor(len(bands), width, height, ordering)
+    used = []
+    with timed('mosaic_read'), ThreadPoolExecutor(max_workers=MOSAIC_WORKERS,
+                                                  thread_name_prefix='mosaic') as pool:
+        futures = {pool.submit(read_dataset_window, d['src_uri'], bbox, width, height, bands): (i, d)
+                   for i, d in enumerate(datasets)}
+        for future in as_completed(futures):
+            index, dataset = futures[future]
+            try:
+                data, valid = future.result()
+            except ValueError:
+                continue  # 波段数不足的数据集不参与合成
+            except Exception as e:
+                print(f"镶嵌时读取数据集 {dataset['id']} 出错，已跳过: {e}")
+                continue
+            compositor.add(index, data, valid)
+            used.append(dataset)
+
+    if not used:
+        return Image.new('LA', (width, height)), 0, truncated
+    values, valid = compositor.result()
+    stretches = mosaic_stretches(values, valid, used, bands)
+    with timed('render'):
+        img = render_image(values, stretches, colormap, valid_mask=valid)
+    return img, len(used), truncated
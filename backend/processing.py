@@ -1,45 +1,54 @@
 # -*- coding: utf-8 -*-
+import io
 import os
+import time
 import uuid
-import tempfile
-import boto3
+import threading
 import rasterio
+from rasterio.enums import Resampling
 from rasterio.warp import transform_bounds
 import numpy as np
-from PIL import Image
-import psycopg2
 import psycopg2.extras
+from tile_cache import tile_cache
+from catalog_cache import bump_catalog_version, catalog_changed
+from manifest import UPSERT_MANIFEST_SQL, MANIFEST_ROW_TEMPLATE
+from raster_stats import compute_band_stats, get_stretch_range
+from render import render_image, parse_render_params
+from encoding import encode_image, PREVIEW_FORMAT
+from dedup import content_preview_key, find_dataset_by_hash
+from metrics import timed, add_bytes_read, add_bytes_written, add_rows_inserted
+# S3 客户端按进程懒加载，导入本模块时不创建 (也不导入 boto3)
+from clients import get_s3_client
+# 数据库连接来自共享连接池，入库脚本通过本模块导入
+from db import get_db_connection
 
 # --- 配置 ---
 # 从环境变量中获取配置，这是部署的最佳实践
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
 AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
 S3_PREVIEW_PREFIX = 'previews/'
-
-# 初始化 boto3 客户端
-s3_client = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
-
-# --- 数据库连接 ---
-def get_db_connection():
-    """建立与 PostgreSQL 数据库的连接 (凭证来自环境变量)"""
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST'),
-        database=os.environ.get('DB_NAME'),
-        user=os.environ.get('DB_USER'),
-        password=os.environ.get('DB_PASSWORD')
-    )
-    return conn
+# 预览图长边的最大像素数；读取时按该尺寸降采样，峰值内存与预览尺寸成正比，而非源文件尺寸
+PREVIEW_MAX_DIM = int(os.environ.get('PREVIEW_MAX_DIM', 2048))
+# 批量入库：累计到这么多行或距上次写入超过这么多秒时写入一次
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 200))
+INGEST_BATCH_SECONDS = float(os.environ.get('INGEST_BATCH_SECONDS', 5.0))
+# 预览图的色带和波段，例如 PREVIEW_COLORMAP=terrain，或 PREVIEW_BANDS=4,3,2 生成假彩色合成
+PREVIEW_COLORMAP, PREVIEW_BANDS = parse_render_params(
+    os.environ.get('PREVIEW_COLORMAP'), os.environ.get('PREVIEW_BANDS')
+)
 
 # --- S3 辅助函数 ---
-def upload_file_to_s3(file_path, object_key):
-    """将本地文件上传到 S3 并设置为公开可读"""
+def upload_bytes_to_s3(data, object_key, content_type='image/png'):
+    """将内存中的数据上传到 S3 并设置为公开可读 (不经过临时文件)"""
     try:
-        s3_client.upload_file(
-            file_path,
-            S3_BUCKET_NAME,
-            object_key,
-            ExtraArgs={'ContentType': 'image/png', 'ACL': 'public-read'}
-        )
+        with timed('preview_upload'):
+            get_s3_client().upload_fileobj(
+                io.BytesIO(data),
+                S3_BUCKET_NAME,
+                object_key,
+                ExtraArgs={'ContentType': content_type, 'ACL': 'public-read'}
+            )
+        add_bytes_written('s3_preview', len(data))
         print(f"成功上传文件到 s3://{S3_BUCKET_NAME}/{object_key}")
     except Exception as e:
         print(f"S3 上传失败: {e}")
@@ -49,68 +58,304 @@ def get_s3_public_url(object_key):
     """根据 S3 区域和存储桶名称构建公开 URL"""
     return f"https://{S3_BUCKET_NAME}.s3.{AWS_DEFAULT_REGION}.amazonaws.com/{object_key}"
 
+# --- 预览图生成 ---
+def get_preview_shape(width, height, max_dim=PREVIEW_MAX_DIM):
+    """按长边不超过 max_dim 等比例缩放，返回 (rows, cols)。小于 max_dim 的栅格保持原尺寸。"""
+    scale = min(1.0, float(max_dim) / max(width, height))
+    return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+def read_preview_band(dataset, band_index=1, max_dim=PREVIEW_MAX_DIM, masked=False):
+    """
+    以预览尺寸读取单个波段，而不是 dataset.read(1) 读取全分辨率数据。
+    GDAL 在 out_shape 小于原尺寸时会自动选用最接近的内部金字塔 (overview)；
+    没有金字塔时则做最近邻抽样读取，只解码所需的行。
+    :param masked: 为 True 时返回 nodata 被掩膜的 numpy.ma.MaskedArray。
+    """
+    out_shape = get_preview_shape(dataset.width, dataset.height, max_dim)
+    resampling = Resampling.average if dataset.overviews(band_index) else Resampling.nearest
+    with timed('read'):
+        return dataset.read(band_index, out_shape=out_shape, resampling=resampling, masked=masked)
+
+def render_preview_image(dataset, max_dim=PREVIEW_MAX_DIM, stats=None,
+                         colormap=PREVIEW_COLORMAP, bands=PREVIEW_BANDS):
+    """
+    从已打开的 rasterio 数据集生成预览图 (PIL Image)。
+    默认是波段 1 的灰度图；可指定色带，或用三个波段合成 RGB。
+    传入 stats (raster_stats.compute_band_stats 的结果，对应波段 1) 时按其中的百分位范围拉伸，
+    其他波段现场统计；有 nodata 像素时生成带透明通道的图像。
+    """
+    if dataset.count < max(bands):
+        bands, colormap = (1,), None  # 波段不足时退回波段 1 的灰度图
+    arrays, stretches = [], []
+    valid = None
+    for band_index in bands:
+        band = read_preview_band(dataset, band_index, max_dim, masked=True)
+        if band_index == 1 and stats:
+            band_stats = stats
+        else:
+            with timed('stats'):
+                band_stats = compute_band_stats(dataset, band_index)
+        arrays.append(band.data)
+        stretches.append(get_stretch_range(band_stats))
+        band_valid = ~np.ma.getmaskarray(band)
+        valid = band_valid if valid is None else (valid & band_valid)
+    with timed('render'):
+        return render_image(arrays, stretches, colormap, valid_mask=None if valid.all() else valid)
+
 # --- 核心处理函数 ---
-def process_geotiff_and_upload(local_geotiff_path):
+def process_geotiff_and_upload(local_geotiff_path, opener=None, preview_format=PREVIEW_FORMAT, content_hash=None):
     """
     处理本地 GeoTIFF 文件，生成预览图，上传至 S3，并返回所需元数据。
     :param local_geotiff_path: 服务器上临时 GeoTIFF 文件的路径。
-    :return: 包含 wkt_polygon 和 preview_url 的字典。
+    :param opener: 可选的 rasterio opener (例如 s3_reader.S3RangeContainer)，
+                   此时 local_geotiff_path 是 opener 能识别的路径，数据按需远程读取。
+    :param preview_format: 预览图格式 (png/webp/jpeg/auto，见 encoding.py)。
+    :param content_hash: 可选，文件的 SHA-256；提供时预览图按内容寻址存放 (见 dedup.py)。
+    :return: 包含 wkt_polygon、preview_url、波段统计 stats 和预览图大小 preview_bytes 的字典。
     """
-    try:
-        with rasterio.open(local_geotiff_path) as dataset:
-            # 1. 坐标和范围转换
+    if opener is None and os.path.exists(local_geotiff_path):
+        # 通过 opener 远程读取时，实际传输的字节数由调用方记录
+        add_bytes_read('raster', os.path.getsize(local_geotiff_path))
+    with rasterio.open(local_geotiff_path, opener=opener) as dataset:
+        # 1. 坐标和范围转换
+        with timed('bounds'):
             wgs84_bounds = transform_bounds(dataset.crs, {'init': 'epsg:4326'}, *dataset.bounds)
-            wkt_polygon = f'POLYGON(({wgs84_bounds[0]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[1]}))'
-
-            # 2. 图像处理，生成预览图
-            band1 = dataset.read(1)
-            min_val, max_val = np.min(band1), np.max(band1)
-            if max_val > min_val:
-                normalized_band = ((band1 - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-            else:
-                normalized_band = np.zeros(band1.shape, dtype=np.uint8)
-
-            img = Image.fromarray(normalized_band, 'L')
-            
-            # 3. 将预览图保存到临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_preview:
-                img.save(temp_preview.name, format='PNG')
-                temp_preview_path = temp_preview.name
-
-        # 4. 上传预览图到 S3
-        s3_preview_key = f"{S3_PREVIEW_PREFIX}{uuid.uuid4()}.png"
-        upload_file_to_s3(temp_preview_path, s3_preview_key)
-        preview_url = get_s3_public_url(s3_preview_key)
-
-        return {
-            "wkt_polygon": wkt_polygon,
-            "preview_url": preview_url
-        }
+        wkt_polygon = f'POLYGON(({wgs84_bounds[0]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[1]}, {wgs84_bounds[2]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[3]}, {wgs84_bounds[0]} {wgs84_bounds[1]}))'
 
-    finally:
-        # 5. 清理临时预览图文件
-        if 'temp_preview_path' in locals() and os.path.exists(temp_preview_path):
-            os.remove(temp_preview_path)
+        # 2. 逐块统计有效像素 (排除 nodata)，按百分位范围拉伸生成预览图
+        with timed('stats'):
+            stats = compute_band_stats(dataset, 1)
+        img = render_preview_image(dataset, stats=stats)
+
+    # 3. 在内存中编码预览图，不再写临时文件
+    data, content_type, extension = encode_image(img, preview_format)
+
+    # 4. 直接从内存上传预览图到 S3
+    if content_hash:
+        s3_preview_key = content_preview_key(content_hash, extension)
+    else:
+        s3_preview_key = f"{S3_PREVIEW_PREFIX}{uuid.uuid4()}.{extension}"
+    upload_bytes_to_s3(data, s3_preview_key, content_type)
+    preview_url = get_s3_public_url(s3_preview_key)
 
+    return {
+        "wkt_polygon": wkt_polygon,
+        "preview_url": preview_url,
+        "stats": stats,
+        "preview_bytes": len(data)
+    }
 
-def insert_dataset_to_db(conn, name, image_url, geom_wkt, source_path, source_type, category_id):
+
+def insert_dataset_to_db(conn, name, image_url, geom_wkt, source_path, source_type, category_id, cog_path=None,
+                         stats=None, content_hash=None):
     """
     将数据集的元数据插入到数据库中。
+    :param cog_path: 可选，规范化后的 COG 的 S3 键，与 source_path 一同保存。
+    :param stats: 可选，波段统计结果，保存到 stats 列供瓦片渲染复用。
+    :param content_hash: 可选，文件的 SHA-256，用于去重。
+    :return: 新数据集的 ID。
     """
     cursor = conn.cursor()
     try:
-        cursor.execute(
-            """
-            INSERT INTO datasets (name, image_url, geom, source_path, source_type, category_id) 
-            VALUES (%s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s)
-            """,
-            (name, image_url, geom_wkt, source_path, source_type, category_id)
-        )
-        conn.commit()
+        with timed('db_insert'):
+            cursor.execute(
+                """
+                INSERT INTO datasets (name, image_url, geom, source_path, source_type, category_id, cog_path, stats,
+                                      content_hash) 
+                VALUES (%s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s, %s, %s, %s)
+                RETURNING id
+                """,
+                (name, image_url, geom_wkt, source_path, source_type, category_id, cog_path,
+                 psycopg2.extras.Json(stats) if stats else None, content_hash)
+            )
+            dataset_id = cursor.fetchone()[0]
+            # 与插入在同一事务中递增目录版本，使 /api/datasets 的缓存失效
+            bump_catalog_version(cursor)
+            conn.commit()
+        catalog_changed()
+        add_rows_inserted('single', 1)
+        tile_cache.invalidate_dataset(dataset_id)
         print(f"✅ 成功入库: {name} (来源: {source_type})")
+        return dataset_id
     except Exception as e:
         conn.rollback()
         print(f"❌ 数据库插入失败: {name}. 错误: {e}")
         raise
     finally:
         cursor.close()
+
+
+class DatasetBatchWriter:
+    """
+    批量入库：累积数据集行，达到 batch_size 行或距上次写入超过 max_seconds 秒时，
+    用一条多行 INSERT 在单个事务中写入。以 source_path 做 upsert，重复运行入库脚本是幂等的；
+    被更新的行会刷新 created_at，从而使瓦片缓存中的旧版本失效。
+    线程安全，可被多个入库线程共享。用法:
+        with DatasetBatchWriter() as writer:
+            writer.add(name=..., image_url=..., ...)
+        print(writer.stats())
+    """
+
+    UPSERT_SQL = """
+        INSERT INTO datasets (name, image_url, geom, source_path, source_type, category_id, cog_path, stats,
+                              content_hash)
+        VALUES %s
+        ON CONFLICT (source_path) DO UPDATE SET
+            name = EXCLUDED.name,
+            image_url = EXCLUDED.image_url,
+            geom = EXCLUDED.geom,
+            source_type = EXCLUDED.source_type,
+            category_id = EXCLUDED.category_id,
+            cog_path = EXCLUDED.cog_path,
+            stats = EXCLUDED.stats,
+            content_hash = EXCLUDED.content_hash,
+            created_at = CURRENT_TIMESTAMP
+        RETURNING id
+    """
+    ROW_TEMPLATE = "(%s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s, %s, %s, %s)"
+
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, max_seconds=INGEST_BATCH_SECONDS):
+        self.batch_size = batch_size
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._rows = {}  # source_path -> row；同一批次内重复的 source_path 只保留最后一行
+        self._manifest = {}  # source_path -> 清单记录，与数据集行在同一事务中写入
+        self._last_flush = time.monotonic()
+        self._stats = {'rows_written': 0, 'flushes': 0, 'flush_seconds': 0.0}
+
+    def add(self, name, image_url, geom_wkt, source_path, source_type, category_id, cog_path=None,
+            manifest_entry=None, stats=None, content_hash=None):
+        """
+        :param manifest_entry: 可选，manifest.make_entry() 生成的清单记录。
+        :param stats: 可选，波段统计结果。
+        :param content_hash: 可选，文件的 SHA-256。
+        """
+        with self._lock:
+            self._rows[source_path] = (name, image_url, geom_wkt, source_path, source_type, category_id, cog_path,
+                                       psycopg2.extras.Json(stats) if stats else None, content_hash)
+            if manifest_entry is not None:
+                self._manifest[source_path] = manifest_entry
+            due = (len(self._rows) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.max_seconds)
+            if due:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def flush_if_due(self):
+        """距上次写入超过 max_seconds 时写入缓冲区；供长时间运行的调用方在空闲时定期调用。"""
+        with self._lock:
+            if self._rows and time.monotonic() - self._last_flush >= self.max_seconds:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._rows:
+            return
+        rows = list(self._rows.values())
+        start = time.perf_counter()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            with timed('db_batch_insert'):
+                dataset_ids = [r[0] for r in psycopg2.extras.execute_values(
+                    cursor, self.UPSERT_SQL, rows, template=self.ROW_TEMPLATE, page_size=len(rows), fetch=True
+                )]
+                if self._manifest:
+                    psycopg2.extras.execute_values(
+                        cursor, UPSERT_MANIFEST_SQL, list(self._manifest.values()), template=MANIFEST_ROW_TEMPLATE
+                    )
+                # 每个批次只递增一次目录版本，而不是每行一次
+                bump_catalog_version(cursor)
+                conn.commit()
+            catalog_changed()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ 批量入库失败 ({len(rows)} 行): {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        # 只有写入成功后才清空缓冲区；失败的批次保留，由调用方决定是否重试
+        self._rows.clear()
+        self._manifest.clear()
+        for dataset_id in dataset_ids:
+            tile_cache.invalidate_dataset(dataset_id)
+        self._stats['rows_written'] += len(rows)
+        add_rows_inserted('batch', len(rows))
+        self._stats['flushes'] += 1
+        self._stats['flush_seconds'] += time.perf_counter() - start
+        print(f"✅ 批量入库 {len(rows)} 行")
+
+    def stats(self):
+        """返回写入行数、批次数和写入吞吐量 (行/秒，只计算数据库写入耗时)。"""
+        with self._lock:
+            result = dict(self._stats)
+        seconds = result['flush_seconds']
+        result['rows_per_sec'] = result['rows_written'] / seconds if seconds > 0 else 0.0
+        return result
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def find_duplicate_dataset(content_hash, source_path=None):
+    """在其他来源路径下查找内容相同 (SHA-256 相同) 的已入库数据集；没有哈希或未命中时返回 None。"""
+    if not content_hash:
+        return None
+    conn = get_db_connection()
+    try:
+        return find_dataset_by_hash(conn, content_hash, exclude_source_path=source_path)
+    finally:
+        conn.close()
+
+def process_and_insert_geotiff(local_geotiff_path, source_path, category_id, source_type, writer=None,
+                               manifest_entry=None):
+    """
+    入库脚本 (ingest_local.py / ingest_gdrive.py) 使用的一站式处理：
+    生成并上传预览图，然后写入数据库。传入 writer 时交给 DatasetBatchWriter 批量写入。
+    清单记录中带有内容哈希、且相同内容已在别处入库时，复用已有的预览图和元数据，不再渲染。
+    :param local_geotiff_path: 用于读取的本地文件路径。
+    :param source_path: 记录到数据库中的来源路径 (例如 Google Drive 中的完整路径)。
+    :param manifest_entry: 可选的清单记录，仅在使用 writer 时与数据集行一同写入。
+    """
+    content_hash = manifest_entry.get('content_hash') if manifest_entry else None
+    duplicate = find_duplicate_dataset(content_hash, source_path)
+    if duplicate is not None:
+        print(f"♻️ {source_path} 与数据集 #{duplicate['id']} ({duplicate['source_path']}) 内容相同，复用其预览图和元数据")
+        processed_data = {
+            'preview_url': duplicate['image_url'],
+            'wkt_polygon': duplicate['geom_wkt'],
+            'stats': duplicate['stats'],
+        }
+    else:
+        processed_data = process_geotiff_and_upload(local_geotiff_path, content_hash=content_hash)
+    row = dict(
+        name=os.path.splitext(os.path.basename(source_path))[0],
+        image_url=processed_data['preview_url'],
+        geom_wkt=processed_data['wkt_polygon'],
+        source_path=source_path,
+        source_type=source_type,
+        category_id=category_id,
+        cog_path=duplicate['cog_path'] if duplicate else None,
+        stats=processed_data.get('stats'),
+        content_hash=content_hash
+    )
+    if writer is not None:
+        writer.add(manifest_entry=manifest_entry, **row)
+        return None
+
+    conn = get_db_connection()
+    try:
+        return insert_dataset_to_db(conn, **row)
+    finally:
+        conn.close()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+流式栅格统计：按数据块 (或降采样的金字塔条带) 逐块读取，累计有效像素的
+最小值/最大值、均值/标准差以及直方图，内存占用与栅格尺寸无关。
+
+nodata、内部掩膜以及 NaN/Inf 都会被排除，因此一个 -9999 填充值不会再把整幅
+图像的拉伸范围压扁。百分位拉伸 (默认 2%–98%) 由直方图估计，结果在入库时
+保存到 datasets.stats，预览图和瓦片渲染都直接复用，不再重新计算。
+"""
+import os
+import math
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# --- 配置 ---
+# 超过该像素数的栅格改为读取降采样条带 (GDAL 会自动选用金字塔)，而不是遍历全分辨率数据块
+RASTER_STATS_MAX_PIXELS = int(os.environ.get('RASTER_STATS_MAX_PIXELS', 2048 * 2048))
+# 百分位拉伸的下限和上限 (百分比)
+RASTER_STATS_PERCENTILES = tuple(
+    float(p) for p in os.environ.get('RASTER_STATS_PERCENTILES', '2,98').split(',')
+)
+# 直方图的分箱数；百分位的估计误差不超过 (max - min) / HISTOGRAM_BINS 的两倍
+HISTOGRAM_BINS = 4096
+# 每次读取的像素数上限
+STATS_STRIP_PIXELS = 1 << 20
+
+
+class StreamingStats:
+    """
+    可逐块累计的统计量。均值和方差使用 Chan 等人的并行合并公式；
+    直方图的范围随数据扩展，超出时把相邻两个分箱合并、范围加倍，分箱数保持不变。
+    """
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.bins = bins
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.hist = None
+        self.lo = None     # 直方图覆盖 [lo, lo + width]
+        self.width = None
+
+    def update(self, values):
+        """累计一组有效值 (任意形状)；非有限值会被忽略。"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        n = values.size
+        if n == 0:
+            return
+        block_min, block_max = float(values.min()), float(values.max())
+        block_mean = float(values.mean())
+        block_m2 = float(np.square(values - block_mean).sum())
+
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += block_m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = block_min if self.min is None else min(self.min, block_min)
+        self.max = block_max if self.max is None else max(self.max, block_max)
+        self._update_histogram(values, block_min, block_max)
+
+    def _update_histogram(self, values, block_min, block_max):
+        if self.hist is None:
+            self.lo = block_min
+            self.width = (block_max - block_min) or 1.0
+            self.hist = np.zeros(self.bins, dtype=np.int64)
+        while block_min < self.lo:
+            self._grow(downward=True)
+        while block_max > self.lo + self.width:
+            self._grow(downward=False)
+        index = ((values - self.lo) * (self.bins / self.width)).astype(np.int64)
+        np.clip(index, 0, self.bins - 1, out=index)
+        self.hist += np.bincount(index, minlength=self.bins)
+
+    def _grow(self, downward):
+        half = self.bins // 2
+        merged = self.hist.reshape(half, 2).sum(axis=1)
+        hist = np.zeros_like(self.hist)
+        if downward:
+            hist[half:] = merged
+            self.lo -= self.width
+        else:
+            hist[:half] = merged
+        self.width *= 2
+        self.hist = hist
+
+    def percentile(self, p):
+        """由直方图估计第 p 百分位，在分箱内线性插值。"""
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        cumulative = np.cumsum(self.hist)
+        i = min(int(np.searchsorted(cumulative, target, side='left')), self.bins - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        in_bin = self.hist[i]
+        fraction = (target - before) / in_bin if in_bin else 0.0
+        value = self.lo + (i + fraction) * self.width / self.bins
+        return float(min(max(value, self.min), self.max))
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else None
+
+
+def iter_masked_blocks(dataset, band_index=1, max_pixels=RASTER_STATS_MAX_PIXELS):
+    """
+    逐块产出带掩膜的数据 (numpy.ma.MaskedArray)，nodata 和内部掩膜为 masked。
+    像素数不超过 max_pixels 时按数据块高度对齐的整行条带读取全分辨率数据，每次解码的都是完整的块；
+    否则按降采样后的尺寸分条带读取，GDAL 会从最接近的金字塔中取数。
+    """
+    width, height = dataset.width, dataset.height
+    scale = min(1.0, math.sqrt(float(max_pixels) / (width * height)))
+    out_width = max(1, int(round(width * scale)))
+    out_height = max(1, int(round(height * scale)))
+
+    block_rows = dataset.block_shapes[band_index - 1][0] if scale == 1.0 else 1
+    strip_rows = max(1, STATS_STRIP_PIXELS // out_width)
+    strip_rows = max(block_rows, strip_rows - strip_rows % block_rows)
+
+    for out_row in range(0, out_height, strip_rows):
+        rows = min(strip_rows, out_height - out_row)
+        row_start = int(round(out_row * height / out_height))
+        row_stop = int(round((out_row + rows) * height / out_height))
+        window = Window(0, row_start, width, row_stop - row_start)
+        yield dataset.read(band_index, window=window, out_shape=(rows, out_width),
+                           masked=True, resampling=Resampling.nearest)
+
+def compute_band_stats(dataset, band_index=1, max_pixels=RASTER_STATS_MAX_PIXELS,
+                       percentiles=RASTER_STATS_PERCENTILES):
+    """
+    计算单个波段的统计量，返回可直接序列化为 JSON 的字典:
+        count / nodata_count: 参与统计的有效像素数和被排除的像素数 (降采样时为样本数)
+        min / max / mean / std
+        percentiles: {'2': ..., '98': ...}
+        stretch: [下限, 上限]，即 percentiles 指定的拉伸范围；没有有效像素时为 None
+        sampled: 是否基于降采样数据
+    """
+    stats = StreamingStats()
+    total = 0
+    for block in iter_masked_blocks(dataset, band_index, max_pixels):
+        total += block.size
+        stats.update(block.compressed())
+
+    low, high = percentiles
+    result = {
+        'band': band_index,
+        'count': stats.count,
+        'nodata_count': total - stats.count,
+        'min': stats.min,
+        'max': stats.max,
+        'mean': stats.mean if stats.count else None,
+        'std': stats.std,
+        'percentiles': {f"{p:g}": stats.percentile(p) for p in percentiles},
+        'stretch': [stats.percentile(low), stats.percentile(high)] if stats.count else None,
+        'sampled': dataset.width * dataset.height > max_pixels,
+    }
+    return result
+
+def get_stretch_range(stats):
+    """从统计结果中取出拉伸范围；百分位范围退化时退回到 min/max，没有统计信息时返回 (None, None)。"""
+    if not stats:
+        return None, None
+    stretch = stats.get('stretch')
+    if stretch and stretch[1] > stretch[0]:
+        return stretch[0], stretch[1]
+    if stats.get('min') is not None and stats['max'] > stats['min']:
+        return stats['min'], stats['max']
+    return None, None
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+预览图和瓦片共用的渲染器：线性拉伸 → (可选) 色带 → 8 位图像。
+
+- uint8/int8/uint16/int16 (常见的 DEM 和影像类型) 预先为所有可能的像素值计算查找表，
+  拉伸和色带合并成一张表，渲染只需要一次索引 (np.take)，没有浮点运算。
+- 其他类型 (float32/float64/int32 等) 在线程内复用的 float32 缓冲区上原地计算，
+  不再为每个中间结果分配整幅数组。
+- 支持单波段 + 色带 (gray/terrain/slope/hillshade) 以及从任意三个波段合成的
+  真彩色/假彩色 RGB 图像。
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+
+# 色带控制点: (位置 0-1, (R, G, B))
+COLORMAP_STOPS = {
+    'gray': [(0.0, (0, 0, 0)), (1.0, (255, 255, 255))],
+    'terrain': [(0.0, (0, 97, 71)), (0.2, (16, 122, 47)), (0.45, (232, 215, 125)),
+                (0.7, (161, 67, 0)), (0.85, (130, 30, 30)), (1.0, (255, 255, 255))],
+    'slope': [(0.0, (26, 150, 65)), (0.5, (255, 255, 191)), (1.0, (215, 25, 28))],
+    'hillshade': [(0.0, (20, 20, 30)), (0.5, (140, 135, 130)), (1.0, (255, 250, 235))],
+}
+# 可以用查找表渲染的整数类型 (值域不超过 65536)
+LUT_DTYPES = {
+    np.dtype(np.uint8): np.dtype(np.uint8),
+    np.dtype(np.int8): np.dtype(np.uint8),
+    np.dtype(np.uint16): np.dtype(np.uint16),
+    np.dtype(np.int16): np.dtype(np.uint16),
+}
+# 每个线程最多保留的浮点缓冲区数量 (瓦片只有一种尺寸，预览图的尺寸因文件而异)
+SCRATCH_BUFFERS_PER_THREAD = 4
+
+_local = threading.local()
+
+
+def _build_colormap(stops):
+    positions = np.array([p for p, _ in stops])
+    colors = np.array([c for _, c in stops], dtype=np.float64)
+    x = np.linspace(0.0, 1.0, 256)
+    table = np.stack([np.interp(x, positions, colors[:, i]) for i in range(3)], axis=1)
+    return np.round(table).astype(np.uint8)
+
+COLORMAPS = {name: _build_colormap(stops) for name, stops in COLORMAP_STOPS.items()}
+
+
+def _scratch(shape, dtype):
+    """返回当前线程复用的缓冲区 (内容未初始化)。"""
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = OrderedDict()
+    key = (shape, np.dtype(dtype).str)
+    buffer = buffers.get(key)
+    if buffer is None:
+        buffer = buffers[key] = np.empty(shape, dtype)
+        while len(buffers) > SCRATCH_BUFFERS_PER_THREAD:
+            buffers.popitem(last=False)
+    else:
+        buffers.move_to_end(key)
+    return buffer
+
+@lru_cache(maxsize=64)
+def _lookup_table(dtype_str, min_val, max_val, colormap):
+    """为整数类型的所有可能取值计算 拉伸 (+ 色带) 后的输出，按无符号表示索引。"""
+    dtype = np.dtype(dtype_str)
+    index_dtype = LUT_DTYPES[dtype]
+    values = np.arange(2 ** (8 * index_dtype.itemsize), dtype=np.int64).astype(index_dtype).view(dtype)
+    scale = 255.0 / (max_val - min_val) if max_val > min_val else 0.0
+    table = np.clip((values.astype(np.float64) - min_val) * scale, 0, 255).astype(np.uint8)
+    if colormap is not None:
+        table = COLORMAPS[colormap][table]
+    table.setflags(write=False)
+    return table
+
+def scale_to_uint8(band, min_val, max_val, colormap=None, out=None):
+    """
+    把单个波段线性拉伸到 0-255 (超出范围的值截断，NaN 输出 0)，可选再经过色带。
+    :param out: 可选的输出数组，形状为 band.shape (无色带) 或 band.shape + (3,) (有色带)，
+                可以是更大数组的切片，例如 RGBA 图像的某个通道。
+    拉伸范围为 None (例如没有有效像素) 时输出全 0。
+    """
+    band = np.asarray(band)
+    shape = band.shape + ((3,) if colormap is not None else ())
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    if min_val is None or max_val is None:
+        min_val = max_val = 0.0
+    min_val, max_val = float(min_val), float(max_val)
+
+    if band.dtype in LUT_DTYPES:
+        table = _lookup_table(band.dtype.str, min_val, max_val, colormap)
+        np.take(table, band.view(LUT_DTYPES[band.dtype]), axis=0, out=out, mode='clip')
+        return out
+
+    scratch = _scratch(band.shape, np.float32)
+    scale = 255.0 / (max_val - min_val) if max_val > min_val else 0.0
+    np.subtract(band, min_val, out=scratch, casting='unsafe')
+    np.multiply(scratch, scale, out=scratch)
+    # fmax/fmin 会把 NaN 替换为另一个操作数，因此 NaN 被映射为 0，无需额外的掩膜数组
+    np.fmax(scratch, 0.0, out=scratch)
+    np.fmin(scratch, 255.0, out=scratch)
+    if colormap is None:
+        np.copyto(out, scratch, casting='unsafe')
+        return out
+    index = _scratch(band.shape, np.uint8)
+    np.copyto(index, scratch, casting='unsafe')
+    np.take(COLORMAPS[colormap], index, axis=0, out=out, mode='clip')
+    return out
+
+def render_bands(bands, stretches, colormap=None, valid_mask=None):
+    """
+    渲染一个或三个波段，返回 (uint8 数组, PIL 模式)。
+    :param bands: 二维数组的列表；一个波段时可使用色带，三个波段合成 RGB。
+    :param stretches: 每个波段的 (min, max) 拉伸范围。
+    :param colormap: COLORMAPS 中的名称；None 或 'gray' 表示灰度。
+    :param valid_mask: 可选的布尔数组，False 处透明。
+    """
+    if colormap == 'gray':
+        colormap = None
+    if len(bands) not in (1, 3):
+        raise ValueError("只支持 1 个或 3 个波段")
+    if len(bands) == 3 and colormap is not None:
+        raise ValueError("色带只能用于单波段渲染")
+
+    height, width = bands[0].shape
+    color_channels = 3 if (len(bands) == 3 or colormap is not None) else 1
+    channels = color_channels + (1 if valid_mask is not None else 0)
+    out = np.empty((height, width, channels), dtype=np.uint8)
+
+    if len(bands) == 1:
+        target = out[..., :3] if colormap is not None else out[..., 0]
+        scale_to_uint8(bands[0], *stretches[0], colormap=colormap, out=target)
+    else:
+        for i, (band, (min_val, max_val)) in enumerate(zip(bands, stretches)):
+            scale_to_uint8(band, min_val, max_val, out=out[..., i])
+
+    if valid_mask is not None:
+        np.multiply(valid_mask, 255, out=out[..., -1], casting='unsafe')
+
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[channels]
+    if channels == 1:
+        out = out[..., 0]
+    return out, mode
+
+def render_image(bands, stretches, colormap=None, valid_mask=None):
+    """render_bands 的 PIL 版本。"""
+    array, mode = render_bands(bands, stretches, colormap, valid_mask)
+    return Image.fromarray(array, mode)
+
+def parse_render_params(colormap=None, bands=None):
+    """
+    解析并校验渲染参数 (例如来自查询字符串)。
+    :param colormap: 色带名称。
+    :param bands: 逗号分隔的波段序号 (从 1 开始)，一个或三个，例如 "4,3,2"。
+    :return: (colormap 或 None, 波段序号元组)；参数非法时抛出 ValueError。
+    """
+    if colormap in (None, '', 'gray'):
+        colormap = None
+    elif colormap not in COLORMAPS:
+        raise ValueError(f"未知的色带: {colormap}，可选: {', '.join(sorted(COLORMAPS))}")
+
+    if bands in (None, ''):
+        band_indexes = (1,)
+    else:
+        try:
+            band_indexes = tuple(int(b) for b in str(bands).split(','))
+        except ValueError:
+            raise ValueError("bands 必须是逗号分隔的整数，例如 4,3,2")
+        if len(band_indexes) not in (1, 3) or min(band_indexes) < 1:
+            raise ValueError("bands 必须是 1 个或 3 个从 1 开始的波段序号")
+    if len(band_indexes) == 3 and colormap is not None:
+        raise ValueError("色带只能用于单波段渲染")
+    return colormap, band_indexes
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+按点取值和按多边形统计 (/api/sample、/api/zonal)。
+
+覆盖请求位置的数据集由 datasets.geom 上的 GiST 索引查出；每个数据集只读取所需的窗口：
+    - 取值：点坐标转换到数据集的 CRS 和像素坐标后按内部数据块分组，每个块只做一次
+      窗口读取 (窗口为该块内所有点的外接矩形)，上万个点通常只需要少量块读取；
+    - 统计：只读取多边形外接矩形对应的窗口，像素数超过 ZONAL_MAX_PIXELS 时按降采样尺寸
+      读取 (GDAL 会自动选用金字塔)，再用栅格化的多边形掩膜排除多边形之外的像素。
+
+打开的 rasterio 数据集保存在有界的 LRU 句柄缓存中，多个请求之间复用，不再每次重新打开
+(对 /vsis3/ 上的文件可省去一次文件头的往返)。
+"""
+import os
+import json
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError, WindowError
+from rasterio.features import geometry_mask, bounds as geometry_bounds
+from rasterio.transform import Affine
+from rasterio.warp import transform as transform_coords, transform_geom
+from rasterio.windows import Window, from_bounds as window_from_bounds
+
+from db import get_db_connection
+from tiles import resolve_source_uri
+from metrics import timed
+
+# --- 配置 ---
+# 句柄缓存中最多保持打开的数据集数量
+RASTER_HANDLE_CACHE_SIZE = int(os.environ.get('RASTER_HANDLE_CACHE_SIZE', 32))
+# 单次 /api/sample 请求最多的点数
+SAMPLE_MAX_POINTS = int(os.environ.get('SAMPLE_MAX_POINTS', 10000))
+# 单个数据集上按多边形统计时读取的像素数上限，超过时降采样读取
+ZONAL_MAX_PIXELS = int(os.environ.get('ZONAL_MAX_PIXELS', 4096 * 4096))
+ZONAL_DEFAULT_BINS = 32
+ZONAL_MAX_BINS = 1024
+WGS84_CRS = 'EPSG:4326'
+
+
+class RasterHandleCache:
+    """
+    按 (源路径, 金字塔级别) 缓存打开的 rasterio 数据集 (LRU，最多 max_size 个)。
+    rasterio 数据集不能被多个线程同时读取，因此每个句柄带有一把锁，open() 在使用期间持有它。
+    能感知 fork：子进程不会复用父进程打开的句柄。
+    """
+
+    def __init__(self, max_size=RASTER_HANDLE_CACHE_SIZE):
+        self.max_size = max_size
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()  # (src_uri, overview_level) -> (dataset, lock)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @contextmanager
+    def open(self, src_uri, overview_level=None):
+        """
+        借用 src_uri 对应的已打开数据集；同一数据集的并发使用者依次等待。
+        :param overview_level: 可选，以该级金字塔作为数据集打开 (见 rasterio.open)。
+        """
+        if self._pid != os.getpid():
+            self._reset()  # 不关闭继承来的句柄，它们属于父进程
+        key = (src_uri, overview_level)
+        open_kwargs = {} if overview_level is None else {'overview_level': overview_level}
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None:
+                self._handles.move_to_end(key)
+                self._stats['hits'] += 1
+
+        if entry is None:
+            # 在锁外打开，避免阻塞其他数据集的读取；并发打开同一文件时只保留先放入的句柄
+            dataset = rasterio.open(src_uri, **open_kwargs)
+            with self._lock:
+                self._stats['misses'] += 1
+                entry = self._handles.get(key)
+                if entry is None:
+                    entry = self._handles[key] = (dataset, threading.Lock())
+                    dataset = None
+                evicted = self._evict_locked()
+            if dataset is not None:
+                dataset.close()
+            for old_dataset, old_lock in evicted:
+                with old_lock:  # 等待正在使用的请求结束后再关闭
+                    old_dataset.close()
+
+        dataset, lock = entry
+        with lock:
+            if dataset.closed:
+                # 刚被淘汰；用一个临时句柄完成本次读取
+                with rasterio.open(src_uri, **open_kwargs) as fresh:
+                    yield fresh
+            else:
+                yield dataset
+
+    def _evict_locked(self):
+        evicted = []
+        while len(self._handles) > self.max_size:
+            _, entry = self._handles.popitem(last=False)
+            evicted.append(entry)
+            self._stats['evictions'] += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result.update({'open_handles': len(self._handles), 'max_size': self.max_size})
+        return result
+
+
+# 进程内共享的句柄缓存
+raster_handles = RasterHandleCache()
+
+
+# --- 参数解析 ---
+def parse_points(value, max_points=SAMPLE_MAX_POINTS):
+    """把 [[lon, lat], ...] 解析为两个 float64 数组；格式或范围不合法时抛出 ValueError。"""
+    if not isinstance(value, list) or not value:
+        raise ValueError("points 必须是非空的 [[lon, lat], ...] 数组")
+    if len(value) > max_points:
+        raise ValueError(f"单次最多 {max_points} 个点")
+    try:
+        coords = np.array(value, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("points 中的每个点必须是 [lon, lat] 两个数值")
+    if coords.ndim != 2 or coords.shape[1] != 2:
+        raise ValueError("points 中的每个点必须是 [lon, lat] 两个数值")
+    lons, lats = coords[:, 0], coords[:, 1]
+    if not (np.all(np.abs(lons) <= 180) and np.all(np.abs(lats) <= 90)):
+        raise ValueError("points 超出经纬度范围")
+    return lons, lats
+
+def parse_band(value):
+    band = int(value if value is not None else 1)
+    if band < 1:
+        raise ValueError("band 必须是从 1 开始的波段序号")
+    return band
+
+def parse_dataset_ids(value):
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise ValueError("dataset_ids 必须是数组")
+    return [int(v) for v in value]
+
+def _to_python(value):
+    value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+# --- 覆盖查询 ---
+_DATASET_COLUMNS = "d.id, d.name, c.name, d.source_path, d.source_type, d.cog_path"
+
+def _dataset_filters(dataset_ids, category):
+    clauses, params = [], []
+    if dataset_ids:
+        clauses.append("d.id = ANY(%s)")
+        params.append(dataset_ids)
+    if category:
+        clauses.append("c.name = %s")
+        params.append(category)
+    return ''.join(f" AND {clause}" for clause in clauses), params
+
+def _describe(row):
+    dataset_id, name, category, source_path, source_type, cog_path = row
+    return {
+        'dataset_id': dataset_id,
+        'name': name,
+        'category': category,
+        'src_uri': resolve_source_uri(source_path, source_type, cog_path),
+    }
+
+def find_datasets_covering_points(lons, lats, dataset_ids=None, category=None):
+    """返回 {dataset_id: (数据集信息, 点序号数组)}；每个点对应的数据集由 GiST 索引查出。"""
+    extra_sql, extra_params = _dataset_filters(dataset_ids, category)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT p.idx - 1, {_DATASET_COLUMNS}
+            FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS p(lon, lat, idx)
+            JOIN datasets d ON ST_Intersects(d.geom, ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326))
+            JOIN categories c ON d.category_id = c.id
+            WHERE TRUE{extra_sql}
+            """,
+            [lons.tolist(), lats.tolist()] + extra_params
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+
+    datasets, indices = {}, defaultdict(list)
+    for row in rows:
+        dataset_id = row[1]
+        if dataset_id not in datasets:
+            datasets[dataset_id] = _describe(row[1:])
+        indices[dataset_id].append(row[0])
+    return {dataset_id: (datasets[dataset_id], np.array(indices[dataset_id], dtype=np.int64))
+            for dataset_id in datasets}
+
+def find_datasets_covering_geometry(geometry, dataset_ids=None, category=None):
+    """返回与 GeoJSON 几何 (WGS84) 相交的数据集信息列表。"""
+    extra_sql, extra_params = _dataset_filters(dataset_ids, category)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT {_DATASET_COLUMNS}
+            FROM datasets d
+            JOIN categories c ON d.category_id = c.id
+            WHERE ST_Intersects(d.geom, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326)){extra_sql}
+            ORDER BY d.id
+            """,
+            [json.dumps(geometry)] + extra_params
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return [_describe(row) for row in rows]
+
+# --- 按点取值 ---
+def read_point_values(src, lons, lats, band=1):
+    """
+    读取一组 WGS84 点在数据集 src 中的像素值，返回与输入等长的列表 (nodata 或范围外为 None)。
+    点按所在的内部数据块分组，每组只读取一次。
+    """
+    xs, ys = transform_coords(WGS84_CRS, src.crs, lons.tolist(), lats.tolist())
+    cols, rows = ~src.transform * (np.asarray(xs), np.asarray(ys))
+    cols = np.floor(cols).astype(np.int64)
+    rows = np.floor(rows).astype(np.int64)
+    values = [None] * len(lons)
+
+    inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+    if inside.size == 0:
+        return values
+    block_rows, block_cols = src.block_shapes[band - 1]
+    blocks_per_row = (src.width + block_cols - 1) // block_cols
+    block_ids = (rows[inside] // block_rows) * blocks_per_row + cols[inside] // block_cols
+
+    order = np.argsort(block_ids, kind='stable')
+    boundaries = np.flatnonzero(np.diff(block_ids[order])) + 1
+    for group in np.split(inside[order], boundaries):
+        group_rows, group_cols = rows[group], cols[group]
+        row_off, col_off = int(group_rows.min()), int(group_cols.min())
+        window = Window(col_off, row_off, int(group_cols.max()) - col_off + 1, int(group_rows.max()) - row_off + 1)
+        data = src.read(band, window=window, masked=True)
+        picked = data[group_rows - row_off, group_cols - col_off]
+        mask = np.ma.getmaskarray(picked)
+        for i, point_index in enumerate(group):
+            if not mask[i]:
+                values[point_index] = _to_python(picked.data[i])
+    return values
+
+def sample_points(lons, lats, band=1, dataset_ids=None, category=None):
+    """
+    对每个点查询覆盖它的所有数据集并取值。
+    :return: 与输入等长的列表，每项为 {'lon', 'lat', 'values': [{'dataset_id', 'name', 'category', 'value'}]}。
+    """
+    with timed('sample_lookup'):
+        covering = find_datasets_covering_points(lons, lats, dataset_ids, category)
+
+    results = [{'lon': float(lon), 'lat': float(lat), 'values': []} for lon, lat in zip(lons, lats)]
+    for dataset_id in sorted(covering):
+        info, indices = covering[dataset_id]
+        if info['src_uri'] is None:
+            continue  # 源文件在服务端不可读 (例如 Google Drive)
+        try:
+            with timed('sample_read'), raster_handles.open(info['src_uri']) as src:
+                if band > src.count:
+                    continue
+                values = read_point_values(src, lons[indices], lats[indices], band)
+        except RasterioIOError as e:
+            print(f"读取数据集 {dataset_id} 时出错: {e}")
+            continue
+        for point_index, value in zip(indices.tolist(), values):
+            results[point_index]['values'].append({
+                'dataset_id': dataset_id,
+                'name': info['name'],
+                'category': info['category'],
+                'value': value,
+            })
+    return results
+
+
+# --- 按多边形统计 ---
+def parse_geometry(value):
+    """接受 GeoJSON Polygon/MultiPolygon，或包含它们的 Feature。"""
+    if isinstance(value, dict) and value.get('type') == 'Feature':
+        value = value.get('geometry')
+    if not isinstance(value, dict) or value.get('type') not in ('Polygon', 'MultiPolygon'):
+        raise ValueError("geometry 必须是 GeoJSON Polygon 或 MultiPolygon")
+    if not value.get('coordinates'):
+        raise ValueError("geometry 缺少坐标")
+    return value
+
+def zonal_stats(src, geometry, band=1, bins=ZONAL_DEFAULT_BINS, max_pixels=ZONAL_MAX_PIXELS):
+    """
+    统计 WGS84 多边形内数据集 src 第 band 波段的有效像素。只读取多边形外接矩形对应的窗口。
+    :return: {'count', 'min', 'max', 'mean', 'std', 'histogram': {'edges', 'counts'}, 'sampled'}
+    """
+    native_geometry = transform_geom(WGS84_CRS, src.crs, geometry)
+    west, south, east, north = geometry_bounds(native_geometry)
+    window = window_from_bounds(west, south, east, north, transform=src.transform)
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    if window.width < 1 or window.height < 1:
+        # 线状或宽/高为零的多边形没有面积，无法统计
+        raise ValueError("geometry 的外接矩形宽度或高度为零")
+    window = window.intersection(Window(0, 0, src.width, src.height))
+
+    scale = min(1.0, (float(max_pixels) / (window.width * window.height)) ** 0.5)
+    out_shape = (max(1, int(round(window.height * scale))), max(1, int(round(window.width * scale))))
+    data = src.read(band, window=window, out_shape=out_shape, masked=True, resampling=Resampling.nearest)
+
+    # 降采样读取时像素变大，掩膜需要使用对应的仿射变换
+    window_transform = src.window_transform(window) * Affine.scale(
+        window.width / out_shape[1], window.height / out_shape[0])
+    outside = geometry_mask([native_geometry], out_shape=out_shape, transform=window_transform)
+    values = np.ma.array(data, mask=np.ma.getmaskarray(data) | outside).compressed().astype(np.float64)
+    values = values[np.isfinite(values)]
+
+    result = {'count': int(values.size), 'sampled': scale < 1.0}
+    if values.size == 0:
+        result.update({'min': None, 'max': None, 'mean': None, 'std': None, 'histogram': None})
+        return result
+    counts, edges = np.histogram(values, bins=bins)
+    result.update({
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+    })
+    return result
+
+def zonal_summary(geometry, band=1, bins=ZONAL_DEFAULT_BINS, dataset_ids=None, category=None):
+    """对与多边形相交的每个数据集计算统计，返回列表 (每项附带 dataset_id、name、category)。"""
+    if not (1 <= bins <= ZONAL_MAX_BINS):
+        raise ValueError(f"bins 必须在 1 到 {ZONAL_MAX_BINS} 之间")
+    with timed('zonal_lookup'):
+        datasets = find_datasets_covering_geometry(geometry, dataset_ids, category)
+
+    results = []
+    for info in datasets:
+        if info['src_uri'] is None:
+            continue
+        entry = {'dataset_id': info['dataset_id'], 'name': info['name'], 'category': info['category']}
+        try:
+            with timed('zonal_read'), raster_handles.open(info['src_uri']) as src:
+                if band > src.count:
+                    continue
+                entry.update(zonal_stats(src, geometry, band, bins))
+        except (RasterioIOError, WindowError) as e:
+            print(f"统计数据集 {info['dataset_id']} 时出错: {e}")
+            continue
+        results.append(entry)
+    return results
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共配置。
+
+各模块在导入时读取环境变量 (S3 桶名、任务目录等)，因此这里在导入任何被测模块之前先设置好，
+S3 访问由 moto 模拟，不需要真实的 AWS 凭据；需要数据库的部分在各测试中用 monkeypatch 替换。
+
+    cd backend
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+TEST_BUCKET = 'test-geotiff-bucket'
+os.environ.update({
+    'S3_BUCKET_NAME': TEST_BUCKET,
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'JOB_SPOOL_DIR': tempfile.mkdtemp(prefix='geotiff_jobs_test_'),
+    'TILE_CACHE_DIR': tempfile.mkdtemp(prefix='geotiff_tiles_test_'),
+})
+
+
+@pytest.fixture
+def s3():
+    """在 moto 模拟的 S3 中创建测试桶，返回本进程的 S3 客户端。"""
+    moto = pytest.importorskip('moto')
+    import clients
+    with moto.mock_aws():
+        clients.reset_clients()
+        client = clients.get_s3_client()
+        client.create_bucket(Bucket=TEST_BUCKET)
+        yield client
+    clients.reset_clients()
+
+
+@pytest.fixture
+def make_geotiff(tmp_path):
+    """生成一个小的合成 GeoTIFF，返回其路径。"""
+    from benchmark import make_synthetic_geotiff
+
+    def make(name='synthetic.tif', **kwargs):
+        path = str(tmp_path / name)
+        kwargs.setdefault('width', 256)
+        kwargs.setdefault('height', 256)
+        kwargs.setdefault('blocksize', 128)
+        make_synthetic_geotiff(path, **kwargs)
+        return path
+    return make
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""db.ConnectionPool 的测试 (使用桩连接，不访问数据库)。"""
+import threading
+
+import psycopg2
+
+from db import ConnectionPool
+
+
+class FakeConnection:
+    """SELECT 1 会阻塞到 release 被设置；healthy=False 时随后抛出 OperationalError。"""
+
+    def __init__(self, release=None, healthy=True):
+        self.release = release
+        self.healthy = healthy
+        self.closed = 0
+        self.checking = threading.Event()
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.checking.set()
+        if self.release is not None:
+            self.release.wait(10)
+        if not self.healthy:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def test_health_check_does_not_block_other_checkouts():
+    release = threading.Event()
+    stale = FakeConnection(release, healthy=False)
+    pool = ConnectionPool(maxconn=2, timeout=5, healthcheck_idle=0, connect=FakeConnection)
+    pool._idle.append((stale, 0.0))
+    pool._size = 1
+
+    result = {}
+    checker = threading.Thread(target=lambda: result.setdefault('checker', pool.getconn()))
+    checker.start()
+    assert stale.checking.wait(5)
+    # 第一个线程卡在失联连接的 SELECT 1 上时，其他线程仍能借出 (新建) 连接
+    other = threading.Thread(target=lambda: result.setdefault('other', pool.getconn()))
+    other.start()
+    other.join(2)
+    assert not other.is_alive() and result['other'] is not stale
+    release.set()
+    checker.join(10)
+
+    assert result['checker'] is not stale and stale.closed
+    stats = pool.stats()
+    assert stats['healthcheck_failures'] == 1
+    assert stats['connections_discarded'] == 1
+    assert stats['size'] == 2 and stats['in_use'] == 2
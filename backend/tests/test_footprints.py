@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""footprints 聚合网格的行为测试；SQL 部分只检查传给数据库的语句和参数 (数据库连接用桩对象替换)。"""
+import math
+
+import pytest
+
+import footprints
+
+HALF_EXTENT = footprints.WEB_MERCATOR_EXTENT / 2
+
+
+def snap_to_grid(value, origin, cell):
+    """与 PostGIS ST_SnapToGrid(geom, origin, origin, cell, cell) 相同的吸附规则。"""
+    return math.floor((value - origin) / cell + 0.5) * cell + origin
+
+
+def tile_index(value, z):
+    return math.floor((value + HALF_EXTENT) / (footprints.WEB_MERCATOR_EXTENT / 2 ** z))
+
+
+@pytest.mark.parametrize('z', [0, 1, 6])
+def test_cluster_cell_size_divides_tile(z):
+    cell = footprints.cluster_cell_size(z, grid=32)
+    tile = footprints.WEB_MERCATOR_EXTENT / 2 ** z
+    assert cell * 32 == pytest.approx(tile)
+    assert footprints.cluster_cell_size(z + 1, grid=32) == pytest.approx(cell / 2)
+
+
+@pytest.mark.parametrize('z', [0, 3, 6])
+def test_snapped_points_are_cell_centres_in_the_same_tile(z):
+    cell = footprints.cluster_cell_size(z, grid=8)
+    origin = footprints.cluster_grid_origin(cell)
+    tile = footprints.WEB_MERCATOR_EXTENT / 2 ** z
+    # 包括紧贴瓦片边界两侧的点：吸附到单元角点时它们会落到相邻瓦片的边界上
+    boundaries = [-HALF_EXTENT + k * tile for k in range(min(2 ** z, 4) + 1)]
+    values = [b + offset for b in boundaries for offset in (-cell * 0.49, -1e-3, 1e-3, cell * 0.49)]
+    values = [v for v in values if -HALF_EXTENT < v < HALF_EXTENT]
+    for value in values:
+        snapped = snap_to_grid(value, origin, cell)
+        # 单元中心与单元左下角相差半个单元
+        assert (snapped + HALF_EXTENT) / cell % 1 == pytest.approx(0.5)
+        assert abs(snapped - value) <= cell / 2 + 1e-6
+        assert tile_index(snapped, z) == tile_index(value, z)
+
+
+class RecordingConnection:
+    def __init__(self, result):
+        self.result = result
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def fetchone(self):
+        return (self.result,)
+
+    def close(self):
+        pass
+
+
+def test_low_zoom_tiles_use_cluster_query(monkeypatch):
+    conn = RecordingConnection(memoryview(b'mvt'))
+    monkeypatch.setattr(footprints, 'get_db_connection', lambda: conn)
+
+    assert footprints.get_footprint_tile(footprints.FOOTPRINT_CLUSTER_MAX_ZOOM, 1, 2) == b'mvt'
+    sql, params = conn.executed[0]
+    assert sql is footprints.CLUSTER_SQL
+    assert params['origin'] == footprints.cluster_grid_origin(params['cell'])
+
+
+def test_high_zoom_tiles_clip_to_mercator_range(monkeypatch):
+    conn = RecordingConnection(None)
+    monkeypatch.setattr(footprints, 'get_db_connection', lambda: conn)
+
+    assert footprints.get_footprint_tile(footprints.FOOTPRINT_CLUSTER_MAX_ZOOM + 1, 0, 0) == b''
+    sql, params = conn.executed[0]
+    assert sql is footprints.FOOTPRINT_SQL
+    assert f"ST_Transform(ST_ClipByBox2D(d.geom, {footprints.MERCATOR_CLIP_BOX}), 3857)" in sql
+    assert params['limit'] == footprints.FOOTPRINT_MAX_FEATURES
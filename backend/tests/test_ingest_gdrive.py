@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""通过 service_factory 注入桩 Drive 客户端，测试 ingest_gdrive.run_gdrive_ingest 的遍历、分页和并发入库。"""
+import re
+import threading
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import httplib2  # noqa: E402
+import ingest_gdrive  # noqa: E402
+import processing  # noqa: E402
+from test_ingest_s3 import CATEGORIES, FakeConnection, FakeManifest, FakeWriter  # noqa: E402
+
+FOLDER = ingest_gdrive.FOLDER_MIME_TYPE
+
+
+class StubRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class StubMediaRequest:
+    """MediaIoBaseDownload 需要的最小请求对象：uri、headers 和按 Range 头返回数据的 http。"""
+
+    def __init__(self, content):
+        self.uri = 'https://stub.invalid/download'
+        self.headers = {}
+        self.http = self
+        self.content = content
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', headers['range']).groups())
+        chunk = self.content[start:end + 1]
+        response = httplib2.Response({
+            'status': 206,
+            'content-range': f"bytes {start}-{start + len(chunk) - 1}/{len(self.content)}",
+        })
+        return response, chunk
+
+
+class StubBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class StubFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, pageToken=None, **kwargs):
+        parents = re.findall(r"'([^']+)' in parents", q)
+        matches = [item for item in self.drive.items if set(item['parents']) & set(parents)]
+        # 每页只返回两个条目，确保调用方会跟随 nextPageToken
+        start = int(pageToken or 0)
+        response = {'files': matches[start:start + 2]}
+        if start + 2 < len(matches):
+            response['nextPageToken'] = str(start + 2)
+        with self.drive.lock:
+            self.drive.list_calls += 1
+        return StubRequest(response)
+
+    def get(self, fileId, **kwargs):
+        item = self.drive.by_id[fileId]
+        return StubRequest({key: item[key] for key in ('id', 'name', 'parents') if key in item})
+
+    def get_media(self, fileId, **kwargs):
+        return StubMediaRequest(self.drive.contents[fileId])
+
+
+class StubDrive:
+    """一棵内存中的 Drive 文件夹树，所有线程共享 (每个线程各自拿到一个 StubService)。"""
+
+    def __init__(self):
+        self.items = []
+        self.by_id = {'root': {'id': 'root', 'name': 'Survey'}}
+        self.contents = {}
+        self.lock = threading.Lock()
+        self.list_calls = 0
+        self.services = 0
+
+    def add(self, item_id, name, parent, mime_type='image/tiff', content=None):
+        item = {'id': item_id, 'name': name, 'mimeType': mime_type, 'parents': [parent]}
+        if content is not None:
+            self.contents[item_id] = content
+            item['size'] = str(len(content))
+            item['md5Checksum'] = f"md5-{item_id}"
+        self.items.append(item)
+        self.by_id[item_id] = item
+        return item
+
+    def service_factory(self):
+        with self.lock:
+            self.services += 1
+        return StubService(self)
+
+
+class StubService:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return StubFiles(self.drive)
+
+    def new_batch_http_request(self, callback):
+        return StubBatch(callback)
+
+
+@pytest.fixture
+def drive(make_geotiff):
+    def read(name, seed):
+        with open(make_geotiff(name, seed=seed), 'rb') as f:
+            return f.read()
+
+    drive = StubDrive()
+    drive.add('dem', 'DEM', 'root', FOLDER)
+    drive.add('misc', 'Misc', 'root', FOLDER)
+    drive.add('slope', 'Slope', 'misc', FOLDER)
+    drive.add('a', 'a.tif', 'dem', content=read('a.tif', 1))
+    drive.add('b', 'b.tif', 'dem', content=read('b.tif', 2))
+    drive.add('c', 'c.tif', 'slope', content=read('c.tif', 3))
+    drive.add('broken', 'broken.tif', 'slope', content=b'not a tiff')
+    drive.add('notes', 'notes.txt', 'dem', mime_type='text/plain')
+    return drive
+
+
+def test_run_gdrive_ingest_with_stub_service(s3, drive, tmp_path, monkeypatch):
+    fake_manifest = FakeManifest(legacy_keys={'Survey/DEM/b.tif'})
+    monkeypatch.setattr(ingest_gdrive.manifest, 'lookup', fake_manifest.lookup)
+    monkeypatch.setattr(ingest_gdrive.manifest, 'record', fake_manifest.record)
+    monkeypatch.setattr(processing, 'find_duplicate_dataset', lambda content_hash, source_path=None: None)
+    download_dir = tmp_path / 'downloads'
+    download_dir.mkdir()
+    monkeypatch.setattr(ingest_gdrive, 'DOWNLOAD_DIR', str(download_dir))
+    writer = FakeWriter(fake_manifest)
+    path_cache = {}
+
+    stats = ingest_gdrive.run_gdrive_ingest(drive.service_factory, FakeConnection(), writer, CATEGORIES,
+                                            'root', path_cache, download_workers=2, chunk_size=64 * 1024)
+
+    assert stats == {'listed': 4, 'skipped': 1, 'succeeded': 2, 'failed': 1}
+    rows = {row['source_path']: row for row in writer.rows}
+    assert set(rows) == {'Survey/DEM/a.tif', 'Survey/Misc/Slope/c.tif'}
+    assert rows['Survey/DEM/a.tif']['category_id'] == 1
+    assert rows['Survey/Misc/Slope/c.tif']['category_id'] == 2
+    for row in rows.values():
+        assert row['source_type'] == 'GOOGLE_DRIVE'
+        assert len(row['content_hash']) == 64
+        assert row['manifest_entry']['etag'].startswith('md5-')
+    assert 'Survey/DEM/b.tif' in fake_manifest.adopted
+    # 逐层遍历：根目录一页，第二层两个文件夹合并查询共两页，第三层一页
+    assert drive.list_calls == 4
+    # 每个下载线程各自创建客户端，遍历线程另有一个
+    assert 1 < drive.services <= 3
+    assert path_cache == {'root': 'Survey', 'dem': 'Survey/DEM', 'misc': 'Survey/Misc', 'slope': 'Survey/Misc/Slope'}
+    assert list(download_dir.iterdir()) == []  # 下载的临时文件都已删除
+
+    # 第二次运行全部未变化，不再下载
+    writer = FakeWriter(fake_manifest)
+    stats = ingest_gdrive.run_gdrive_ingest(drive.service_factory, FakeConnection(), writer, CATEGORIES,
+                                            'root', path_cache, download_workers=2)
+    assert stats == {'listed': 4, 'skipped': 3, 'succeeded': 0, 'failed': 1}
+    assert writer.rows == []
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""ingest_local.watch 常驻监控循环的容错测试 (数据库、文件监控和处理函数均用桩对象替换)。"""
+import os
+
+import psycopg2
+import pytest
+
+import ingest_local
+import manifest
+
+
+class FakeConnection:
+    def __init__(self, opened):
+        self.discarded = False
+        opened.append(self)
+
+    def discard(self):
+        self.discarded = True
+
+    def close(self):
+        pass
+
+
+class FakeWatcher:
+    """第一次 poll 报告给定文件，之后空转，poll 满 ticks 次后模拟 Ctrl+C。"""
+
+    def __init__(self, paths, ticks):
+        self.paths = paths
+        self.ticks = ticks
+
+    def poll(self, timeout):
+        self.ticks -= 1
+        if self.ticks < 0:
+            raise KeyboardInterrupt
+        paths, self.paths = self.paths, []
+        return paths
+
+    def close(self):
+        pass
+
+
+class ImmediateTracker:
+    """touch 过的文件在下一次 pop_stable 时立即返回，不做去抖。"""
+
+    def __init__(self):
+        self.pending = set()
+
+    def touch(self, path):
+        self.pending.add(path)
+
+    def pop_stable(self):
+        ready, self.pending = self.pending, set()
+        return [(path, os.stat(path)) for path in ready]
+
+
+@pytest.fixture
+def watch_env(tmp_path, monkeypatch):
+    path = tmp_path / 'dem.tif'
+    path.write_bytes(b'tiff')
+    opened, ingested = [], []
+    monkeypatch.setattr(ingest_local, 'WATCH_RETRY_SECONDS', 0)
+    monkeypatch.setattr(ingest_local, 'get_db_connection', lambda: FakeConnection(opened))
+    monkeypatch.setattr(ingest_local, 'get_categories', lambda conn: {'其他': 1})
+    monkeypatch.setattr(ingest_local, 'assign_category_by_filepath', lambda filepath, categories: 1)
+    monkeypatch.setattr(ingest_local, 'scan_changed_files', lambda conn, folder, stats: iter(()))
+    monkeypatch.setattr(ingest_local, 'create_watcher',
+                        lambda folder, use_polling=False: FakeWatcher([str(path)], ticks=5))
+    monkeypatch.setattr(ingest_local, 'StableFileTracker', ImmediateTracker)
+    monkeypatch.setattr(ingest_local, 'ingest_file',
+                        lambda file_path, category_id, writer, entry: ingested.append(file_path))
+    return str(path), opened, ingested
+
+
+def test_watch_survives_database_error_and_retries_file(watch_env, monkeypatch):
+    path, opened, ingested = watch_env
+    failures = [psycopg2.OperationalError("server closed the connection unexpectedly")]
+
+    def lookup(conn, source_type, keys):
+        if failures:
+            raise failures.pop()
+        return {key: None for key in keys}
+    monkeypatch.setattr(manifest, 'lookup', lookup)
+
+    ingest_local.watch(os.path.dirname(path), workers=1)
+
+    # 出错的连接被丢弃并换成新连接，出错那一轮的文件在下一轮重新比对后入库
+    assert len(opened) == 2
+    assert opened[0].discarded and not opened[1].discarded
+    assert ingested == [path]
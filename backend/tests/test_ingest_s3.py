@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""ingest_s3.run_concurrent_ingest 在 moto 模拟的 S3 上的端到端测试 (数据库部分用内存替身)。"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import ingest_s3
+
+CATEGORIES = {'数字高程模型 (DEM)': 1, '坡度分析': 2, '遥感影像': 3, '其他': 4}
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+class FakeManifest:
+    """内存中的 ingest_manifest：lookup 返回与 manifest.lookup 相同结构的行。"""
+
+    def __init__(self, legacy_keys=()):
+        self.rows = {}
+        self.legacy_keys = set(legacy_keys)  # 只在 datasets 中、没有清单记录的旧数据
+        self.adopted = []
+
+    def lookup(self, conn, source_type, keys):
+        result = {}
+        for key in keys:
+            row = self.rows.get(key)
+            if row is not None:
+                result[key] = dict(row, in_manifest=True, in_catalog=True)
+            elif key in self.legacy_keys:
+                result[key] = {'size': None, 'mtime': None, 'etag': None, 'content_hash': None,
+                               'in_manifest': False, 'in_catalog': True}
+        return result
+
+    def record(self, conn, entries):
+        for entry in entries:
+            self.adopted.append(entry['source_key'])
+            self.rows[entry['source_key']] = entry
+
+
+class FakeWriter:
+    """代替 DatasetBatchWriter：记录入库的行，并像真实写入器一样写入清单。"""
+
+    def __init__(self, fake_manifest):
+        self.rows = []
+        self.fake_manifest = fake_manifest
+        self._lock = threading.Lock()
+
+    def add(self, **row):
+        with self._lock:
+            self.rows.append(row)
+            if row['manifest_entry'] is not None:
+                self.fake_manifest.record(None, [row['manifest_entry']])
+
+
+class InlineProcessPool(ThreadPoolExecutor):
+    """用线程代替 spawn 进程池：spawn 出的子进程看不到本进程中的 moto 模拟。"""
+
+    def __init__(self, max_workers=None, mp_context=None):
+        super().__init__(max_workers=max_workers)
+
+
+@pytest.fixture
+def fake_manifest(monkeypatch):
+    fake = FakeManifest(legacy_keys={'geotiffs/dem/legacy.tif'})
+    monkeypatch.setattr(ingest_s3.manifest, 'lookup', fake.lookup)
+    monkeypatch.setattr(ingest_s3.manifest, 'record', fake.record)
+    monkeypatch.setattr(ingest_s3, 'get_db_connection', FakeConnection)
+    monkeypatch.setattr(ingest_s3, 'find_duplicate_dataset', lambda content_hash, s3_key=None: None)
+    monkeypatch.setattr(ingest_s3, 'ProcessPoolExecutor', InlineProcessPool)
+    return fake
+
+
+def upload(s3, key, path):
+    with open(path, 'rb') as f:
+        s3.put_object(Bucket=ingest_s3.S3_BUCKET_NAME, Key=key, Body=f.read())
+
+
+def run(writer):
+    return ingest_s3.run_concurrent_ingest(writer, CATEGORIES, download_workers=2,
+                                           process_workers=1, queue_size=2, in_place=False)
+
+
+def test_concurrent_ingest_processes_new_objects(s3, fake_manifest, make_geotiff):
+    upload(s3, 'geotiffs/dem/a.tif', make_geotiff('a.tif', seed=1))
+    upload(s3, 'geotiffs/slope/b.tif', make_geotiff('b.tif', seed=2))
+    upload(s3, 'geotiffs/dem/legacy.tif', make_geotiff('legacy.tif', seed=3))
+    s3.put_object(Bucket=ingest_s3.S3_BUCKET_NAME, Key='geotiffs/dem/broken.tif', Body=b'not a tiff')
+    s3.put_object(Bucket=ingest_s3.S3_BUCKET_NAME, Key='geotiffs/readme.txt', Body=b'ignored')
+    writer = FakeWriter(fake_manifest)
+
+    succeeded, failed, transfer, listing = run(writer)
+
+    assert succeeded == 2
+    assert [key for key, _ in failed] == ['geotiffs/dem/broken.tif']
+    assert listing == {'complete': True, 'skipped': 1}
+    assert fake_manifest.adopted[0] == 'geotiffs/dem/legacy.tif'
+    assert transfer['bytes_transferred'] == transfer['source_bytes'] > 0
+
+    rows = {row['source_path']: row for row in writer.rows}
+    assert set(rows) == {'geotiffs/dem/a.tif', 'geotiffs/slope/b.tif'}
+    assert rows['geotiffs/dem/a.tif']['category_id'] == 1
+    assert rows['geotiffs/slope/b.tif']['category_id'] == 2
+    for row in rows.values():
+        assert row['source_type'] == 'S3'
+        assert row['geom_wkt'].startswith('POLYGON((')
+        assert row['manifest_entry']['content_hash'] == row['content_hash']
+        preview_key = row['image_url'].split('.amazonaws.com/', 1)[1]
+        s3.head_object(Bucket=ingest_s3.S3_BUCKET_NAME, Key=preview_key)
+
+
+def test_rerun_picks_up_keys_sorting_before_processed_ones(s3, fake_manifest, make_geotiff):
+    upload(s3, 'geotiffs/dem/m.tif', make_geotiff('m.tif', seed=4))
+    assert run(FakeWriter(fake_manifest))[0] == 1
+
+    # 新对象在字典序上排在已处理的对象之前，也必须被列举到
+    upload(s3, 'geotiffs/dem/0-early.tif', make_geotiff('early.tif', seed=5))
+    writer = FakeWriter(fake_manifest)
+    succeeded, failed, _, listing = run(writer)
+
+    assert (succeeded, failed) == (1, [])
+    assert [row['source_path'] for row in writer.rows] == ['geotiffs/dem/0-early.tif']
+    assert listing == {'complete': True, 'skipped': 1}
+
+
+def test_cog_normalize_reports_downloaded_size(tmp_path, monkeypatch):
+    source = tmp_path / 'dem.tif'
+    source.write_bytes(b'x' * 1000)
+    cog = tmp_path / 'dem.cog.tif'
+    cog.write_bytes(b'y' * 3000)
+    monkeypatch.setattr(ingest_s3, 'COG_NORMALIZE', True)
+    monkeypatch.setattr(ingest_s3, 'normalize_and_upload_cog',
+                        lambda path, s3_key: (str(cog), 'cogs/dem.tif'))
+    monkeypatch.setattr(ingest_s3, 'process_geotiff_and_upload',
+                        lambda path, content_hash=None: {'rendered': path})
+
+    result = ingest_s3.render_s3_object(str(source), 'geotiffs/dem.tif')
+    assert result['rendered'] == str(cog)
+    # 传输量是下载的对象大小，而不是本地生成的 COG 的大小
+    assert result['bytes_transferred'] == result['source_bytes'] == 1000
+    assert result['cog_key'] == 'cogs/dem.tif'
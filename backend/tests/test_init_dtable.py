@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""init_dtable.create_source_path_index 的测试 (数据库连接用桩对象替换)。"""
+import init_dtable
+
+
+class RecordingConnection:
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        self.executed = []
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.duplicates
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+def test_unique_index_is_created_without_duplicates():
+    conn = RecordingConnection(duplicates=[])
+    assert init_dtable.create_source_path_index(conn) is True
+    assert 'CREATE UNIQUE INDEX IF NOT EXISTS idx_source_path_unique' in conn.executed[-1]
+    assert conn.commits == 1
+
+
+def test_duplicate_source_paths_are_reported_instead_of_indexed(capsys):
+    conn = RecordingConnection(duplicates=[('/data/a.tif', [3, 7])])
+    assert init_dtable.create_source_path_index(conn) is False
+    assert not any('CREATE UNIQUE INDEX' in sql for sql in conn.executed)
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+    assert '/data/a.tif: dataset ids [3, 7]' in capsys.readouterr().out
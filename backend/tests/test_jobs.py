@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""jobs.py 任务队列的测试：独立 worker 进程的指标经由 Web 进程的 /metrics 导出，以及失败任务的保留与重试。"""
+import os
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import jobs
+import metrics
+
+
+def probe_handler(payload, report):
+    report('probing', 0.5)
+    with metrics.timed('probe_stage'):
+        time.sleep(0.01)
+    metrics.add_bytes_written('probe_target', payload['nbytes'])
+    return {'ok': True}
+
+
+def run_one_job_in_worker():
+    """在独立进程中运行 worker_loop，处理完一个任务后退出。"""
+    stop = threading.Event()
+
+    def handler(payload, report):
+        try:
+            return probe_handler(payload, report)
+        finally:
+            stop.set()
+    jobs.JOB_HANDLERS['probe'] = handler
+    jobs.worker_loop(stop, export_metrics=True)
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    # spawn 出的 worker 进程在导入 jobs 时从环境变量读取 spool 目录
+    monkeypatch.setenv('JOB_SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(jobs, 'JOB_SPOOL_DIR', str(tmp_path))
+    return tmp_path
+
+
+def test_worker_process_stage_timings_reach_web_metrics(spool_dir):
+    job_id = jobs.enqueue_job(jobs.new_job_id(), 'probe', {'nbytes': 4321})
+
+    process = multiprocessing.get_context('spawn').Process(target=run_one_job_in_worker)
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'succeeded'
+    assert 'probe_stage' in job['timings']['stages']
+
+    # 本进程没有执行任务，导出的指标全部来自 worker 进程的快照
+    assert 'probe_stage' not in metrics.render_prometheus()
+    text = metrics.render_prometheus(jobs.load_worker_metrics())
+    assert 'geotiff_stage_seconds_count{stage="probe_stage"} 1' in text
+    assert 'geotiff_bytes_written_total{target="probe_target"} 4321' in text
+    assert 'geotiff_jobs_total{kind="probe",status="succeeded"} 1' in text
+
+
+def test_snapshots_from_several_workers_are_summed(spool_dir):
+    snapshot = {
+        'histograms': [['stage_seconds', [['stage', 'cog']], {
+            'buckets': [0] * (len(metrics.STAGE_BUCKETS) - 1) + [1], 'sum': 400.0, 'count': 1}]],
+        'counters': [['rows_inserted_total', [['mode', 'single']], 2]],
+    }
+    text = metrics.render_prometheus([snapshot, snapshot])
+    assert 'geotiff_stage_seconds_count{stage="cog"} 2' in text
+    assert 'geotiff_stage_seconds_sum{stage="cog"} 800.0' in text
+    assert 'geotiff_rows_inserted_total{mode="single"} 4' in text
+
+
+def test_prune_removes_snapshots_of_exited_workers(spool_dir):
+    jobs.export_worker_metrics()
+    dead = spool_dir / 'metrics' / '999999999.json'
+    dead.write_text('{}')
+
+    jobs.prune_worker_metrics()
+    assert sorted(p.name for p in (spool_dir / 'metrics').iterdir()) == [f"{os.getpid()}.json"]
+
+
+@pytest.fixture
+def upload_job(spool_dir, monkeypatch):
+    """一个已落盘的上传任务；渲染结果和数据库写入由测试替换。"""
+    monkeypatch.setattr(jobs, 'find_duplicate_dataset', lambda content_hash: None)
+    job_id = jobs.new_job_id()
+    path = jobs.spool_file_path(job_id, 'dem.tif')
+    with open(path, 'wb') as f:
+        f.write(b'tiff')
+    jobs.enqueue_job(job_id, 'upload', {'path': path, 'filename': 'dem.tif', 's3_key': 'geotiffs/dem.tif'})
+    return job_id, path
+
+
+def test_failed_upload_job_keeps_spool_file_and_can_be_retried(upload_job, monkeypatch):
+    job_id, path = upload_job
+
+    def fail(render_path, content_hash=None):
+        raise RuntimeError("渲染失败")
+    monkeypatch.setattr(jobs, 'process_geotiff_and_upload', fail)
+
+    jobs.run_job(jobs.claim_next_job())
+    assert jobs.get_job(job_id)['status'] == 'failed'
+    assert os.path.exists(path)
+    assert jobs.claim_next_job() is None
+
+    assert jobs.retry_failed_jobs() == 1
+    assert jobs.get_job(job_id)['status'] == 'queued'
+    assert jobs.claim_next_job()['id'] == job_id
+
+
+def test_succeeded_upload_job_removes_spool_file(upload_job, monkeypatch):
+    job_id, path = upload_job
+
+    class Connection:
+        def close(self):
+            pass
+    monkeypatch.setattr(jobs, 'process_geotiff_and_upload', lambda render_path, content_hash=None: {
+        'preview_url': 'https://example.invalid/p.png', 'wkt_polygon': 'POLYGON((0 0,1 0,1 1,0 0))', 'stats': None})
+    monkeypatch.setattr(jobs, 'get_db_connection', Connection)
+    monkeypatch.setattr(jobs, 'insert_dataset_to_db', lambda conn, **row: 42)
+
+    jobs.run_job(jobs.claim_next_job())
+    assert jobs.get_job(job_id)['result']['dataset_id'] == 42
+    assert not os.path.exists(path)
+    assert jobs.retry_failed_jobs() == 0
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""mosaic.render_mosaic 的参数校验和合成行为测试 (数据集查询用 monkeypatch 替换)。"""
+import pytest
+import rasterio
+
+import mosaic
+
+
+@pytest.fixture
+def no_db(monkeypatch):
+    def find_mosaic_datasets(bbox, category=None, ordering='first'):
+        raise AssertionError("bbox 不合法时不应查询数据库")
+    monkeypatch.setattr(mosaic, 'find_mosaic_datasets', find_mosaic_datasets)
+
+
+@pytest.mark.parametrize('bbox', [
+    (10.0, 0.0, 10.0, 1.0),    # 宽度为零
+    (170.0, 0.0, -170.0, 1.0),  # 跨越 180° 经线
+    (0.0, 5.0, 1.0, 4.0),      # south > north
+    (0.0, 5.0, 1.0, 5.0),      # 高度为零
+])
+def test_render_mosaic_rejects_invalid_bbox_before_querying(no_db, bbox):
+    with pytest.raises(ValueError):
+        mosaic.render_mosaic(bbox, 64, 64)
+
+
+@pytest.mark.parametrize('width, height', [(0, 10), (10, mosaic.MOSAIC_MAX_SIZE + 1), (-1, -1)])
+def test_parse_mosaic_size_rejects_out_of_range(width, height):
+    with pytest.raises(ValueError):
+        mosaic.parse_mosaic_size(width, height)
+
+
+def test_parse_ordering():
+    assert mosaic.parse_ordering(None) == 'first'
+    assert mosaic.parse_ordering('MEAN') == 'mean'
+    with pytest.raises(ValueError):
+        mosaic.parse_ordering('max')
+
+
+def test_render_mosaic_without_datasets_is_transparent(monkeypatch):
+    monkeypatch.setattr(mosaic, 'find_mosaic_datasets', lambda bbox, category=None, ordering='first': ([], False))
+    img, used, truncated = mosaic.render_mosaic((0.0, 0.0, 1.0, 1.0), 32, 16)
+    assert (used, truncated) == (0, False)
+    assert img.size == (32, 16)
+    assert img.getextrema()[1] == (0, 0)  # alpha 全为 0
+
+
+def test_render_mosaic_composites_local_dataset(monkeypatch, make_geotiff):
+    path = make_geotiff()
+    with rasterio.open(path) as src:
+        bounds = tuple(src.bounds)
+    datasets = [{'id': 1, 'src_uri': path, 'stats': None},
+                {'id': 2, 'src_uri': '/nonexistent/missing.tif', 'stats': None}]
+    monkeypatch.setattr(mosaic, 'find_mosaic_datasets', lambda bbox, category=None, ordering='first': (datasets, True))
+
+    img, used, truncated = mosaic.render_mosaic(bounds, 64, 64)
+    assert used == 1  # 无法读取的数据集被跳过
+    assert truncated is True
+    assert img.size == (64, 64)
+
+
+class RecordingConnection:
+    """记录执行的 SQL，返回 id 为 1..count 的数据集中按 SQL 排序并截取 LIMIT 行的结果。"""
+
+    def __init__(self, count):
+        self.count = count
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+        ids = range(self.count, 0, -1) if 'ORDER BY d.id DESC' in sql else range(1, self.count + 1)
+        self.rows = [(i, f"/data/{i}.tif", 'LOCAL', None, None) for i in ids][:params[-1]]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('ordering, order_by, expected_ids', [
+    ('first', 'ORDER BY d.id LIMIT', [1, 2, 3]),
+    ('mean', 'ORDER BY d.id LIMIT', [1, 2, 3]),
+    ('last', 'ORDER BY d.id DESC LIMIT', [3, 4, 5]),
+])
+def test_find_mosaic_datasets_keeps_datasets_matching_ordering(monkeypatch, ordering, order_by, expected_ids):
+    conn = RecordingConnection(count=5)
+    monkeypatch.setattr(mosaic, 'get_db_connection', lambda: conn)
+    monkeypatch.setattr(mosaic, 'resolve_source_uri', lambda source_path, source_type, cog_path: source_path)
+
+    datasets, truncated = mosaic.find_mosaic_datasets((0, 0, 1, 1), ordering=ordering, limit=3)
+
+    sql, params = conn.executed[0]
+    assert order_by in sql
+    assert params[-1] == 4  # 多取一行用于判断截断
+    assert truncated is True
+    # 无论保留哪些数据集，交给合成器时都按 id 升序
+    assert [d['id'] for d in datasets] == expected_ids
+
+
+def test_find_mosaic_datasets_not_truncated_within_limit(monkeypatch):
+    conn = RecordingConnection(count=3)
+    monkeypatch.setattr(mosaic, 'get_db_connection', lambda: conn)
+    monkeypatch.setattr(mosaic, 'resolve_source_uri', lambda source_path, source_type, cog_path: source_path)
+
+    datasets, truncated = mosaic.find_mosaic_datasets((0, 0, 1, 1), ordering='last', limit=3)
+    assert truncated is False
+    assert [d['id'] for d in datasets] == [1, 2, 3]
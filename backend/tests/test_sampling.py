@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""sampling.parse_points / zonal_stats 的行为测试 (只使用本地合成栅格，不访问数据库)。"""
+import numpy as np
+import pytest
+import rasterio
+from rasterio.errors import WindowError
+
+import sampling
+
+
+def box(west, south, east, north):
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def test_parse_points_returns_lon_lat_arrays():
+    lons, lats = sampling.parse_points([[116.4, 39.9], [-180, -90], [180, 90]])
+    assert lons.tolist() == [116.4, -180.0, 180.0]
+    assert lats.tolist() == [39.9, -90.0, 90.0]
+
+
+@pytest.mark.parametrize('value', [
+    [],
+    None,
+    [[1.0]],
+    [[1.0, 2.0, 3.0]],
+    [['a', 2.0]],
+    [[181.0, 0.0]],
+    [[0.0, -90.5]],
+])
+def test_parse_points_rejects_invalid_input(value):
+    with pytest.raises(ValueError):
+        sampling.parse_points(value)
+
+
+def test_parse_points_enforces_max_points():
+    with pytest.raises(ValueError):
+        sampling.parse_points([[0.0, 0.0]] * 3, max_points=2)
+
+
+def test_zonal_stats_over_whole_raster_matches_numpy(make_geotiff):
+    with rasterio.open(make_geotiff()) as src:
+        expected = src.read(1).astype(np.float64)
+        result = sampling.zonal_stats(src, box(*src.bounds), bins=4)
+
+    assert result['count'] == expected.size
+    assert result['sampled'] is False
+    assert result['min'] == pytest.approx(expected.min())
+    assert result['max'] == pytest.approx(expected.max())
+    assert result['mean'] == pytest.approx(expected.mean())
+    assert sum(result['histogram']['counts']) == expected.size
+    assert len(result['histogram']['edges']) == 5
+
+
+def test_zonal_stats_only_counts_pixels_inside_polygon(make_geotiff):
+    with rasterio.open(make_geotiff()) as src:
+        west, south, east, north = src.bounds
+        # 左半部分
+        result = sampling.zonal_stats(src, box(west, south, (west + east) / 2, north))
+        assert result['count'] == src.width * src.height // 2
+
+        # 完全落在栅格之外的多边形由 zonal_summary 捕获 WindowError 后跳过该数据集
+        with pytest.raises(WindowError):
+            sampling.zonal_stats(src, box(east + 1, south, east + 2, north))
+
+
+def test_zonal_stats_downsamples_large_windows(make_geotiff):
+    with rasterio.open(make_geotiff()) as src:
+        result = sampling.zonal_stats(src, box(*src.bounds), max_pixels=64 * 64)
+    assert result['sampled'] is True
+    assert result['count'] <= 64 * 64
+
+
+def test_zonal_stats_rejects_zero_area_polygon(make_geotiff):
+    with rasterio.open(make_geotiff()) as src:
+        west, south, east, north = src.bounds
+        middle = (west + east) / 2
+        with pytest.raises(ValueError):
+            sampling.zonal_stats(src, box(middle, south, middle, north))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""tile_cache.TileCache 磁盘层的占用统计测试。"""
+from tile_cache import TileCache
+
+
+def test_overwriting_disk_entry_counts_only_the_new_size(tmp_path):
+    cache = TileCache(memory_bytes=0, disk_bytes=1000, cache_dir=str(tmp_path))
+    key = cache.make_key(1, 3, 4, 5)
+    other = cache.make_key(2, 3, 4, 5)
+
+    cache._put_disk(key, b'x' * 100)  # 首次写入时扫描磁盘层
+    cache._put_disk(other, b'y' * 100)
+    for _ in range(5):
+        cache._put_disk(key, b'z' * 120)
+
+    assert cache.stats()['disk_bytes'] == 220
+    assert cache.stats()['disk_evictions'] == 0
+    assert cache.get(key) == b'z' * 120
+    assert cache.get(other) == b'y' * 100
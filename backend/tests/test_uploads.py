@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""uploads.py 分块上传协议的测试 (S3 由 moto 模拟)。"""
+import io
+import os
+import time
+
+import pytest
+
+import jobs
+import uploads
+from uploads import UploadError
+
+PART_SIZE = uploads.UPLOAD_PART_SIZE
+
+
+@pytest.fixture
+def no_duplicates(monkeypatch):
+    monkeypatch.setattr(uploads, 'find_duplicate_dataset', lambda content_hash: None)
+
+
+@pytest.fixture
+def session(s3, no_duplicates):
+    data = os.urandom(PART_SIZE + 100)
+    return uploads.create_upload('dem.tif', len(data)), data
+
+
+def part_bytes(data, part_number):
+    return data[(part_number - 1) * PART_SIZE:part_number * PART_SIZE]
+
+
+def put(upload_id, part_number, payload, content_length=None):
+    return uploads.put_part(upload_id, part_number, io.BytesIO(payload),
+                            len(payload) if content_length is None else content_length)
+
+
+def test_create_upload_splits_into_parts(session):
+    created, data = session
+    assert created['part_count'] == 2
+    assert created['status'] == 'uploading'
+    assert uploads.describe_upload(created['upload_id'])['parts_missing'] == [1, 2]
+
+
+@pytest.mark.parametrize('part_number', [0, 3])
+def test_put_part_rejects_out_of_range_part_number(session, part_number):
+    created, data = session
+    with pytest.raises(UploadError) as excinfo:
+        put(created['upload_id'], part_number, b'x')
+    assert excinfo.value.status == 400
+
+
+def test_put_part_rejects_wrong_length(session):
+    created, data = session
+    with pytest.raises(UploadError) as excinfo:
+        put(created['upload_id'], 2, part_bytes(data, 2), content_length=99)
+    assert excinfo.value.status == 400
+
+
+def test_put_part_rejects_truncated_stream(session):
+    created, data = session
+    with pytest.raises(UploadError) as excinfo:
+        put(created['upload_id'], 2, part_bytes(data, 2)[:50], content_length=100)
+    assert excinfo.value.status == 400
+    assert uploads.describe_upload(created['upload_id'])['parts_received'] == []
+
+
+def test_last_part_completes_upload_and_late_part_is_rejected(s3, session):
+    created, data = session
+    upload_id = created['upload_id']
+
+    first = put(upload_id, 2, part_bytes(data, 2))
+    assert 'job_id' not in first
+    result = put(upload_id, 1, part_bytes(data, 1))
+    assert result['status_url'] == f"/api/jobs/{result['job_id']}"
+
+    stored = s3.get_object(Bucket=uploads.S3_BUCKET_NAME, Key=created['s3_key'])['Body'].read()
+    assert stored == data
+    assert jobs.get_job(result['job_id'])['status'] == 'queued'
+
+    with pytest.raises(UploadError) as excinfo:
+        put(upload_id, 2, part_bytes(data, 2))
+    assert excinfo.value.status == 409
+    assert uploads.complete_upload(upload_id) == {'job_id': result['job_id'], 'status_url': result['status_url']}
+
+
+def test_complete_upload_reports_missing_parts(session):
+    created, data = session
+    put(created['upload_id'], 1, part_bytes(data, 1))
+    with pytest.raises(UploadError) as excinfo:
+        uploads.complete_upload(created['upload_id'])
+    assert excinfo.value.status == 409
+
+
+def test_part_is_rejected_once_completion_has_started(session):
+    created, data = session
+    upload_id = created['upload_id']
+    put(upload_id, 1, part_bytes(data, 1))
+    data_path = uploads._upload_path(upload_id, '.data')
+    with open(data_path, 'rb') as f:
+        before = f.read()
+
+    # 另一个请求已创建完成标记、正在计算哈希
+    assert uploads._claim_marker(upload_id)
+    with pytest.raises(UploadError) as excinfo:
+        put(upload_id, 1, os.urandom(PART_SIZE))
+    assert excinfo.value.status == 409
+    with open(data_path, 'rb') as f:
+        assert f.read() == before
+
+
+def test_part_after_data_was_moved_is_a_conflict(session):
+    created, data = session
+    os.remove(uploads._upload_path(created['upload_id'], '.data'))
+    with pytest.raises(UploadError) as excinfo:
+        put(created['upload_id'], 1, part_bytes(data, 1))
+    assert excinfo.value.status == 409
+
+
+def test_expire_uploads_aborts_idle_sessions(s3, session):
+    created, data = session
+    upload_id = created['upload_id']
+    put(upload_id, 1, part_bytes(data, 1))
+
+    assert uploads.expire_uploads(ttl=3600) == 0
+    assert uploads.describe_upload(upload_id)['parts_received'] == [1]
+
+    assert uploads.expire_uploads(ttl=3600, now=time.time() + 3601) >= 1
+    with pytest.raises(UploadError) as excinfo:
+        uploads.describe_upload(upload_id)
+    assert excinfo.value.status == 404
+    assert not os.path.exists(uploads._upload_path(upload_id, '.data'))
+    pending = s3.list_multipart_uploads(Bucket=uploads.S3_BUCKET_NAME).get('Uploads', [])
+    assert created['s3_upload_id'] not in [u['UploadId'] for u in pending]
+
+
+def test_expire_uploads_forgets_old_completed_sessions(session):
+    created, data = session
+    upload_id = created['upload_id']
+    put(upload_id, 1, part_bytes(data, 1))
+    put(upload_id, 2, part_bytes(data, 2))
+
+    uploads.expire_uploads(ttl=3600, now=time.time() + 3601)
+    assert not os.path.exists(uploads._upload_path(upload_id, '.json'))
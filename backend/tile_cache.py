@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+渲染结果的两级缓存：进程内按字节预算淘汰的 LRU 内存层 + 多进程共享、
+按总大小淘汰的磁盘层 (backend/static/tile_cache/)。
+
+缓存键为 (数据集 ID, z/x/y, 渲染参数, 数据集版本)。数据集版本变化后旧键
+自然失效；invalidate_dataset() 会同时清理该数据集在两级缓存中的全部条目。
+"""
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- 配置 ---
+TILE_CACHE_MEMORY_BYTES = int(os.environ.get('TILE_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+TILE_CACHE_DISK_BYTES = int(os.environ.get('TILE_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+TILE_CACHE_DIR = os.environ.get(
+    'TILE_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'tile_cache')
+)
+# 磁盘层超出上限后清理到上限的这个比例，避免每次写入都触发扫描
+DISK_EVICT_TARGET_RATIO = 0.9
+
+
+def params_digest(params):
+    """将渲染参数字典转换为稳定的短摘要，用作缓存键的一部分。"""
+    if not params:
+        return 'default'
+    text = '&'.join(f"{k}={params[k]}" for k in sorted(params))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+class TileCache:
+    """线程安全的两级瓦片缓存。值为已编码的图像字节。"""
+
+    def __init__(self, memory_bytes=TILE_CACHE_MEMORY_BYTES, disk_bytes=TILE_CACHE_DISK_BYTES,
+                 cache_dir=TILE_CACHE_DIR):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        # 磁盘层的总大小在首次写入时扫描一次，之后按本进程的写入和删除增量估算
+        self._disk_used = None
+        # 同一时间只有一个线程在锁外扫描和清理磁盘层
+        self._disk_evicting = False
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'invalidations': 0,
+        }
+
+    # --- 键与路径 ---
+    @staticmethod
+    def make_key(dataset_id, z, x, y, params=None, version=0):
+        return (str(dataset_id), int(z), int(x), int(y), params_digest(params), str(version))
+
+    def _disk_path(self, key):
+        dataset_id, z, x, y, digest, version = key
+        return os.path.join(self.cache_dir, dataset_id, version, digest, str(z), str(x), f"{y}.bin")
+
+    # --- 读写接口 ---
+    def get(self, key):
+        """先查内存层，再查磁盘层 (命中后回填内存层)；未命中返回 None。"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return data
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        """写入两级缓存。磁盘写入采用临时文件 + 原子替换，多进程并发写入同一键是安全的。"""
+        with self._lock:
+            self._put_memory(key, data)
+        if self.disk_bytes > 0:
+            self._put_disk(key, data)
+
+    def invalidate_dataset(self, dataset_id):
+        """清除某个数据集所有版本、所有渲染参数下的缓存条目。"""
+        dataset_id = str(dataset_id)
+        with self._lock:
+            stale = [k for k in self._memory if k[0] == dataset_id]
+            for k in stale:
+                self._memory_used -= len(self._memory.pop(k))
+            self._stats['invalidations'] += 1
+
+        # 只扫描该数据集的目录，在锁外删除，按删除的字节数调整磁盘层占用
+        dataset_dir = os.path.join(self.cache_dir, dataset_id)
+        removed = sum(size for _, size, _ in self._snapshot_disk(dataset_dir))
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used = max(0, self._disk_used - removed)
+
+    def stats(self):
+        """返回命中/未命中/淘汰计数以及两级缓存的当前占用，用于评估缓存容量。"""
+        with self._lock:
+            result = dict(self._stats)
+            result.update({
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_used,
+                'memory_budget_bytes': self.memory_bytes,
+                'disk_bytes': self._disk_used,
+                'disk_budget_bytes': self.disk_bytes,
+            })
+        return result
+
+    # --- 内部实现 ---
+    def _put_memory(self, key, data):
+        """调用方需持有 self._lock。"""
+        size = len(data)
+        if size > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+        self._memory[key] = data
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+            self._stats['memory_evictions'] += 1
+
+    def _put_disk(self, key, data):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            # 覆盖已有的文件时只增加两者的差值，否则 _disk_used 会逐渐偏大、过早触发清理
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"瓦片缓存写入磁盘失败: {e}")
+            return
+
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used = max(0, self._disk_used + len(data) - replaced)
+                if self._disk_used <= self.disk_bytes:
+                    return
+            if self._disk_evicting:
+                return
+            self._disk_evicting = True
+            base = self._disk_used
+        try:
+            self._evict_disk(base)
+        finally:
+            with self._lock:
+                self._disk_evicting = False
+
+    @staticmethod
+    def _snapshot_disk(directory):
+        """返回 directory 下全部文件的 [(mtime, 大小, 路径)]。不持锁调用。"""
+        entries = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict_disk(self, base):
+        """
+        扫描磁盘层，超出上限时按修改时间从旧到新删除文件，直到总大小降到上限的 DISK_EVICT_TARGET_RATIO 以下。
+        扫描和删除都在锁外进行，内存层的读写不会被阻塞；只在最后更新计数时持锁。
+        :param base: 开始扫描时的 _disk_used，用于保留扫描期间其他线程的写入增量。
+        """
+        entries = sorted(self._snapshot_disk(self.cache_dir))
+        total = sum(size for _, size, _ in entries)
+        removed = evicted = 0
+        if total > self.disk_bytes:
+            target = self.disk_bytes * DISK_EVICT_TARGET_RATIO
+            for _, size, path in entries:
+                if total - removed <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += size
+                evicted += 1
+
+        with self._lock:
+            written_meanwhile = self._disk_used - base if base is not None and self._disk_used is not None else 0
+            self._disk_used = total - removed + written_meanwhile
+            self._stats['disk_evictions'] += evicted
+
+
+# 进程内共享的缓存实例
+tile_cache = TileCache()
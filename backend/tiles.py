@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+动态 XYZ 瓦片渲染：将源栅格按需重投影到 Web Mercator (EPSG:3857)，
+每个瓦片只做一次窗口化读取，只触及该瓦片覆盖到的数据块。
+"""
+import os
+from functools import lru_cache
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds, calculate_default_transform
+from PIL import Image
+
+from render import render_bands
+from raster_stats import compute_band_stats, get_stretch_range
+
+# --- 配置 ---
+S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+TILE_SIZE = 256
+WEB_MERCATOR_CRS = 'EPSG:3857'
+# Web Mercator 投影的半周长 (米)
+WEB_MERCATOR_HALF_EXTENT = 20037508.342789244
+# 可以直接按需读取的来源类型；GOOGLE_DRIVE 等来源在服务端没有可读的源文件
+TILEABLE_SOURCE_TYPES = ('S3', 'S3_UPLOAD', 'LOCAL')
+# 没有保存统计信息的波段在瓦片请求中只做粗略估计，最多读取这么多像素 (通常来自最粗一级金字塔)；
+# 旧数据集的完整统计由 backfill_stats.py 计算并写入数据库
+TILE_FALLBACK_STATS_PIXELS = int(os.environ.get('TILE_FALLBACK_STATS_PIXELS', 256 * 256))
+
+
+# --- 瓦片坐标计算 ---
+def tile_bounds(z, x, y):
+    """返回 XYZ 瓦片在 EPSG:3857 下的范围 (west, south, east, north)。"""
+    tile_span = 2 * WEB_MERCATOR_HALF_EXTENT / (2 ** z)
+    west = -WEB_MERCATOR_HALF_EXTENT + x * tile_span
+    north = WEB_MERCATOR_HALF_EXTENT - y * tile_span
+    return west, north - tile_span, west + tile_span, north
+
+def is_valid_tile(z, x, y):
+    """检查瓦片坐标是否在该缩放级别的合法范围内。"""
+    return 0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def resolve_source_uri(source_path, source_type, cog_path=None):
+    """
+    将数据库中的 source_path 转换为 rasterio 可以打开的路径。入库时生成了 COG 的
+    数据集优先读取 COG。S3 对象通过 GDAL 的 /vsis3/ 虚拟文件系统按范围请求读取；
+    无法读取时返回 None。
+    """
+    if cog_path:
+        return f"/vsis3/{S3_BUCKET_NAME}/{cog_path}"
+    if not source_path or source_type not in TILEABLE_SOURCE_TYPES:
+        return None
+    if source_type == 'LOCAL':
+        return source_path if os.path.exists(source_path) else None
+    return f"/vsis3/{S3_BUCKET_NAME}/{source_path}"
+
+
+# --- 源数据信息 (每个进程内缓存) ---
+@lru_cache(maxsize=256)
+def get_source_info(src_uri):
+    """
+    读取并缓存瓦片渲染所需的源数据信息：Web Mercator 范围、原生分辨率和金字塔倍数。
+    """
+    with rasterio.open(src_uri) as src:
+        merc_bounds = transform_bounds(src.crs, WEB_MERCATOR_CRS, *src.bounds)
+        merc_transform, _, _ = calculate_default_transform(
+            src.crs, WEB_MERCATOR_CRS, src.width, src.height, *src.bounds
+        )
+        return {
+            'merc_bounds': merc_bounds,
+            'native_res': merc_transform.a,
+            'overviews': tuple(src.overviews(1)),
+        }
+
+@lru_cache(maxsize=256)
+def get_fallback_stretch(src_uri, band_index=1):
+    """
+    没有保存统计信息的波段 (未回填的旧数据集或合成用的其他波段)：按不超过 TILE_FALLBACK_STATS_PIXELS
+    的降采样数据估计拉伸范围并在进程内缓存。有金字塔时直接读取最粗一级，不会在瓦片请求中遍历整个波段。
+    """
+    overviews = get_source_info(src_uri)['overviews']
+    open_kwargs = {'overview_level': len(overviews) - 1} if overviews else {}
+    with rasterio.open(src_uri, **open_kwargs) as src:
+        return get_stretch_range(compute_band_stats(src, band_index, max_pixels=TILE_FALLBACK_STATS_PIXELS))
+
+def _pick_overview_level(info, tile_res):
+    """选择分辨率不高于瓦片分辨率的最粗一级金字塔；返回 None 表示读取原始分辨率。"""
+    level = None
+    for i, factor in enumerate(info['overviews']):
+        if info['native_res'] * factor <= tile_res:
+            level = i
+    return level
+
+def _intersects(a, b):
+    return a[0] < b[2] and a[2] > b[0] and a[1] < b[3] and a[3] > b[1]
+
+
+# --- 瓦片渲染 ---
+def render_tile(src_uri, z, x, y, tile_size=TILE_SIZE, stats=None, colormap=None, bands=(1,)):
+    """
+    渲染一个 XYZ 瓦片并返回 PIL Image (LA/RGBA 模式，透明处为无数据)。
+    瓦片与数据范围不相交时返回 None。
+    :param stats: 入库时保存的波段 1 统计；按其中的拉伸范围渲染，与预览图的色调保持一致。
+    :param colormap: 单波段使用的色带 (见 render.COLORMAPS)。
+    :param bands: 一个或三个波段序号，三个时合成 RGB。源数据波段不足时抛出 ValueError。
+    """
+    info = get_source_info(src_uri)
+    bounds = tile_bounds(z, x, y)
+    if not _intersects(bounds, info['merc_bounds']):
+        return None
+
+    tile_res = (bounds[2] - bounds[0]) / tile_size
+    open_kwargs = {}
+    overview_level = _pick_overview_level(info, tile_res)
+    if overview_level is not None:
+        open_kwargs['overview_level'] = overview_level
+
+    with rasterio.open(src_uri, **open_kwargs) as src:
+        with WarpedVRT(
+            src,
+            crs=WEB_MERCATOR_CRS,
+            transform=from_bounds(*bounds, tile_size, tile_size),
+            width=tile_size,
+            height=tile_size,
+            resampling=Resampling.bilinear,
+            add_alpha=True,
+        ) as vrt:
+            # add_alpha 生成的 alpha 波段位于最后，标记瓦片中落在数据范围之外的像素
+            if max(bands) >= vrt.count:
+                raise ValueError(f"数据集只有 {vrt.count - 1} 个波段")
+            data = vrt.read(list(bands) + [vrt.count])
+
+    stretches = [
+        get_stretch_range(stats) if (band_index == 1 and stats) else get_fallback_stretch(src_uri, band_index)
+        for band_index in bands
+    ]
+    array, mode = render_bands(list(data[:-1]), stretches, colormap, valid_mask=data[-1] > 0)
+    return Image.fromarray(array, mode)
+
+def empty_tile(tile_size=TILE_SIZE):
+    """全透明瓦片，用于数据范围之外的请求。"""
+    return Image.new('LA', (tile_size, tile_size))
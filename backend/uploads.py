@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+分块、可续传的大文件上传。单个 multipart 表单 POST 会受到代理请求体大小的限制，
+断线后也只能从头再来；这里把文件切成固定大小的分块逐个上传:
+
+    POST   /api/uploads                  {"filename": ..., "size": 字节数}
+                                         -> upload_id、part_size、part_count
+    PUT    /api/uploads/<id>/parts/<n>   请求体为第 n 块 (从 1 开始) 的原始字节
+    GET    /api/uploads/<id>             已收到的分块列表，断线后据此只补传缺失的块
+    POST   /api/uploads/<id>/complete    (可选) 最后一块到达时会自动完成
+    DELETE /api/uploads/<id>             放弃上传
+
+每个分块一边接收一边写入本地 spool 文件的对应位置，接收完后作为 S3 multipart upload
+的同一编号分块上传，因此存档副本不需要在全部接收后再整体上传一遍；客户端可以并发
+发送多个分块，让接收和向 S3 发送重叠进行。所有分块到齐后立即完成 S3 上传并把
+本地文件交给上传任务队列 (jobs.py) 处理。
+
+分块可能乱序到达，因此内容哈希在所有分块到齐后对本地文件顺序计算一次 (刚写入的数据
+通常仍在页缓存中)。相同内容已入库时中止 S3 上传、不再入队，响应中 duplicate 为 true
+(见 dedup.py)。
+
+会话状态保存在任务 spool 目录下，多个 gunicorn worker 之间共享:
+    <spool>/uploads/<id>.json        会话信息
+    <spool>/uploads/<id>.data        按偏移写入的文件内容
+    <spool>/uploads/<id>.parts/<n>   每个已完成分块的 ETag
+    <spool>/uploads/<id>.complete    完成标记 (O_EXCL 创建，保证只完成一次)
+    <spool>/uploads/<id>.lock        flock 锁：写入分块时持共享锁，创建完成标记时持排他锁，
+                                     因此完成标记创建后 (文件已开始计算哈希) 不会再有分块写入
+
+超过 UPLOAD_SESSION_TTL 没有活动的未完成会话由 expire_uploads() 中止 (删除稀疏的本地文件并
+中止 S3 multipart upload)；create_upload() 每隔 UPLOAD_SWEEP_INTERVAL 顺带执行一次。
+已完成会话的状态文件同样在 TTL 之后删除。
+
+本地测试时可设置 AWS_ENDPOINT_URL 指向 MinIO 或 moto server 等兼容 S3 的服务。
+"""
+import os
+import re
+import math
+import time
+import uuid
+import base64
+import shutil
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+from processing import S3_BUCKET_NAME, find_duplicate_dataset
+from clients import get_s3_client
+from dedup import describe_duplicate
+from manifest import hash_file
+from jobs import (
+    JOB_SPOOL_DIR, S3_SOURCE_PREFIX, new_job_id, spool_file_path, enqueue_job, write_json, read_json
+)
+
+# --- 配置 ---
+# 分块大小；S3 要求除最后一块外每块至少 5MB，且最多 10000 块
+UPLOAD_PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get('UPLOAD_PART_SIZE', 16 * 1024 * 1024)))
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 100 * 1024 ** 3))
+S3_MAX_PARTS = 10000
+# 未完成的会话超过该时间 (秒) 没有新的分块即视为放弃
+UPLOAD_SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+# create_upload() 顺带清理过期会话的最小间隔 (秒)
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get('UPLOAD_SWEEP_INTERVAL', 3600))
+UPLOAD_READ_CHUNK = 1024 * 1024
+
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """上传请求无效；status 为建议返回的 HTTP 状态码。"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# --- 会话存储 ---
+def _upload_path(upload_id, suffix):
+    directory = os.path.join(JOB_SPOOL_DIR, 'uploads')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{upload_id}{suffix}")
+
+def _load_session(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id or ''):
+        raise UploadError("上传不存在", 404)
+    session = read_json(_upload_path(upload_id, '.json'))
+    if session is None:
+        raise UploadError("上传不存在", 404)
+    return session
+
+@contextmanager
+def _session_lock(upload_id, exclusive=False):
+    """跨进程的会话锁 (flock)：put_part 持共享锁写入分块，完成或中止时持排他锁创建完成标记。"""
+    with open(_upload_path(upload_id, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _claim_marker(upload_id):
+    """在排他锁下创建完成标记；已存在时返回 False。此后 put_part 不会再写入 .data。"""
+    with _session_lock(upload_id, exclusive=True):
+        try:
+            os.close(os.open(_upload_path(upload_id, '.complete'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+    return True
+
+def _received_parts(upload_id):
+    """返回 {分块编号: 分块状态}。"""
+    parts_dir = _upload_path(upload_id, '.parts')
+    try:
+        names = os.listdir(parts_dir)
+    except OSError:
+        return {}
+    parts = {}
+    for name in names:
+        if name.isdigit():
+            state = read_json(os.path.join(parts_dir, name))
+            if state is not None:
+                parts[int(name)] = state
+    return parts
+
+def _part_length(session, part_number):
+    if part_number < session['part_count']:
+        return session['part_size']
+    return session['size'] - session['part_size'] * (session['part_count'] - 1)
+
+def describe_upload(upload_id):
+    """返回会话信息和已收到的分块编号 (用于续传)。"""
+    session = _load_session(upload_id)
+    received = sorted(_received_parts(upload_id))
+    missing = [n for n in range(1, session['part_count'] + 1) if n not in set(received)]
+    return dict(session, parts_received=received, parts_missing=missing)
+
+
+# --- 协议 ---
+def create_upload(filename, size):
+    """开始一个分块上传：创建 S3 multipart upload 和本地 spool 文件。"""
+    filename = os.path.basename(filename or '')
+    if not filename:
+        raise UploadError("缺少文件名")
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError("size 必须是正整数 (字节)")
+    if size > UPLOAD_MAX_SIZE:
+        raise UploadError(f"文件过大，上限为 {UPLOAD_MAX_SIZE} 字节", 413)
+
+    _maybe_expire_uploads()
+    part_size = max(UPLOAD_PART_SIZE, math.ceil(size / S3_MAX_PARTS))
+    upload_id = uuid.uuid4().hex
+    s3_key = f"{S3_SOURCE_PREFIX}{uuid.uuid4()}_{filename}"
+    response = get_s3_client().create_multipart_upload(Bucket=S3_BUCKET_NAME, Key=s3_key, ContentType='image/tiff')
+
+    with open(_upload_path(upload_id, '.data'), 'wb') as f:
+        f.truncate(size)  # 稀疏文件，分块可以按任意顺序写入
+    os.makedirs(_upload_path(upload_id, '.parts'), exist_ok=True)
+    session = {
+        'upload_id': upload_id,
+        'filename': filename,
+        'size': size,
+        'part_size': part_size,
+        'part_count': max(1, math.ceil(size / part_size)),
+        's3_key': s3_key,
+        's3_upload_id': response['UploadId'],
+        'status': 'uploading',
+        'job_id': None,
+        'created_at': time.time(),
+    }
+    write_json(_upload_path(upload_id, '.json'), session)
+    return session
+
+def put_part(upload_id, part_number, stream, content_length=None):
+    """
+    接收一个分块：边读边写入本地文件的对应偏移，然后作为 S3 分块上传。
+    同一分块可以重复上传 (后一次覆盖前一次)。所有分块到齐时自动完成上传并入队处理。
+    :return: {'part_number', 'etag'}；自动完成时还包含 complete_upload() 的结果。
+    """
+    if _load_session(upload_id)['status'] != 'uploading':
+        raise UploadError("上传已完成", 409)
+    with _session_lock(upload_id):
+        # 持锁后重新读取：等锁期间上传可能已经完成或被中止
+        session = _load_session(upload_id)
+        if session['status'] != 'uploading':
+            raise UploadError("上传已完成", 409)
+        if os.path.exists(_upload_path(upload_id, '.complete')):
+            raise UploadError("上传正在完成或已取消，不再接收分块", 409)
+        if not 1 <= part_number <= session['part_count']:
+            raise UploadError(f"分块编号必须在 1 到 {session['part_count']} 之间")
+        expected = _part_length(session, part_number)
+        if content_length is not None and content_length != expected:
+            raise UploadError(f"第 {part_number} 块应为 {expected} 字节，收到 {content_length} 字节")
+
+        # 1. 流式写入本地 spool 文件，同时保留一份内存副本用于上传 S3 (内存占用为一个分块)
+        buffer = bytearray()
+        md5 = hashlib.md5()
+        try:
+            with open(_upload_path(upload_id, '.data'), 'r+b') as f:
+                f.seek((part_number - 1) * session['part_size'])
+                while len(buffer) < expected:
+                    chunk = stream.read(min(UPLOAD_READ_CHUNK, expected - len(buffer)))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    md5.update(chunk)
+                    buffer += chunk
+        except FileNotFoundError:
+            raise UploadError("上传已完成或已取消，不再接收分块", 409)
+        if len(buffer) != expected:
+            raise UploadError(f"第 {part_number} 块不完整 ({len(buffer)}/{expected} 字节)，请重新上传该块")
+
+        # 2. 作为 S3 multipart upload 的同一编号分块上传，由 S3 校验 MD5
+        response = get_s3_client().upload_part(
+            Bucket=S3_BUCKET_NAME,
+            Key=session['s3_key'],
+            UploadId=session['s3_upload_id'],
+            PartNumber=part_number,
+            Body=bytes(buffer),
+            ContentMD5=base64.b64encode(md5.digest()).decode('ascii'),
+        )
+        write_json(os.path.join(_upload_path(upload_id, '.parts'), str(part_number)),
+                   {'etag': response['ETag'], 'size': expected})
+
+    result = {'part_number': part_number, 'etag': response['ETag']}
+    # 3. 最后一块到达后立即完成，不必等客户端再发 complete 请求
+    if len(_received_parts(upload_id)) == session['part_count']:
+        outcome = _try_complete(upload_id)
+        if outcome is not None:
+            result.update(outcome)
+    return result
+
+def complete_upload(upload_id):
+    """
+    完成上传并入队处理 (幂等)。
+    :return: {'job_id', 'status_url'}；内容已入库时为 dedup.describe_duplicate() 的结果。
+    """
+    session = _load_session(upload_id)
+    if session['status'] == 'completed':
+        return _job_info(session['job_id'])
+    if session['status'] == 'duplicate':
+        return session['duplicate']
+    missing = describe_upload(upload_id)['parts_missing']
+    if missing:
+        raise UploadError(f"缺少分块: {missing[:20]}", 409)
+    job = _try_complete(upload_id)
+    if job is None:
+        raise UploadError("上传正在由另一个请求完成，请稍后查询", 409)
+    return job
+
+def abort_upload(upload_id):
+    """放弃上传：中止 S3 multipart upload 并删除本地文件。"""
+    session = _load_session(upload_id)
+    if session['status'] != 'uploading' or not _claim_marker(upload_id):
+        raise UploadError("上传已完成，无法取消", 409)
+    try:
+        get_s3_client().abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=session['s3_key'],
+                                         UploadId=session['s3_upload_id'])
+    finally:
+        _cleanup(upload_id, keep_session=False)
+
+def expire_uploads(ttl=UPLOAD_SESSION_TTL, now=None):
+    """
+    中止超过 ttl 秒没有活动的未完成上传，并删除超过 ttl 的已完成会话的状态文件。
+    :return: 中止的未完成上传数量
+    """
+    now = time.time() if now is None else now
+    directory = os.path.dirname(_upload_path('x', ''))
+    expired = 0
+    for name in os.listdir(directory):
+        upload_id, ext = os.path.splitext(name)
+        if ext != '.json' or not UPLOAD_ID_PATTERN.match(upload_id):
+            continue
+        session = read_json(os.path.join(directory, name))
+        if session is None:
+            continue
+        # 最近一次活动：会话创建/更新、分块写入 (.data) 或分块记录 (.parts)
+        last_active = 0.0
+        for suffix in ('.json', '.data', '.parts'):
+            try:
+                last_active = max(last_active, os.path.getmtime(_upload_path(upload_id, suffix)))
+            except OSError:
+                pass
+        if now - last_active <= ttl:
+            continue
+        if session['status'] != 'uploading':
+            _cleanup(upload_id, keep_session=False)
+            continue
+        try:
+            abort_upload(upload_id)
+            expired += 1
+            print(f"已中止过期的上传 {upload_id} ({session['filename']})")
+        except UploadError:
+            pass  # 恰好在完成
+        except Exception as e:
+            print(f"中止过期的上传 {upload_id} 时出错: {e}")
+    return expired
+
+def _maybe_expire_uploads():
+    """距上次清理超过 UPLOAD_SWEEP_INTERVAL 时清理过期会话 (以标记文件的 mtime 在进程间协调)。"""
+    marker = _upload_path('.last_sweep', '')
+    try:
+        if time.time() - os.path.getmtime(marker) < UPLOAD_SWEEP_INTERVAL:
+            return
+    except OSError:
+        pass
+    with open(marker, 'a'):
+        os.utime(marker)
+    try:
+        expire_uploads()
+    except Exception as e:
+        print(f"清理过期上传时出错: {e}")
+
+def _try_complete(upload_id):
+    """抢占完成标记；抢到的请求负责去重检查、完成 S3 上传并入队，其他请求返回 None。"""
+    marker = _upload_path(upload_id, '.complete')
+    if not _claim_marker(upload_id):
+        return None
+
+    try:
+        session = _load_session(upload_id)
+        data_path = _upload_path(upload_id, '.data')
+        content_hash = hash_file(data_path)
+        duplicate = find_duplicate_dataset(content_hash)
+        if duplicate is not None:
+            get_s3_client().abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=session['s3_key'],
+                                             UploadId=session['s3_upload_id'])
+            print(f"♻️ 上传 {session['filename']} 与数据集 #{duplicate['id']} 内容相同，已中止存档")
+            session.update(status='duplicate', content_hash=content_hash, duplicate=describe_duplicate(duplicate))
+            write_json(_upload_path(upload_id, '.json'), session)
+            _cleanup(upload_id, keep_session=True)
+            return session['duplicate']
+
+        parts = _received_parts(upload_id)
+        get_s3_client().complete_multipart_upload(
+            Bucket=S3_BUCKET_NAME,
+            Key=session['s3_key'],
+            UploadId=session['s3_upload_id'],
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': parts[n]['etag']}
+                                       for n in range(1, session['part_count'] + 1)]},
+        )
+        print(f"原始文件已上传至: s3://{S3_BUCKET_NAME}/{session['s3_key']}")
+
+        # 本地文件已完整，直接移交给上传任务；存档已在 S3 中，任务会跳过再次上传
+        job_id = new_job_id()
+        path = spool_file_path(job_id, session['filename'])
+        os.replace(data_path, path)
+        enqueue_job(job_id, 'upload', {'path': path, 'filename': session['filename'], 's3_key': session['s3_key'],
+                                       'content_hash': content_hash})
+    except Exception:
+        os.remove(marker)  # 允许重试
+        raise
+
+    session.update(status='completed', job_id=job_id, content_hash=content_hash)
+    write_json(_upload_path(upload_id, '.json'), session)
+    _cleanup(upload_id, keep_session=True)
+    return _job_info(job_id)
+
+def _cleanup(upload_id, keep_session):
+    shutil.rmtree(_upload_path(upload_id, '.parts'), ignore_errors=True)
+    suffixes = ['.data', '.complete', '.lock'] + ([] if keep_session else ['.json'])
+    for suffix in suffixes:
+        try:
+            os.remove(_upload_path(upload_id, suffix))
+        except OSError:
+            pass
+
+def _job_info(job_id):
+    return {'job_id': job_id, 'status_url': f"/api/jobs/{job_id}"}